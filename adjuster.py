@@ -0,0 +1,91 @@
+from twisted.internet import reactor
+
+# Sensor volts, higher is wetter. At WET_VOLTS a zone doesn't need watering
+# at all, at DRY_VOLTS it gets its full run time, and in between it's
+# scaled down in a straight line. Drier than that scales up, to MAX_SCALE.
+# These are only where "moistureAdjust" in the settings file starts from;
+# what your sensors read wet and dry is up to them.
+WET_VOLTS = 1.2
+DRY_VOLTS = 0.6
+MAX_SCALE = 1.5
+
+# Less than this much of a zone's run time isn't worth turning it on for.
+MIN_SCALE = 0.2
+
+# All of those, the way Settings.moistureAdjust has them.
+DEFAULT_LIMITS = { "wetVolts" : WET_VOLTS,
+                   "dryVolts" : DRY_VOLTS,
+                   "minScale" : MIN_SCALE,
+                   "maxScale" : MAX_SCALE }
+
+# Look this far ahead along the trend, so soil that's drying out fast gets
+# watered like it's already that dry.
+TREND_HORIZON = 6 * 60 * 60
+
+# Readings older than this mean the sensor's gone quiet. Don't trust the
+# trend then; water like normal.
+STALE_SECONDS = 60 * 60
+
+class WateringAdjuster(object):
+    """
+    Scales run times by how wet the soil is, from MoistureTrends the sampler
+    keeps up to date. Nothing here goes to rrdtool, so it costs the same
+    however much history there is.
+
+    trend is for every zone. zoneTrends is {zone : MoistureTrend} for zones
+    with a sensor of their own. limits is like DEFAULT_LIMITS, and comes
+    from the settings, so it's passed in every time instead of kept.
+    """
+    def __init__(self, trend, clock = reactor, zoneTrends = None):
+        self.trend = trend
+        self.clock = clock
+        self.zoneTrends = zoneTrends or {}
+
+    def trendFor(self, zone):
+        return self.zoneTrends.get(zone, self.trend)
+
+    def projected(self, zone):
+        """
+        The level this zone's sensor is headed for, or None if there's
+        nothing recent enough to go on.
+        """
+        trend = self.trendFor(zone)
+        now = self.clock.seconds()
+        if trend.level is None or now - trend.lastTimestamp > STALE_SECONDS:
+            return None
+        return trend.projected(now + TREND_HORIZON)
+
+    def scale(self, zone, limits = DEFAULT_LIMITS):
+        projected = self.projected(zone)
+        if projected is None:
+            return 1.0
+        wetVolts, dryVolts = limits["wetVolts"], limits["dryVolts"]
+        scale = min((wetVolts - projected) / (wetVolts - dryVolts), limits["maxScale"])
+        if scale < limits["minScale"]:
+            return 0.0
+        return scale
+
+    def adjust(self, runTimesMinutes, limits = DEFAULT_LIMITS):
+        """
+        A copy of runTimesMinutes with every zone scaled. Zones that are wet
+        enough come out as 0, which the planner skips.
+        """
+        return dict((zone, int(round(minutes * self.scale(zone, limits))))
+                    for zone, minutes in runTimesMinutes.items())
+
+    def describe(self, limits = DEFAULT_LIMITS):
+        """
+        One line on what the main sensor is doing and what it'll do to run
+        times, then one for each zone with its own.
+        """
+        lines = [self._describe("Moisture", None, limits)]
+        for zone in sorted(self.zoneTrends):
+            lines.append(self._describe("Zone %d" % zone, zone, limits))
+        return "\n".join(lines)
+
+    def _describe(self, name, zone, limits):
+        projected = self.projected(zone)
+        if projected is None:
+            return name + ": no recent readings, not adjusting."
+        return "%s: %.3f V, heading for %.3f V. Run times x%.2f." % (
+            name, self.trendFor(zone).level, projected, self.scale(zone, limits))
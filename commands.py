@@ -0,0 +1,116 @@
+from stats import STATS
+
+class UsageError(Exception):
+    """
+    Raise this from a handler when the arguments don't make sense. The
+    registry replies with the command's usage.
+    """
+
+class Command(object):
+    """
+    One chat command: what it's called, which handler method runs it, and
+    how it shows up in help.
+    """
+    def __init__(self, name, handlerName, aliases = (), usage = ("",), description = None,
+                 prefixes = True, title = None):
+        self.name = name
+        self.handlerName = handlerName
+        self.aliases = list(aliases)
+        self.usage = list(usage)
+        self.description = description
+        self.prefixes = prefixes
+        self.title = title
+
+    def names(self):
+        return [self.name] + self.aliases
+
+    def helpLines(self):
+        title = self.title
+        if title is None:
+            title = self.name
+            if self.aliases:
+                title += " (" + ", ".join(self.aliases) + ")"
+        lines = []
+        for usage in self.usage:
+            line = title
+            if usage:
+                line += " " + usage
+            if self.description:
+                line += ": " + self.description
+            lines.append(line)
+        return lines
+
+class CommandRegistry(object):
+    """
+    Maps every command name, alias, and unambiguous prefix straight to its
+    Command, so dispatching a message is one dict lookup. Exact names and
+    aliases always win over prefixes. The table is rebuilt whenever a command
+    is registered, which only happens at import time.
+
+    Handlers are named by method so one registry serves every instance of a
+    protocol. They get the Session the message came in on and the message
+    tokens, like handleOn(session, msgTokens), and reply with
+    session.sendText(). A handler can return a Deferred to make that
+    session's next command wait for it.
+    """
+    def __init__(self):
+        self.commands = []      # In help order
+        self.table = {}
+
+    def register(self, name, handlerName, **kwargs):
+        """
+        Takes the same arguments as Command.
+        """
+        self.commands.append(Command(name, handlerName, **kwargs))
+        self._rebuild()
+
+    def unregister(self, handlerName):
+        """
+        Take out the command handlerName runs, like before registering it
+        again with different names.
+        """
+        self.commands = [command for command in self.commands if command.handlerName != handlerName]
+        self._rebuild()
+
+    def _rebuild(self):
+        prefixOwners = {}
+        for command in self.commands:
+            if not command.prefixes:
+                continue
+            for name in command.names():
+                for i in range(1, len(name)):
+                    prefixOwners.setdefault(name[:i], set()).add(command)
+
+        table = dict((prefix, owners.pop()) for prefix, owners in prefixOwners.items()
+                     if len(owners) == 1)
+        for command in self.commands:
+            for name in command.names():
+                table[name] = command
+        self.table = table
+
+    def find(self, word):
+        return self.table.get(word.lower())
+
+    def dispatch(self, protocol, session, msgTokens):
+        """
+        Run the handler for msgTokens[0] on protocol, or its
+        handleUnknownCommand if there isn't one. Returns whatever the
+        handler does.
+        """
+        if not msgTokens:
+            return
+        command = self.find(msgTokens[0])
+        if command is None:
+            return protocol.handleUnknownCommand(session, msgTokens)
+        try:
+            return STATS.timed(command.handlerName, getattr(protocol, command.handlerName),
+                               session, msgTokens)
+        except UsageError, e:
+            session.sendText(str(e) + "\n" + "\n".join(command.helpLines()))
+
+    def helpText(self):
+        responseText = "Commands:\n"
+        for command in self.commands:
+            for line in command.helpLines():
+                responseText += line + "\n"
+        return responseText
@@ -0,0 +1,398 @@
+import threading
+import Queue
+
+from twisted.internet import reactor, defer
+from twisted.internet.task import LoopingCall
+from twisted.python import failure
+import u3
+
+from portshadow import PortShadow, RESYNC_COMMAND, commandBytes, isPortRead
+from stats import STATS
+
+# A Feedback packet is at most 64 bytes each way. Take off the 7 byte
+# command header and the 9 byte response header and this is what's left.
+MAX_FEEDBACK_COMMAND_BYTES = 57
+MAX_FEEDBACK_RESPONSE_BYTES = 55
+
+# How long shutdown waits for the worker to finish what's queued, like the
+# last ALL_OFF_COMMAND, before giving up on a wedged device.
+WORKER_SHUTDOWN_TIMEOUT = 5
+
+class WorkerStuck(Exception):
+    """
+    The worker never finished what it had, so nothing else can go to the
+    device.
+    """
+
+# How often a FeedbackBatcher reads the ports back to check its PortShadow.
+SHADOW_RESYNC_PERIOD = 15 * 60
+
+class DeviceWorker(object):
+    """
+    Owns a u3.U3 and is the only thing that ever touches it. Requests go in a
+    queue and get run one at a time, in order, on the worker's own thread, so
+    a slow USB transfer never holds up the reactor.
+
+    call() returns a Deferred that fires back on the reactor thread.
+
+    Pass device None and open() it to have the worker open it too. Anything
+    queued before it's open waits for it.
+
+    It stops in the "during" phase of shutdown, after every "before" trigger
+    (like the tac's, which turns everything off) has had its turn.
+    """
+    def __init__(self, device = None, reactor = reactor):
+        self.device = device
+        self.reactor = reactor
+        self.requests = Queue.Queue()
+        self.stopped = False
+        self.thread = threading.Thread(target = self._work, name = "DeviceWorker")
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+
+    def call(self, f, *args, **kwargs):
+        """
+        Run f(*args, **kwargs) on the worker thread. f is usually a
+        bound method of self.device.
+
+        Once it's stopped, f runs right here instead, after the worker's
+        done with everything before it. That way a last ALL_OFF_COMMAND
+        from late in shutdown, like from connectionLost, still goes out.
+        """
+        if self.stopped:
+            self.thread.join(WORKER_SHUTDOWN_TIMEOUT)
+            if self.thread.isAlive():
+                return defer.fail(WorkerStuck())
+            return defer.maybeDeferred(f, *args, **kwargs)
+        d = defer.Deferred()
+        self.requests.put((d, f, args, kwargs))
+        return d
+
+    def open(self, openDevice, *args, **kwargs):
+        """
+        Set self.device to openDevice(*args, **kwargs), like u3.U3(serial = ...),
+        run on the worker thread so the reactor isn't waiting on USB. The
+        Deferred fires with the device.
+        """
+        def opened():
+            self.device = openDevice(*args, **kwargs)
+            return self.device
+        return self.call(opened)
+
+    def stop(self):
+        """
+        Let the worker finish what's already queued, then exit.
+        """
+        if not self.stopped:
+            self.stopped = True
+            self.requests.put(None)
+
+    def _work(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            d, f, args, kwargs = request
+            try:
+                result = f(*args, **kwargs)
+            except:
+                self.reactor.callFromThread(d.errback, failure.Failure())
+            else:
+                self.reactor.callFromThread(d.callback, result)
+
+class InlineWorker(object):
+    """
+    Does what a DeviceWorker does, but right away on the calling thread.
+    Good for the simulator, where the device is a FakeU3 and the clock is
+    a task.Clock, so there's nothing to wait for. Without a device it stands
+    in for a DiskQueue.
+    """
+    def __init__(self, device = None):
+        self.device = device
+
+    def call(self, f, *args, **kwargs):
+        return defer.maybeDeferred(f, *args, **kwargs)
+
+class FeedbackBatcher(object):
+    """
+    Sits in front of a DeviceWorker and collects every getFeedback() made
+    during one reactor iteration, then sends them all in as few Feedback
+    packets as will fit (usually one). Each caller gets back a Deferred that
+    fires with its own results, the same list d.getFeedback() would have
+    returned.
+
+    Anything that isn't a Feedback command (configAnalog and friends) flushes
+    whatever is queued first so the device sees everything in the order it
+    was asked for. Those return Deferreds too.
+
+    Direction and state writes go through a PortShadow first, so only the
+    lines that would actually change get written. A write that wouldn't
+    change anything never goes out, and its result is None like it would
+    have been. The ports get read back with the first batch after every
+    SHADOW_RESYNC_PERIOD (or on their own if nothing else goes out for a
+    whole period), and any line that's not what the shadow thought gets
+    written next time.
+    """
+    def __init__(self, worker, clock = reactor):
+        self.worker = worker
+        self.clock = clock
+        self.pending = []       # (commandList, Deferred)
+        self.riders = []        # (commandList, Deferred) waiting for a batch
+        self.flushCall = None
+        self.shadow = PortShadow()
+        self.resyncRider = None
+        self.resyncLoop = LoopingCall(self.resync)
+        self.resyncLoop.clock = self.clock
+        self.resyncLoop.start(SHADOW_RESYNC_PERIOD, now = False)
+
+    def getFeedback(self, *commandList):
+        """
+        Takes the commands as separate arguments or as one list, like
+        u3.U3.getFeedback.
+        """
+        d = defer.Deferred()
+        self.pending.append((flattenCommands(commandList), d))
+        if self.flushCall is None:
+            self.flushCall = self.clock.callLater(0, self.flush)
+        return d
+
+    def piggyback(self, *commandList):
+        """
+        Like getFeedback, except it never sends a packet by itself. The
+        commands ride along with the next batch somebody else sends, and the
+        Deferred fires then. That could be never, so keep the Deferred and
+        unpiggyback() it if you get tired of waiting.
+        """
+        d = defer.Deferred()
+        self.riders.append((flattenCommands(commandList), d))
+        return d
+
+    def unpiggyback(self, d):
+        """
+        Take back commands from piggyback(). Returns False if they already
+        went out.
+        """
+        for i, (commandList, riderDeferred) in enumerate(self.riders):
+            if riderDeferred is d:
+                del self.riders[i]
+                return True
+        return False
+
+    def flush(self):
+        """
+        Send everything queued so far. Called at the end of the reactor
+        iteration, but it's fine to call it early, like right before
+        shutting down.
+        """
+        if self.flushCall is not None:
+            if self.flushCall.active():
+                self.flushCall.cancel()
+            self.flushCall = None
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        pending.extend(self.riders)
+        self.riders = []
+
+        # Line every command up with the index of the caller that queued it.
+        commands = []
+        owners = []
+        for i, (commandList, d) in enumerate(pending):
+            commands.extend(commandList)
+            owners.extend([i] * len(commandList))
+
+        # Cut the writes down to what changes anything, in order, and note
+        # what the shadow said at each port read so it can be checked.
+        toSend = []
+        sentFrom = []           # Index in commands of each one in toSend
+        snapshots = {}          # Index in toSend : PortShadow.snapshot()
+        for i, command in enumerate(commands):
+            command = self.shadow.reduce(command)
+            if command is None:
+                continue
+            if isPortRead(command):
+                snapshots[len(toSend)] = self.shadow.snapshot()
+            toSend.append(command)
+            sentFrom.append(i)
+        if not toSend:
+            self._distribute([], pending, owners, toSend, sentFrom, snapshots)
+            return
+
+        sent = STATS.timed("feedback batch", self.worker.call, _sendPackets, self.worker, toSend)
+        sent.addCallbacks(self._distribute, self._notSent,
+                          callbackArgs = (pending, owners, toSend, sentFrom, snapshots),
+                          errbackArgs = (pending,))
+
+    def _distribute(self, packets, pending, owners, toSend, sentFrom, snapshots):
+        """
+        Hand each caller its results from the packets _sendPackets sent.
+        Commands that didn't have to go out get None.
+        """
+        commandResults = [None] * len(owners)
+        failures = [None] * len(pending)
+        for (start, end), packetResults in packets:
+            if isinstance(packetResults, failure.Failure):
+                self.shadow.forget() # Some of it might have happened
+                for i in sentFrom[start:end]:
+                    failures[owners[i]] = failures[owners[i]] or packetResults
+            else:
+                for j, result in zip(range(start, end), packetResults):
+                    commandResults[sentFrom[j]] = result
+                    if j in snapshots and self.shadow.check(snapshots[j], toSend[j], result):
+                        print "U3 ports weren't what they should be. Rewriting them next time."
+
+        results = [[] for p in pending]
+        for owner, result in zip(owners, commandResults):
+            results[owner].append(result)
+        for (commandList, d), result, f in zip(pending, results, failures):
+            if f:
+                d.errback(f)
+            else:
+                d.callback(result)
+
+    def _notSent(self, reason, pending):
+        """
+        The worker couldn't even try, like when the U3 never opened.
+        """
+        self.shadow.forget()
+        for commandList, d in pending:
+            d.errback(reason)
+
+    def resync(self):
+        """
+        Read the ports back so the shadow can't drift from the U3 for long.
+        """
+        if self.resyncRider is not None and self.unpiggyback(self.resyncRider):
+            self.resyncRider = None
+            return self.getFeedback(RESYNC_COMMAND).addErrback(lambda reason: None)
+        self.resyncRider = self.piggyback(RESYNC_COMMAND).addErrback(lambda reason: None)
+
+    def configAnalog(self, *args):
+        self.flush()
+        self.shadow.forget(*args) # Switching modes can change them
+        return self.worker.call(_callDevice, self.worker, "configAnalog", *args)
+
+    def configDigital(self, *args):
+        self.flush()
+        self.shadow.forget(*args)
+        return self.worker.call(_callDevice, self.worker, "configDigital", *args)
+
+    def readRegister(self, *args, **kwargs):
+        self.flush()
+        return self.worker.call(_callDevice, self.worker, "readRegister", *args, **kwargs)
+
+    def readAnalog(self, *channels):
+        """
+        Volts on each AIN channel, in order. It's one u3.AIN apiece in the
+        same batch as everybody else's commands, so any number of channels
+        is still one trip over USB. The worker turns the bits into volts
+        with the U3's own calibration.
+        """
+        d = self.getFeedback([u3.AIN(channel) for channel in channels])
+        return d.addCallback(lambda bits: self.worker.call(_toVolts, self.worker, channels, bits))
+
+class DevicePool(object):
+    """
+    A FeedbackBatcher for each U3, by serial number. Each one should have its
+    own DeviceWorker, so every U3 gets its own thread and a slow board never
+    holds up commands for the others.
+
+    A serial of None gets the first one added, so with one board nobody has
+    to know its serial number.
+    """
+    def __init__(self):
+        self.batchers = {}      # serial : FeedbackBatcher
+        self.serials = []       # In the order they were added
+
+    def add(self, serial, batcher):
+        self.batchers[serial] = batcher
+        self.serials.append(serial)
+
+    def get(self, serial = None):
+        if serial is None and serial not in self.batchers:
+            serial = self.serials[0]
+        return self.batchers[serial]
+
+    def __iter__(self):
+        return iter([self.batchers[serial] for serial in self.serials])
+
+    def __len__(self):
+        return len(self.serials)
+
+    def broadcast(self, *commandList):
+        """
+        getFeedback on every U3. The Deferred fires with a list of
+        (success, results), one for each, like a DeferredList.
+        """
+        return defer.DeferredList([d.getFeedback(*commandList) for d in self])
+
+    def flush(self):
+        for d in self:
+            d.flush()
+
+def _callDevice(worker, methodName, *args, **kwargs):
+    """
+    Runs on the worker thread, where worker.device is sure to be open.
+    """
+    return getattr(worker.device, methodName)(*args, **kwargs)
+
+def _toVolts(worker, channels, bits):
+    """
+    Runs on the worker thread, since the calibration is the device's. AIN0-3
+    on a U3-HV are the high voltage ones.
+    """
+    device = worker.device
+    isHV = getattr(device, "isHV", False)
+    return [device.binaryToCalibratedAnalogVoltage(value, isLowVoltage = not (isHV and channel < 4),
+                                                   channelNumber = channel)
+            for channel, value in zip(channels, bits)]
+
+def _sendPackets(worker, commands):
+    """
+    Runs on the worker thread. Sends commands in as many packets as it takes
+    and returns [((start, end), results or Failure), ...] so one bad packet
+    doesn't sink the rest.
+    """
+    device = worker.device
+    packets = []
+    for start, end in _packetBounds(commands):
+        try:
+            packets.append(((start, end), STATS.timed("getFeedback", device.getFeedback, commands[start:end])))
+        except Exception:
+            packets.append(((start, end), failure.Failure()))
+    return packets
+
+def flattenCommands(commandList):
+    """
+    getFeedback takes commands, lists of commands, or lists of lists.
+    """
+    flat = []
+    for command in commandList:
+        if isinstance(command, (list, tuple)):
+            flat.extend(flattenCommands(command))
+        else:
+            flat.append(command)
+    return flat
+
+def _packetBounds(commands):
+    """
+    Split commands into (start, end) slices that each fit in one Feedback
+    packet, in order.
+    """
+    bounds = []
+    start = 0
+    packetCommandBytes = packetResponseBytes = 0
+    for i, command in enumerate(commands):
+        thisCommandBytes = len(commandBytes(command))
+        thisResponseBytes = command.readLen
+        if i > start and (packetCommandBytes + thisCommandBytes > MAX_FEEDBACK_COMMAND_BYTES or
+                          packetResponseBytes + thisResponseBytes > MAX_FEEDBACK_RESPONSE_BYTES):
+            bounds.append((start, i))
+            start = i
+            packetCommandBytes = packetResponseBytes = 0
+        packetCommandBytes += thisCommandBytes
+        packetResponseBytes += thisResponseBytes
+    if start < len(commands):
+        bounds.append((start, len(commands)))
+    return bounds
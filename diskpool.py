@@ -0,0 +1,119 @@
+import threading
+
+from twisted.internet import reactor, defer, threads
+from twisted.python.threadpool import ThreadPool
+
+# rrdtool and the config journal get their own few threads, so a stalled
+# SD card never holds up the reactor and never ties up the reactor's
+# thread pool either.
+DISK_THREADS = 2
+
+# How long shutdown waits for the last writes before giving up on a
+# wedged card.
+DISK_SHUTDOWN_TIMEOUT = 10
+
+class DiskPool(object):
+    """
+    A small ThreadPool for blocking disk I/O. call() returns a Deferred that
+    fires back on the reactor thread. It starts with the first call and
+    shutdown waits (for a while) for everything it was given to finish.
+    Anything called after it's stopped, like a close from connectionLost,
+    runs right on the calling thread, so it still gets written.
+    """
+    def __init__(self, threads = DISK_THREADS, reactor = reactor):
+        self.reactor = reactor
+        self.pool = ThreadPool(1, threads, "DiskPool")
+        self.pool.threadFactory = _daemonThread # A wedged card can't keep us from exiting
+        self.started = False
+        self.stopped = False
+        self.busy = 0
+        self.idle = []          # Deferreds waiting for busy to get to 0
+
+    def call(self, f, *args, **kwargs):
+        if self.stopped:
+            return defer.maybeDeferred(f, *args, **kwargs)
+        if not self.started:
+            self.started = True
+            self.pool.start()
+            self.reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+        self.busy += 1
+        d = threads.deferToThreadPool(self.reactor, self.pool, f, *args, **kwargs)
+        return d.addBoth(self._finished)
+
+    def stop(self):
+        """
+        Wait until there's nothing left to do, then stop the threads. It
+        looks again a reactor turn later, after everything else shutting
+        down has had its chance to write something. Returns a Deferred so
+        shutdown waits for it, but only for so long.
+        """
+        done = defer.Deferred()
+        timeout = self.reactor.callLater(DISK_SHUTDOWN_TIMEOUT, done.callback, False)
+        def check(ignored = None):
+            if not timeout.active():
+                return
+            if self.busy:
+                self.whenIdle().addCallback(lambda ignored: self.reactor.callLater(0, check))
+            else:
+                timeout.cancel()
+                done.callback(True)
+        self.reactor.callLater(0, check)
+        def finished(idle):
+            if idle:
+                self.pool.stop()
+                self.stopped = True
+            else:
+                print "Gave up waiting on the disk. Some writes might not have made it."
+        return done.addCallback(finished)
+
+    def whenIdle(self):
+        if not self.busy:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.idle.append(d)
+        return d
+
+    def _finished(self, result):
+        self.busy -= 1
+        if not self.busy:
+            idle, self.idle = self.idle, []
+            for d in idle:
+                d.callback(None)
+        return result
+
+def _daemonThread(*args, **kwargs):
+    thread = threading.Thread(*args, **kwargs)
+    thread.setDaemon(True)
+    return thread
+
+_diskPool = None
+
+def diskPool():
+    """
+    The DiskPool everybody shares.
+    """
+    global _diskPool
+    if _diskPool is None:
+        _diskPool = DiskPool()
+    return _diskPool
+
+class DiskQueue(object):
+    """
+    Calls that have to happen one at a time and in order, like appends to
+    one file, run on the DiskPool. Each queue waits for its own calls, not
+    for anybody else's.
+    """
+    def __init__(self, pool = None):
+        self.pool = pool
+        self.last = defer.succeed(None)
+
+    def call(self, f, *args, **kwargs):
+        pool = self.pool or diskPool()
+        pool.busy += 1 # From now, not just once it's its turn, so shutdown waits for it
+        result = defer.Deferred()
+        def run(ignored):
+            d = pool.call(f, *args, **kwargs)
+            d.chainDeferred(result)
+            return d.addBoth(pool._finished)
+        self.last.addCallback(run)
+        return result
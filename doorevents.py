@@ -0,0 +1,244 @@
+import json
+import os
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+from twisted.words.protocols.jabber.jid import InvalidFormat, internJID
+
+from diskpool import DiskQueue
+
+# Where the JIDs that subscribed to door events are kept between restarts.
+SUBSCRIBERS_NAME = "liftbot-subscribers.json"
+
+# The doors, and which DoorState attribute says each one is up.
+DOORS = [("big", "bigDoorUp"), ("little", "littleDoorUp")]
+
+# What an event can say happened.
+OPENED = "opened"
+CLOSED = "closed"
+LEFT_OPEN = "left open"
+
+class DoorEvents(object):
+    """
+    Tells everybody subscribed every time a door opens or closes, one line
+    of JSON per door per change, so nobody has to poll LiftBot's presence:
+
+        {"door": "big", "event": "closed", "openSeconds": 754, "time": 1760781600}
+
+    openSeconds is how long the door had been open (0 when it opens).
+    Subscribers who asked for alerts also get a "left open" event once a
+    door's been open that many minutes. That comes off a timer set from
+    when the door opened, not from reading the doors any more often.
+
+    JIDs get theirs through sendText(jid, text), LiftBot's outbound queue,
+    and stay subscribed across restarts. They're kept by bare JID, so
+    subscribing from the phone and unsubscribing from the laptop works, and
+    the server hands the events to whichever client is on. Connections to the event socket
+    (see DoorEventFactory) get theirs with sendLine() for as long as they're
+    connected.
+    """
+    def __init__(self, sendText, path = SUBSCRIBERS_NAME, clock = reactor, disk = None):
+        self.sendText = sendText
+        self.path = path
+        self.clock = clock
+        self.disk = disk or DiskQueue()
+        self.jids = {}          # Bare JID : alert minutes or None
+        self.listeners = {}     # Connection : alert minutes or None
+        self.openSince = {}     # door : when it opened
+        self.alerted = set()    # (door, minutes) already sent since it opened
+        self.alertCall = None
+        self.load()
+
+    def subscribe(self, jid, minutes = None):
+        self.jids[bareJid(jid)] = minutes
+        self.save()
+        self._scheduleAlert()
+
+    def unsubscribe(self, jid):
+        """
+        Returns False if jid wasn't subscribed.
+        """
+        jid = bareJid(jid)
+        if jid not in self.jids:
+            return False
+        del self.jids[jid]
+        self.save()
+        self._scheduleAlert()
+        return True
+
+    def listen(self, connection, minutes = None):
+        self.listeners[connection] = minutes
+        self._scheduleAlert()
+
+    def stopListening(self, connection):
+        self.listeners.pop(connection, None)
+        self._scheduleAlert()
+
+    def doorsChanged(self, oldState, newState, when):
+        """
+        The doors went from oldState to newState at when. With no oldState
+        (LiftBot just started), doors that are up count as opened at when
+        but nobody hears about it.
+        """
+        for door, attribute in DOORS:
+            isUp = getattr(newState, attribute)
+            if oldState is None:
+                if isUp:
+                    self.openSince[door] = when
+            elif isUp and not getattr(oldState, attribute):
+                self.openSince[door] = when
+                self._publish(door, OPENED, when)
+            elif not isUp and getattr(oldState, attribute):
+                self._publish(door, CLOSED, when)
+                self.openSince.pop(door, None)
+                self.alerted = set((alertDoor, minutes) for alertDoor, minutes in self.alerted if alertDoor != door)
+        self._scheduleAlert()
+
+    def describe(self, jid):
+        jid = bareJid(jid)
+        if jid not in self.jids:
+            return "Not subscribed to door events."
+        if self.jids[jid] is None:
+            return "Subscribed to door events."
+        return "Subscribed to door events, and to alerts after %d minutes open." % self.jids[jid]
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                jids = json.load(f)
+        except IOError:
+            return
+        except ValueError, e:
+            print "Not using the door event subscribers in", self.path + ".", e
+            return
+        if not isinstance(jids, dict):
+            print "Not using the door event subscribers in", self.path + ". Should be a JSON object."
+            return
+        self.jids = {}
+        for jid, minutes in jids.items():
+            try:
+                self.jids[bareJid(jid)] = minutes # Older files have whole JIDs
+            except InvalidFormat:
+                print "Not a JID in", self.path + ":", jid
+
+    def save(self):
+        """
+        Write the JIDs out on the disk queue. The Deferred fires once
+        they're in.
+        """
+        d = self.disk.call(_writeJson, self.path, dict(self.jids))
+        def failed(reason):
+            print "Couldn't save the door event subscribers.", reason.getErrorMessage()
+        return d.addErrback(failed)
+
+    def stop(self):
+        if self.alertCall and self.alertCall.active():
+            self.alertCall.cancel()
+        self.alertCall = None
+
+    def _publish(self, door, event, when, minutes = None):
+        """
+        Send the event to everybody, or with minutes, just the ones who
+        asked for alerts after that long.
+        """
+        text = json.dumps({"door" : door,
+                           "event" : event,
+                           "time" : int(when),
+                           "openSeconds" : int(when - self.openSince.get(door, when))}, sort_keys = True)
+        for jid, alertMinutes in self.jids.items():
+            if minutes is None or alertMinutes == minutes:
+                self.sendText(jid, text)
+        for connection, alertMinutes in self.listeners.items():
+            if minutes is None or alertMinutes == minutes:
+                connection.sendLine(text)
+
+    def _alertMinutes(self):
+        return set(minutes for minutes in self.jids.values() + self.listeners.values() if minutes is not None)
+
+    def _scheduleAlert(self):
+        """
+        Set one timer for the next left-open alert anybody wants, if a
+        door's open.
+        """
+        self.stop()
+        due = [since + minutes * 60
+               for door, since in self.openSince.items()
+               for minutes in self._alertMinutes()
+               if (door, minutes) not in self.alerted]
+        if due:
+            self.alertCall = self.clock.callLater(max(0, min(due) - self.clock.seconds()), self._alert)
+
+    def _alert(self):
+        self.alertCall = None
+        now = self.clock.seconds()
+        for door, since in self.openSince.items():
+            for minutes in sorted(self._alertMinutes()):
+                if (door, minutes) not in self.alerted and since + minutes * 60 <= now:
+                    self.alerted.add((door, minutes))
+                    self._publish(door, LEFT_OPEN, now, minutes)
+        self._scheduleAlert()
+
+class DoorEventProtocol(LineReceiver):
+    """
+    One connection to the event socket, subscribed until it hangs up. Send
+    it a number of minutes to get left-open alerts too, or "off" to stop
+    them.
+    """
+    delimiter = "\n"
+
+    def connectionMade(self):
+        self.factory.events.listen(self)
+
+    def connectionLost(self, reason):
+        self.factory.events.stopListening(self)
+
+    def lineReceived(self, line):
+        line = line.strip()
+        if line == "off":
+            self.factory.events.listen(self, None)
+            return
+        minutes = parseMinutes(line)
+        if minutes is None:
+            self.sendLine(json.dumps({"error" : "Not a number of minutes: " + line}))
+            return
+        self.factory.events.listen(self, minutes)
+
+class DoorEventFactory(Factory):
+    """
+    For strports.service(), like DOOR_EVENTS_PORT in rainbot.tac.
+    """
+    protocol = DoorEventProtocol
+
+    def __init__(self, events):
+        self.events = events
+
+def bareJid(jid):
+    """
+    user@host from user@host/resource.
+    """
+    return str(internJID(unicode(jid)).userhost())
+
+def parseMinutes(text):
+    """
+    A whole number of minutes more than 0, or None if text isn't one.
+    """
+    try:
+        minutes = int(text)
+    except ValueError:
+        return None
+    if minutes < 1:
+        return None
+    return minutes
+
+def _writeJson(path, value):
+    """
+    On the disk queue. Written next to path and renamed over it, so a crash
+    never leaves half of it.
+    """
+    newPath = path + ".new"
+    with open(newPath, "w") as f:
+        json.dump(value, f, sort_keys = True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(newPath, path)
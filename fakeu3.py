@@ -0,0 +1,144 @@
+from device import flattenCommands, commandBytes
+
+# Feedback IOTypes this understands. Anything else gets all-zero results.
+AIN                = 1
+BIT_STATE_READ     = 10
+BIT_STATE_WRITE    = 11
+BIT_DIR_READ       = 12
+BIT_DIR_WRITE      = 13
+PORT_STATE_READ    = 26
+PORT_STATE_WRITE   = 27
+PORT_DIR_READ      = 28
+PORT_DIR_WRITE     = 29
+DAC0_16            = 38
+DAC1_16            = 39
+
+# Low voltage single-ended AIN: 0-2.44 V over 16 bits
+AIN_VOLTS_PER_BIT = 2.44 / 65536
+
+# FIO0-7, EIO0-7 and CIO0-3, numbered 0-19 like LabJackPython does. The
+# port commands have bits for CIO4-7 too, but like on a real U3, writing
+# them does nothing and they read 0.
+NUM_IO = 20
+PORT_LINES = 24         # What a port command reads and writes
+
+class FakeU3(object):
+    """
+    Pretends to be a u3.U3, enough for RainBot, LiftBot, and the moisture
+    sampler to run against it.
+
+    It decodes the Feedback command bytes the way the real device does, so
+    whatever LabJackPython builds works here too. It keeps the state and
+    direction of every FIO/EIO/CIO line (CIO only has 4), the DACs, and
+    which lines are analog. Input lines read whatever setInput() last put on
+    them (high, like a pull-up, if nothing did) and analog inputs read
+    whatever setVoltage() put on them.
+
+    relayLog gets (time, lines) every time the set of output lines driven low
+    changes. That's the set of relays that are on. Pass a clock to get real
+    times in it.
+    """
+    def __init__(self, clock = None):
+        self.clock = clock
+        self.states = [1] * NUM_IO
+        self.directions = [0] * NUM_IO    # 1 is output
+        self.analog = set()
+        self.inputs = {}                  # IO number : level on an input line
+        self.voltages = {}                # AIN channel : volts
+        self.dacs = [0, 0]
+        self.feedbackCount = 0            # One per USB round trip
+        self.commandCount = 0             # Feedback commands in all of those
+        self.relayLog = []
+        self.lastRelays = ()
+
+    def setInput(self, ioNumber, level):
+        self.inputs[ioNumber] = int(bool(level))
+
+    def setVoltage(self, channel, volts):
+        self.voltages[channel] = volts
+
+    def relaysOn(self):
+        """
+        The output lines that are low, which is what turns a relay on.
+        """
+        return tuple(io for io in range(NUM_IO) if self.directions[io] and not self.states[io])
+
+    def getFeedback(self, *commandList):
+        self.feedbackCount += 1
+        results = []
+        for command in flattenCommands(commandList):
+            self.commandCount += 1
+            response = self._run(list(commandBytes(command)))
+            response += [0] * (command.readLen - len(response))
+            results.append(command.handle(response))
+        relays = self.relaysOn()
+        if relays != self.lastRelays:
+            self.lastRelays = relays
+            self.relayLog.append((self.clock and self.clock.seconds(), relays))
+        return results
+
+    def configAnalog(self, *ioNumbers):
+        self.analog.update(ioNumbers)
+
+    def configDigital(self, *ioNumbers):
+        self.analog.difference_update(ioNumbers)
+
+    def readRegister(self, addr, numReg = None, format = None, unitId = None):
+        """
+        The AIN registers are two apiece starting at 0 and read in volts.
+        """
+        return self.voltages.get(addr // 2, 0.0)
+
+    def binaryToCalibratedAnalogVoltage(self, bits, isLowVoltage = True, isSingleEnded = True,
+                                        isSpecialSetting = False, channelNumber = 0):
+        return bits * AIN_VOLTS_PER_BIT
+
+    def readBit(self, ioNumber):
+        if ioNumber >= NUM_IO:
+            return 0
+        if self.directions[ioNumber]:
+            return self.states[ioNumber]
+        return self.inputs.get(ioNumber, 1)
+
+    def _run(self, cmdBytes):
+        """
+        Do one Feedback command and return its response bytes.
+        """
+        ioType = cmdBytes[0]
+        if ioType == AIN:
+            bits = int(self.voltages.get(cmdBytes[1] & 0x1f, 0.0) / AIN_VOLTS_PER_BIT)
+            bits = max(0, min(bits, 0xffff))
+            return [bits & 0xff, bits >> 8]
+        elif ioType == BIT_STATE_READ:
+            return [self.readBit(cmdBytes[1] & 0x1f)]
+        elif ioType == BIT_STATE_WRITE:
+            if cmdBytes[1] & 0x1f < NUM_IO:
+                self.states[cmdBytes[1] & 0x1f] = cmdBytes[1] >> 7
+        elif ioType == BIT_DIR_READ:
+            if cmdBytes[1] & 0x1f < NUM_IO:
+                return [self.directions[cmdBytes[1] & 0x1f]]
+            return [0]
+        elif ioType == BIT_DIR_WRITE:
+            if cmdBytes[1] & 0x1f < NUM_IO:
+                self.directions[cmdBytes[1] & 0x1f] = cmdBytes[1] >> 7
+        elif ioType == PORT_STATE_READ:
+            return self._portBytes([self.readBit(io) for io in range(NUM_IO)])
+        elif ioType == PORT_STATE_WRITE:
+            self._writePorts(self.states, cmdBytes[1:4], cmdBytes[4:7])
+        elif ioType == PORT_DIR_READ:
+            return self._portBytes(self.directions)
+        elif ioType == PORT_DIR_WRITE:
+            self._writePorts(self.directions, cmdBytes[1:4], cmdBytes[4:7])
+        elif ioType in (DAC0_16, DAC1_16):
+            self.dacs[ioType - DAC0_16] = cmdBytes[1] + (cmdBytes[2] << 8)
+        return []
+
+    def _portBytes(self, bits):
+        bits = list(bits[:NUM_IO]) + [0] * (PORT_LINES - NUM_IO)
+        return [sum(bits[port * 8 + i] << i for i in range(8)) for port in range(3)]
+
+    def _writePorts(self, bits, writeMask, values):
+        for io in range(NUM_IO):
+            port, i = divmod(io, 8)
+            if writeMask[port] & (1 << i):
+                bits[io] = (values[port] >> i) & 1
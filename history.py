@@ -0,0 +1,190 @@
+import os
+import re
+import struct
+from bisect import bisect_right
+
+from diskpool import DiskQueue
+
+HISTORY_NAME = "rainbot-history"
+
+# Every event is one of these: when, what kind, flags, zone, and a number
+# that depends on the kind (days for a pause). Fixed width, so the Nth
+# event is at N * EVENT.size.
+EVENT = struct.Struct(">dBBHi")
+
+# What can be in the log.
+ZONE_ON, ZONE_OFF, PROGRAM_START, PROGRAM_END, PAUSE, TURNED_OFF, TURNED_ON, SKIPPED = range(1, 9)
+KIND_NAMES = { ZONE_ON       : "on",
+               ZONE_OFF      : "off",
+               PROGRAM_START : "program started",
+               PROGRAM_END   : "program finished",
+               PAUSE         : "paused",
+               TURNED_OFF    : "sprinklers off",
+               TURNED_ON     : "sprinklers on",
+               SKIPPED       : "skipped, soil was wet" }
+
+# Flags
+MANUAL = 1
+
+# Keep the time of every INDEX_EVERYth event in memory. A query looks up
+# where to start in that and reads from there.
+INDEX_EVERY = 256
+
+# A query starts this much early so zones that were already on when the
+# range starts get counted. Nothing runs longer than this.
+LOOKBACK_SECONDS = 24 * 60 * 60
+
+# For "30d", "1w", "week", and so on.
+UNIT_SECONDS = { "h" : 60 * 60,
+                 "d" : 24 * 60 * 60,
+                 "w" : 7 * 24 * 60 * 60,
+                 "m" : 30 * 24 * 60 * 60,
+                 "y" : 365 * 24 * 60 * 60 }
+UNIT_WORDS = { "hour" : "h", "day" : "d", "week" : "w", "month" : "m", "year" : "y" }
+
+class HistoryLog(object):
+    """
+    Every zone on and off, program, pause, and off and on, appended to a file
+    of fixed-width EVENTs. Nothing's ever rewritten, and nothing's kept in
+    memory except a sparse index, so it can go on for years.
+
+    Times only go forward in the log. If the clock jumps back, events get
+    the last time that was logged instead.
+
+    Opening it reads the whole index, so do that on a thread. After that,
+    the appends and the reads for queries happen on disk, a DiskQueue unless
+    you pass something else with a call(), in order, so a query sees every
+    event added before it.
+    """
+    def __init__(self, path = HISTORY_NAME, disk = None):
+        self.path = path
+        self.disk = disk or DiskQueue()
+        self.index = []         # Time of event 0, INDEX_EVERY, 2 * INDEX_EVERY, ...
+        self.count = 0
+        self.lastTime = 0.0
+        self._recover()
+        self.log = open(self.path, "ab")
+
+    def add(self, when, kind, zone = 0, manual = False, number = 0):
+        when = max(when, self.lastTime)
+        if self.count % INDEX_EVERY == 0:
+            self.index.append(when)
+        self.count += 1
+        self.lastTime = when
+        d = self.disk.call(self._append, EVENT.pack(when, kind, MANUAL if manual else 0, zone, number))
+        def failed(reason):
+            print "Couldn't log an event to", self.path, reason.getErrorMessage()
+        return d.addErrback(failed)
+
+    def events(self, start, end = None):
+        """
+        A Deferred that fires with [(when, kind, zone, manual, number), ...]
+        for every event from start up to end (or the end of the log), oldest
+        first. It only reads from the index entry before start.
+        """
+        first = max(0, bisect_right(self.index, start) - 1) * INDEX_EVERY
+        return self.disk.call(self._read, first, self.count, start, end)
+
+    def usage(self, start, end, zones = None):
+        """
+        A Deferred that fires with {zone : (seconds on, times turned on)}
+        between start and end. A zone that was already on at start counts
+        from start, and one that's still on at end counts up to end.
+        """
+        d = self.events(start - LOOKBACK_SECONDS, end)
+        return d.addCallback(self._usage, start, end, zones)
+
+    def close(self):
+        return self.disk.call(self.log.close)
+
+    def _append(self, record):
+        """
+        On the disk queue.
+        """
+        self.log.write(record)
+        self.log.flush()
+
+    def _read(self, first, count, start, end):
+        """
+        On the disk queue. Events first up to count that are between start
+        and end.
+        """
+        events = []
+        with open(self.path, "rb") as f:
+            f.seek(first * EVENT.size)
+            for i in xrange(first, count):
+                when, kind, flags, zone, number = EVENT.unpack(f.read(EVENT.size))
+                if when < start:
+                    continue
+                if end is not None and when > end:
+                    break
+                events.append((when, kind, zone, bool(flags & MANUAL), number))
+        return events
+
+    def _usage(self, events, start, end, zones):
+        usage = {}
+        onSince = {}
+        for when, kind, zone, manual, number in events:
+            if zones is not None and zone not in zones:
+                continue
+            if kind == ZONE_ON:
+                onSince[zone] = when
+                if when >= start:
+                    seconds, runs = usage.get(zone, (0.0, 0))
+                    usage[zone] = (seconds, runs + 1)
+            elif kind == ZONE_OFF and zone in onSince:
+                self._addTime(usage, zone, onSince.pop(zone), when, start)
+        for zone, since in onSince.items():
+            self._addTime(usage, zone, since, end, start)
+        return usage
+
+    def _addTime(self, usage, zone, on, off, start):
+        seconds, runs = usage.get(zone, (0.0, 0))
+        usage[zone] = (seconds + max(0.0, off - max(on, start)), runs)
+
+    def _recover(self):
+        """
+        Cut off a partly written event, then read every INDEX_EVERYth time
+        into the index.
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size % EVENT.size:
+            print "Dropping the unfinished end of", self.path
+            with open(self.path, "r+b") as f:
+                f.truncate(size - size % EVENT.size)
+        self.count = size // EVENT.size
+        with open(self.path, "rb") as f:
+            for i in xrange(0, self.count, INDEX_EVERY):
+                f.seek(i * EVENT.size)
+                self.index.append(EVENT.unpack(f.read(EVENT.size))[0])
+            if self.count:
+                f.seek((self.count - 1) * EVENT.size)
+                self.lastTime = EVENT.unpack(f.read(EVENT.size))[0]
+
+def parsePeriod(text):
+    """
+    Seconds in "30d", "12h", "1w", "week", "2months", and so on, or None if
+    it isn't one of those.
+    """
+    match = re.match(r"^(\d*)\s*([a-z]+?)s?$", text.lower())
+    if not match:
+        return None
+    count, unit = match.groups()
+    unit = UNIT_WORDS.get(unit, unit)
+    if unit not in UNIT_SECONDS:
+        return None
+    return int(count or 1) * UNIT_SECONDS[unit]
+
+def describeEvent(kind, zone, manual, number):
+    if kind in (ZONE_ON, ZONE_OFF):
+        text = "Zone %d %s" % (zone, KIND_NAMES[kind])
+    else:
+        text = KIND_NAMES.get(kind, "something (%d)" % kind).capitalize()
+    if kind == PAUSE:
+        text += " %d days" % number
+    if kind in (ZONE_ON, PROGRAM_START):
+        text += manual and " (manual)" or " (scheduled)"
+    return text
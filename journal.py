@@ -0,0 +1,271 @@
+import os
+import struct
+import time
+import zlib
+import cPickle as pickle
+
+from twisted.internet import reactor, defer
+
+from diskpool import DiskQueue
+from stats import STATS
+
+# Every record is this header followed by a pickled (key, value) payload.
+# The value is pickled on its own, or None for a delete.
+RECORD_HEADER = struct.Struct(">II")    # payload length, crc32 of the payload
+
+# Rewrite the journal once it's this many times the size of the live data,
+# but don't bother while it's small.
+COMPACT_RATIO = 4
+COMPACT_MIN_BYTES = 64 * 1024
+
+class JournalStore(object):
+    """
+    A stand-in for a shelve that never rewrites anything in place. Every
+    assignment appends a record to the journal file; the records written
+    during one reactor iteration go out together with one fsync, no matter how
+    many times sync() gets called.
+
+    Like shelve, values are pickled, so changing what you got back doesn't
+    change the store until you assign it again.
+
+    On open, the journal is replayed up to the last record that checks out
+    and anything after that (a write cut off by a power failure) is dropped.
+    Once the journal gets big it's rewritten with just the live values and
+    swapped in with a rename.
+
+    All the writing happens on disk, a DiskQueue unless you pass something
+    else with a call() (like an InlineWorker to simulate), so a slow card
+    never holds up the reactor. Only the queue's calls touch the file, one
+    at a time, in order.
+    """
+    def __init__(self, path, clock = reactor, disk = None):
+        self.path = path
+        self.compactPath = path + ".compact"
+        self.clock = clock
+        self.disk = disk or DiskQueue()
+        self.data = {}          # key : pickled value
+        self.unwritten = []     # Records waiting for the next flush
+        self.flushCall = None
+        self.compacting = None  # Records written since the compaction snapshot
+        self.swapping = False   # The compacted file is waiting to be swapped in
+        self.closed = False
+        self.journalBytes = self._recover()
+        self.journal = open(self.path, "ab")
+
+    def __getitem__(self, key):
+        return pickle.loads(self.data[key])
+
+    def __setitem__(self, key, value):
+        valueBytes = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.data[key] = valueBytes
+        self._append(_encodeRecord(key, valueBytes))
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self._append(_encodeRecord(key, None))
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data.keys())
+
+    def has_key(self, key):
+        return key in self.data
+
+    def keys(self):
+        return self.data.keys()
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def sync(self):
+        """
+        Make sure what's been assigned gets written. It happens at the end of
+        this reactor iteration along with everything else.
+        """
+        if self.unwritten and self.flushCall is None:
+            self.flushCall = self.clock.callLater(0, self.flush)
+
+    def flush(self):
+        """
+        Send everything assigned so far to be written and fsynced, now
+        instead of at the end of the reactor iteration. The Deferred fires
+        once it's on disk.
+        """
+        if self.flushCall is not None:
+            if self.flushCall.active():
+                self.flushCall.cancel()
+            self.flushCall = None
+        if not self.unwritten or self.closed:
+            return defer.succeed(None)
+        records = "".join(self.unwritten)
+        self.unwritten = []
+        d = self.disk.call(self._write, records)
+        d.addCallback(self._written, len(records))
+        return d
+
+    def writeNow(self, items):
+        """
+        Assign every (key, value) in items and write them right here, on
+        this thread. It never goes near the clock, so it's fine off the
+        reactor, like openConfig() on a thread, as long as nobody else has
+        the store yet.
+        """
+        records = []
+        for key, value in items:
+            valueBytes = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            self.data[key] = valueBytes
+            records.append(_encodeRecord(key, valueBytes))
+        records = "".join(records)
+        self.journalBytes += len(records)
+        self._write(records)
+
+    def close(self):
+        """
+        Write what's left and close the journal, after anything that's
+        already on its way. The Deferred fires once it's closed.
+        """
+        self.flush()
+        self.closed = True
+        return self.disk.call(self._closeJournal)
+
+    def _write(self, records):
+        """
+        On the disk queue. Returns how long the write and fsync took.
+        """
+        start = time.time()
+        self.journal.write(records)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        return time.time() - start
+
+    def _written(self, seconds, recordBytes):
+        STATS.record("config sync", seconds)
+        self.journalBytes += recordBytes
+        self._maybeCompact()
+
+    def _closeJournal(self):
+        self.journal.close()
+        self.journal = None
+
+    def _append(self, record):
+        self.unwritten.append(record)
+        if self.compacting is not None:
+            self.compacting.append(record)
+        self.sync()
+
+    def _recover(self):
+        """
+        Replay the journal into self.data and cut off anything after the last
+        good record. Returns the length of the good part.
+        """
+        if os.path.exists(self.compactPath):
+            os.remove(self.compactPath) # Didn't get swapped in, so it's not needed
+        try:
+            journal = open(self.path, "rb")
+        except IOError:
+            return 0
+        goodBytes = 0
+        with journal:
+            while True:
+                header = journal.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, crc = RECORD_HEADER.unpack(header)
+                payload = journal.read(length)
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    break
+                try:
+                    key, valueBytes = pickle.loads(payload)
+                except Exception:
+                    break
+                if valueBytes is None:
+                    self.data.pop(key, None)
+                else:
+                    self.data[key] = valueBytes
+                goodBytes += RECORD_HEADER.size + length
+        if goodBytes < os.path.getsize(self.path):
+            print "Dropping the unfinished end of", self.path
+            with open(self.path, "r+b") as journal:
+                journal.truncate(goodBytes)
+        return goodBytes
+
+    def _maybeCompact(self):
+        if self.compacting is not None or self.swapping or self.journalBytes < COMPACT_MIN_BYTES:
+            return
+        snapshot = [_encodeRecord(key, valueBytes) for key, valueBytes in self.data.items()]
+        if self.journalBytes < COMPACT_RATIO * sum(len(record) for record in snapshot):
+            return
+        self.compacting = []
+        d = self.disk.call(_writeFile, self.compactPath, snapshot)
+        d.addCallbacks(self._finishCompaction, self._compactionFailed)
+
+    def _finishCompaction(self, compactBytes):
+        """
+        Back on the reactor. Anything assigned while the snapshot was being
+        written goes on the end of the new file before it replaces the old
+        one. That happens on the disk queue too, after the writes ahead of
+        it.
+        """
+        if self.closed:
+            return # _recover will clean up
+        self.flush()
+        records = "".join(self.compacting)
+        self.compacting = None
+        self.swapping = True # Until then journalBytes is still the old file's
+        d = self.disk.call(self._swapIn, records)
+        d.addCallbacks(self._swappedIn, self._compactionFailed, callbackArgs = (compactBytes + len(records),))
+
+    def _swapIn(self, records):
+        """
+        On the disk queue.
+        """
+        with open(self.compactPath, "ab") as compacted:
+            compacted.write(records)
+            compacted.flush()
+            os.fsync(compacted.fileno())
+        self.journal.close()
+        os.rename(self.compactPath, self.path)
+        _syncDirectory(self.path)
+        self.journal = open(self.path, "ab")
+
+    def _swappedIn(self, ignored, journalBytes):
+        self.journalBytes = journalBytes
+        self.swapping = False
+
+    def _compactionFailed(self, failure):
+        print "Couldn't compact", self.path, failure.getErrorMessage()
+        self.compacting = None
+        self.swapping = False
+
+def _encodeRecord(key, valueBytes):
+    payload = pickle.dumps((key, valueBytes), pickle.HIGHEST_PROTOCOL)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+def _writeFile(path, records):
+    """
+    Runs on a thread. Returns how many bytes it wrote.
+    """
+    data = "".join(records)
+    with open(path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(data)
+
+def _syncDirectory(path):
+    """
+    fsync the directory so the rename itself survives a power failure.
+    """
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
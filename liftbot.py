@@ -1,9 +1,10 @@
 from twisted.words.xish import domish
 from twisted.internet import reactor
-from twisted.internet.task import LoopingCall
 from wokkel.xmppim import MessageProtocol, AvailablePresence
 
 from rainbot import RainBotProtocol
+from commands import CommandRegistry, UsageError
+from doorevents import parseMinutes
 import u3
 
 BIG_DOOR_BUTTON    = u3.FIO4
@@ -11,7 +12,22 @@ BIG_DOOR_SENSOR    = u3.FIO7
 LITTLE_DOOR_BUTTON = u3.FIO5
 LITTLE_DOOR_SENSOR = u3.FIO6
 
-SAMPLE_PERIOD = 3
+# Every line the doors use, for checking nothing else on LIFTBOT_BOARD does.
+DOOR_LINES = { BIG_DOOR_BUTTON    : "the big door button",
+               BIG_DOOR_SENSOR    : "the big door sensor",
+               LITTLE_DOOR_BUTTON : "the little door button",
+               LITTLE_DOOR_SENSOR : "the little door sensor" }
+
+# The doors get read every FAST_SAMPLE_PERIOD right after a button push or
+# a change, then BACKOFF times less often each time nothing changes, down to
+# every SLOW_SAMPLE_PERIOD. In between, the reads ride along with anything
+# else that goes to the U3.
+FAST_SAMPLE_PERIOD = 0.5
+SLOW_SAMPLE_PERIOD = 30
+BACKOFF = 2
+
+# How many reads in a row have to agree before a door counts as moved.
+DEBOUNCE_READS = 3
 
 PUSH_TIME = 3 # Seconds to hold the button down for
 
@@ -80,89 +96,187 @@ class DoorState(object):
     def __eq__(self, b):
         return self.bigDoorUp == b.bigDoorUp and self.littleDoorUp == b.littleDoorUp
 
-def getDoorState(d):
+    def __ne__(self, b):
+        return not self == b
+
+def getDoorState(d, piggyback = False):
     """Read the state of BIG_DOOR_SENSOR and LITTLE_DOOR_SENSOR
+
+    Returns a Deferred that fires with a DoorState, or None if the read failed.
+    With piggyback, the read waits to go out with somebody else's batch.
     """
     commandList = [u3.BitStateRead(BIG_DOOR_SENSOR), 
                    u3.BitStateRead(LITTLE_DOOR_SENSOR)]
-    try:
-        bigDoorUp, littleDoorUp = d.getFeedback(commandList)
-    except:
+    def gotState(results):
+        bigDoorUp, littleDoorUp = results
+        return DoorState(bigDoorUp, littleDoorUp)
+    def readFailed(failure):
         print "LiftBot got exception while reading door state. Returning None."
         return None
-    else:
-        return DoorState(bigDoorUp, littleDoorUp)
+    if piggyback:
+        return d.piggyback(commandList).addCallbacks(gotState, readFailed)
+    return d.getFeedback(commandList).addCallbacks(gotState, readFailed)
+
+LIFTBOT_COMMANDS = CommandRegistry()
+LIFTBOT_COMMANDS.register("big", "handleBig", aliases = ["b", "1"], description = "Press big button")
+LIFTBOT_COMMANDS.register("little", "handleLittle", aliases = ["l", "2"], description = "Press little button")
+LIFTBOT_COMMANDS.register("subscribe", "handleSubscribe", usage = ["", "<minutes open before an alert>"],
+                          description = "Get a message every time a door moves")
+LIFTBOT_COMMANDS.register("unsubscribe", "handleUnsubscribe", description = "Stop the door messages")
+LIFTBOT_COMMANDS.register("quit", "handleQuit", aliases = ["q"], description = "Quit the application")
+LIFTBOT_COMMANDS.register("help", "handleHelp", aliases = ["h", "?"])
 
 class LiftBotProtocol(RainBotProtocol):
+    commands = LIFTBOT_COMMANDS
+    doorEvents = None   # DoorEvents, to tell subscribers when the doors move
+
     def connectionMade(self):
         print "LiftBot connected"
         initU3(self.d)
         powerOnOpener(self.d)
-        self.doorState = getDoorState(self.d)
-        if self.doorState:
-            self.setStatus(str(self.doorState))
-        self.updateLoop = LoopingCall(self.updateDoorState)               
-        self.updateLoop.start(SAMPLE_PERIOD, now=False)
+        self.doorState = None
+        self.candidateState = None  # What the doors might have changed to
+        self.candidateReads = 0
+        self.candidateSince = None  # When the first read said so
+        self.samplePeriod = FAST_SAMPLE_PERIOD
+        self.pollCall = None
+        self.rider = None
+        self.resumeCall = None
+        self.updateDoorState()
+        if self.startupTimer:
+            self.startupTimer.mark("liftbot connected")
 
     def connectionLost(self, reason):
         print "LiftBot disconnected"
+        self.stopPolling()
+        if self.doorEvents:
+            self.doorEvents.stop()
         print "LiftBot shutting down reactor. That's it for me you've been great."
         reactor.stop()
-    
+
+    def schedulePoll(self):
+        """
+        Read the doors in samplePeriod, or sooner if something else goes to
+        the U3 first.
+        """
+        self.stopPolling()
+        self.pollCall = self.clock.callLater(self.samplePeriod, self.updateDoorState)
+        self.rider = rider = getDoorState(self.d, piggyback = True)
+        def rode(newDoorState):
+            if self.rider is rider:
+                self.rider = None
+                if self.pollCall and self.pollCall.active():
+                    self.pollCall.cancel()
+                self.pollCall = None
+                self.gotDoorState(newDoorState)
+        rider.addCallback(rode)
+
+    def stopPolling(self):
+        if self.pollCall and self.pollCall.active():
+            self.pollCall.cancel()
+        self.pollCall = None
+        if self.rider:
+            self.d.unpiggyback(self.rider)
+        self.rider = None
+
     def updateDoorState(self):
-        newDoorState = getDoorState(self.d)
-        if newDoorState and self.doorState != newDoorState:
+        """
+        Nothing else went to the U3 in time, so read the doors on our own.
+        """
+        self.stopPolling()
+        return getDoorState(self.d).addCallback(self.gotDoorState)
+
+    def gotDoorState(self, newDoorState):
+        """
+        A door only counts as moved after DEBOUNCE_READS reads in a row
+        say so. Poll fast while that's being sorted out, and back off
+        while nothing's happening. Subscribers hear about it with the time
+        of the first of those reads.
+        """
+        if newDoorState is None:
+            pass
+        elif self.doorState is None:
             self.doorState = newDoorState
             self.setStatus(str(self.doorState))
+            if self.doorEvents:
+                self.doorEvents.doorsChanged(None, newDoorState, self.clock.seconds())
+        elif newDoorState == self.doorState:
+            self.candidateState = None
+            self.candidateReads = 0
+            self.samplePeriod = min(self.samplePeriod * BACKOFF, SLOW_SAMPLE_PERIOD)
+        else:
+            if self.candidateState is not None and newDoorState == self.candidateState:
+                self.candidateReads += 1
+            else:
+                self.candidateState = newDoorState
+                self.candidateReads = 1
+                self.candidateSince = self.clock.seconds()
+            self.samplePeriod = FAST_SAMPLE_PERIOD
+            if self.candidateReads >= DEBOUNCE_READS:
+                oldDoorState, self.doorState = self.doorState, newDoorState
+                self.candidateState = None
+                self.candidateReads = 0
+                self.setStatus(str(self.doorState))
+                if self.doorEvents:
+                    self.doorEvents.doorsChanged(oldDoorState, newDoorState, self.candidateSince)
+        if self.resumeCall is None: # Not in the middle of a button push
+            self.schedulePoll()
 
-    def onMessage(self, msg):
-        #print "Got a message", msg.toXml()
-        self.lastFrom = msg["from"] # Save this to send a reply.
-
-        if msg["type"] == 'chat' and hasattr(msg, "body") and msg.body != None:
-            msgTokens = str(msg.body).split()
-            msgCommand = msgTokens[0].lower()
-            if len(msgCommand) > 0:
-                if msgCommand in ["1", "big", "b"]:
-                    self.handleBig(msgTokens)
-                elif msgCommand in ["2", "little", "l"]:
-                    self.handleLittle(msgTokens)
-                elif msgCommand == "help" or msgCommand == "h" or msgCommand == "?":
-                    self.handleHelp(msgTokens)
-                elif msgCommand == "quit" or msgCommand == "q":
-                    self.handleQuit(msgTokens)
-                else:
-                    self.handleUnknownCommand(msgTokens)
-
-    def handleBig(self, msgTokens):
-        self.sendText("Pushing big button")
+    def handleBig(self, session, msgTokens):
+        session.sendText("Pushing big button")
         self.pushAButton(pressBigDoorButton, releaseBigDoorButton)
 
-    def handleLittle(self, msgTokens):
-        self.sendText("Pushing little button")
+    def handleLittle(self, session, msgTokens):
+        session.sendText("Pushing little button")
         self.pushAButton(pressLittleDoorButton, releaseLittleDoorButton)
 
+    def handleSubscribe(self, session, msgTokens):
+        """
+        subscribe       # A message every time a door opens or closes
+        subscribe 15    # Those, plus one when a door's been open 15 minutes
+        """
+        if self.doorEvents is None:
+            session.sendText("No door events here")
+            return
+        minutes = None
+        if len(msgTokens) > 2:
+            raise UsageError("Too many arguments")
+        if len(msgTokens) == 2:
+            minutes = parseMinutes(msgTokens[1])
+            if minutes is None:
+                raise UsageError("Not a number of minutes: " + msgTokens[1])
+        self.doorEvents.subscribe(session.jid, minutes)
+        session.sendText(self.doorEvents.describe(session.jid))
+
+    def handleUnsubscribe(self, session, msgTokens):
+        if self.doorEvents is None or not self.doorEvents.unsubscribe(session.jid):
+            session.sendText("Wasn't subscribed")
+            return
+        session.sendText("Unsubscribed from door events")
+
     def pushAButton(self, pressFunction, releaseFunction):
-        if self.updateLoop.running:
-            self.updateLoop.stop()
+        """
+        Stop reading the doors while the button's down, then read them fast
+        to catch the door moving.
+        """
+        self.stopPolling()
 #        reactor.callLater(0, powerOnOpener, self.d)
-        reactor.callLater(0, pressFunction, self.d)
-        reactor.callLater(PUSH_TIME, releaseFunction, self.d)
+        self.clock.callLater(0, pressFunction, self.d)
+        self.clock.callLater(PUSH_TIME, releaseFunction, self.d)
 #        reactor.callLater(PUSH_TIME + 2, powerOffOpener, self.d)
-        if not self.updateLoop.running:
-            reactor.callLater(PUSH_TIME + 3, self.updateLoop.start, SAMPLE_PERIOD)
+        if self.resumeCall and self.resumeCall.active():
+            self.resumeCall.cancel()
+        self.resumeCall = self.clock.callLater(PUSH_TIME + 3, self.resumePolling)
 
-    def handleHelp(self, msgTokens):
-        responseText = "Commands:\n"
-        responseText += "big (alias 'b' or '1'): Press big button\n"
-        responseText += "little (alias 'l' or '2'): Press little button\n"
-        responseText += "quit (alias 'q'): Quit the application\n"
-        self.sendText(responseText)
+    def resumePolling(self):
+        self.resumeCall = None
+        self.samplePeriod = FAST_SAMPLE_PERIOD
+        self.updateDoorState()
 
-    def handleQuit(self, msgTokens):
+    def handleQuit(self, session, msgTokens):
         """
         Exit. Hopefully you've got monit or something to start you back up.
         """
         responseText = "Quitting"
-        self.sendText(responseText)
+        session.sendText(responseText)
         reactor.callLater(1, reactor.stop)
@@ -1,29 +1,264 @@
+import math
+import os
+from array import array
+from collections import deque
+
+from twisted.internet import reactor, defer
 from twisted.internet.task import LoopingCall
+from twisted.python import failure
 import rrdtool
 
+from diskpool import DiskQueue
+from stats import STATS
+
 SAMPLE_PERIOD = 300         # Every 5 minutes
 RRD_NAME = "moisture.rrd"
 
+# Every sensor is a data source in the RRD. The one for every zone keeps the
+# name it had back when it was the only one, so an old RRD still fits.
+MAIN_DS_NAME = "moisture"
+ZONE_DS_NAME = "zone%d"
+
+# Readings are held in memory and written to the RRD in one update once
+# there are this many of them or the oldest is this old, whichever is first.
+RRD_FLUSH_SAMPLES = 6
+RRD_FLUSH_AGE = 1800        # Half an hour
+
+# The RRAs in the RRD, as (window, samples per row, rows). The same windows
+# are kept in memory so "moisture 1d" doesn't have to go to rrdtool.
+RRAS = [ ("1h", 1,   12),       # Hourly (all 12 readings)
+         ("1d", 12,  24),       # Daily
+         ("1w", 12,  168),      # Weekly
+         ("1m", 72,  120),      # Monthly (6-hour summaries)
+         ("1y", 288, 365) ]     # Yearly
+
+# Like the RRD, a row needs at least this fraction of its samples to count.
+XFF = 0.5
+
+# How fast MoistureTrend forgets old readings, and which in-memory window it
+# starts from after a restart.
+TREND_HALF_LIFE = 3 * 60 * 60
+TREND_SEED_WINDOW = "1d"
+
+# Where graph() renders each window to, like moisture-1d.png, and how big.
+GRAPH_NAME = "moisture-%s.png"
+GRAPH_WIDTH = 600
+GRAPH_HEIGHT = 200
+GRAPH_COLORS = ["0000FF", "00A000", "FF0000", "FF8000", "A000A0", "00A0A0", "808000", "000000"]
+
+class MoistureAggregate(object):
+    """
+    An in-memory copy of one RRA. Rows are consolidated from the samples as
+    they come in, on the same boundaries rrdtool uses, and kept in a ring.
+    The mean, min, and max over the ring are kept up to date as rows come
+    and go, so asking for them costs nothing.
+    """
+    def __init__(self, samplesPerRow, rows):
+        self.samplesPerRow = samplesPerRow
+        self.rows = rows
+        self.rowSeconds = samplesPerRow * SAMPLE_PERIOD
+        self.reset()
+
+    def reset(self):
+        rows = self.rows
+        self.values = array("d", [0.0] * rows)
+        self.known = array("b", [0] * rows)
+        self.next = 0           # Ring slot for the next row
+        self.rowNumber = 0      # Rows added so far
+        self.knownRows = 0
+        self.total = 0.0
+        self.minRows = deque()  # (rowNumber, value), increasing values
+        self.maxRows = deque()  # (rowNumber, value), decreasing values
+        self.bucket = None      # Which row the pending samples belong to
+        self.pendingTotal = 0.0
+        self.pendingCount = 0
+
+    def addSample(self, timestamp, reading):
+        bucket = timestamp // self.rowSeconds
+        if self.bucket is not None and bucket != self.bucket:
+            self.closeRow()
+            # Rows with no samples at all are unknown, like in the RRD.
+            for i in xrange(min(bucket - self.bucket - 1, self.rows)):
+                self.addRow(None)
+        self.bucket = bucket
+        self.pendingTotal += reading
+        self.pendingCount += 1
+
+    def closeRow(self):
+        if self.pendingCount >= XFF * self.samplesPerRow:
+            self.addRow(self.pendingTotal / self.pendingCount)
+        else:
+            self.addRow(None)
+        self.pendingTotal = 0.0
+        self.pendingCount = 0
+
+    def addRow(self, value):
+        """
+        Push a consolidated row (None if unknown), dropping the oldest if
+        the ring is full.
+        """
+        if self.rowNumber >= self.rows and self.known[self.next]:
+            self.knownRows -= 1
+            self.total -= self.values[self.next]
+        oldest = self.rowNumber - self.rows + 1
+        while self.minRows and self.minRows[0][0] < oldest:
+            self.minRows.popleft()
+        while self.maxRows and self.maxRows[0][0] < oldest:
+            self.maxRows.popleft()
+
+        if value is None:
+            self.known[self.next] = 0
+        else:
+            self.known[self.next] = 1
+            self.values[self.next] = value
+            self.knownRows += 1
+            self.total += value
+            while self.minRows and self.minRows[-1][1] >= value:
+                self.minRows.pop()
+            self.minRows.append((self.rowNumber, value))
+            while self.maxRows and self.maxRows[-1][1] <= value:
+                self.maxRows.pop()
+            self.maxRows.append((self.rowNumber, value))
+        self.next = (self.next + 1) % self.rows
+        self.rowNumber += 1
+
+    def load(self, rows):
+        """
+        Start over from rows of (value or None) fetched from the RRD, oldest
+        first. The next sample starts a new row.
+        """
+        self.reset()
+        for value in rows[-self.rows:]:
+            self.addRow(value)
+
+    def mean(self):
+        if self.knownRows:
+            return self.total / self.knownRows
+        return None
+
+    def min(self):
+        if self.minRows:
+            return self.minRows[0][1]
+        return None
+
+    def max(self):
+        if self.maxRows:
+            return self.maxRows[0][1]
+        return None
+
+class MoistureTrend(object):
+    """
+    Exponentially weighted moving averages of the readings and of how fast
+    they're changing (volts per second), updated as each reading comes in.
+    Readings don't have to be evenly spaced; a long gap counts for more.
+    """
+    def __init__(self, halfLife = TREND_HALF_LIFE):
+        self.timeConstant = halfLife / math.log(2)
+        self.level = None
+        self.slope = 0.0
+        self.lastTimestamp = None
+
+    def addSample(self, timestamp, reading):
+        if self.level is None:
+            self.level = reading
+            self.lastTimestamp = timestamp
+            return
+        elapsed = timestamp - self.lastTimestamp
+        if elapsed <= 0:
+            return
+        alpha = 1 - math.exp(-elapsed / self.timeConstant)
+        level = self.level + alpha * (reading - self.level)
+        self.slope += alpha * ((level - self.level) / elapsed - self.slope)
+        self.level = level
+        self.lastTimestamp = timestamp
+
+    def projected(self, timestamp):
+        """
+        Where the level is headed by timestamp if it keeps going this way.
+        None if there haven't been any readings.
+        """
+        if self.level is None:
+            return None
+        return self.level + self.slope * (timestamp - self.lastTimestamp)
+
 class MoistureSampler(object):
     """
     An instance of this class samples, records, and reports moisture readings.
+
+    sensors is {zone or None : AIN channel}, like MOISTURE_SENSORS, where
+    None is the sensor for every zone without its own. They're all read in
+    one batch every SAMPLE_PERIOD and go in one RRD, a data source apiece,
+    with one update for all of them. Each sensor gets its own aggregates
+    and trend. trend is None's, and zoneTrends has the rest, for a
+    WateringAdjuster.
+
+    rrdtool only ever runs on disk, a DiskQueue unless you pass something
+    else with a call(), one call at a time so updates go in in order and a
+    fetch sees every update before it. What's still buffered gets written
+    when reactor shuts down.
     """
-    def __init__(self, device, sensorRegister):
+    def __init__(self, device, sensors, clock = reactor, disk = None, reactor = reactor):
         self.device = device
-        self.sensorRegister = sensorRegister
+        self.zones = sorted(sensors, key = lambda zone: (zone is not None, zone)) # None first
+        self.channels = [sensors[zone] for zone in self.zones]
+        self.clock = clock
+        self.disk = disk or DiskQueue()
+        self.fetched = {}           # startTime : (RRD step it was fetched in, result)
+        self.fetching = {}          # startTime : (step, [Deferreds waiting for it])
+        self.unwritten = []         # "timestamp:reading:reading..." strings
+        self.lastTimestamp = 0
+        self.lastReadings = {}      # zone : volts
+        self.flushCall = None
+        self.aggregates = dict((zone, dict((window, MoistureAggregate(samplesPerRow, rows))
+                                           for window, samplesPerRow, rows in RRAS))
+                               for zone in self.zones)
+        self.trend = MoistureTrend()    # Never gets a reading if there's no sensor for every zone
+        self.zoneTrends = dict((zone, MoistureTrend()) for zone in self.zones if zone is not None)
+        self.graphs = {}            # window : (row it was rendered at, PNG)
+        self.rendering = {}         # window : (row, [Deferreds waiting for it])
+        self.reactor = reactor
+        self.reactor.addSystemEventTrigger("before", "shutdown", self.flush)
         self.sampleLoop = LoopingCall(self.sampleAndLog)               
-        self.sampleLoop.start(SAMPLE_PERIOD, now=False)
+        self.sampleLoop.clock = self.clock
+
+    def start(self):
+        """
+        Check the RRD, then start sampling. Startup does these separately, so
+        the RRD can be checked on a thread while everything else gets going.
+        """
         self.checkRRD()
+        self.startSampling()
+
+    def startSampling(self):
+        self.device.configAnalog(*self.channels)
+        self.sampleLoop.start(SAMPLE_PERIOD, now=False)
     
     def checkRRD(self):
         """
-        Checks for RRD_NAME, creating it if necessary.
+        Checks for RRD_NAME, creating it if necessary. If it's there but has
+        different sensors in it, it gets moved out of the way and a new one
+        made. Safe to run on a thread as long as sampling hasn't started.
         """
-        import os
         try:
             os.stat(RRD_NAME)
         except OSError:
             self.createRRD()
+            return
+        sources = self.sourcesInRRD()
+        if sources != set(dsName(zone) for zone in self.zones):
+            oldName = "%s.%d" % (RRD_NAME, self.clock.seconds())
+            print "The moisture sensors changed. Moving", RRD_NAME, "with", ", ".join(sorted(sources)), "to", oldName
+            os.rename(RRD_NAME, oldName)
+            self.createRRD()
+        else:
+            self.loadAggregates()
+
+    def sourcesInRRD(self):
+        """
+        The names of the data sources RRD_NAME has now.
+        """
+        return set(key[len("ds["):key.index("]")] for key in rrdtool.info(RRD_NAME)
+                   if key.startswith("ds["))
     
     def createRRD(self):
         """
@@ -34,25 +269,219 @@ class MoistureSampler(object):
             Monthly (6-hour summaries)
             Yearly
             
-        Note: Sensor range is 0-1.8 V
+        and a data source for each sensor. Note: Sensor range is 0-1.8 V
         """
         print "Creating database", RRD_NAME
         rrdtool.create(RRD_NAME,
                        "--step", str(SAMPLE_PERIOD),
-                       "DS:moisture:GAUGE:%s:0:1.8" % (str(2*SAMPLE_PERIOD),), # Sensor range is 0-1.8 V
-                       "RRA:AVERAGE:0.5:1:12",                                 # Hourly (all 12 readings)
-                       "RRA:AVERAGE:0.5:12:24",                                # Daily
-                       "RRA:AVERAGE:0.5:12:168",                               # Weekly
-                       "RRA:AVERAGE:0.5:72:120",                               # Monthly (6-hour summaries)
-                       "RRA:AVERAGE:0.5:288:365")                              # Yearly
+                       *(["DS:%s:GAUGE:%s:0:1.8" % (dsName(zone), str(2*SAMPLE_PERIOD)) # Sensor range is 0-1.8 V
+                          for zone in self.zones] +
+                         ["RRA:AVERAGE:%s:%d:%d" % (XFF, samplesPerRow, rows)
+                          for window, samplesPerRow, rows in RRAS]))
+
+    def loadAggregates(self):
+        """
+        Fill the in-memory aggregates from what's already in the RRD.
+        """
+        for window, aggregate in self.aggregates[self.zones[0]].items():
+            seconds = aggregate.rowSeconds * aggregate.rows
+            try:
+                (start, end, step), names, rows = rrdtool.fetch(RRD_NAME, "AVERAGE",
+                                                                "--resolution", str(aggregate.rowSeconds),
+                                                                "--start", "-%d" % seconds)
+            except rrdtool.error, e:
+                print "Couldn't load the", window, "moisture history.", e
+                continue
+            if step != aggregate.rowSeconds:
+                continue # rrdtool picked a different RRA. Start this one empty.
+            for zone in self.zones:
+                column = list(names).index(dsName(zone))
+                self.aggregates[zone][window].load([row[column] for row in rows])
+                if window == TREND_SEED_WINDOW:
+                    for i, row in enumerate(rows):
+                        if row[column] is not None:
+                            self.trendFor(zone).addSample(start + (i + 1) * step, row[column])
+
+    def trendFor(self, zone):
+        return self.zoneTrends.get(zone, self.trend)
 
     def sampleAndLog(self):
-        reading = self.device.readRegister(self.sensorRegister)
-        rrdtool.update(RRD_NAME,
-                       "N:" + str(reading))
+        return self.device.readAnalog(*self.channels).addCallback(self.logReadings)
 
-    def fetchAverage(self, startTime = None):
+    def logReadings(self, readings):
+        """
+        Buffer one reading from each sensor, in the order of self.zones, with
+        their timestamp. They get written to the RRD with the others in
+        flush().
+        """
+        timestamp = int(self.clock.seconds())
+        if timestamp <= self.lastTimestamp:
+            return # RRD only takes one reading per second, in order
+        self.lastTimestamp = timestamp
+        for zone, reading in zip(self.zones, readings):
+            self.lastReadings[zone] = reading
+            for aggregate in self.aggregates[zone].itervalues():
+                aggregate.addSample(timestamp, reading)
+            self.trendFor(zone).addSample(timestamp, reading)
+        self.fetched = {} # They don't have this one
+        self.unwritten.append("%d:%s" % (timestamp, ":".join(str(reading) for reading in readings)))
+        if len(self.unwritten) >= RRD_FLUSH_SAMPLES:
+            self.flush()
+        elif self.flushCall is None:
+            self.flushCall = self.clock.callLater(RRD_FLUSH_AGE, self.flush)
+
+    def flush(self):
+        """
+        Write every buffered reading with one rrdtool update. The Deferred
+        fires once it's in.
+        """
+        if self.flushCall is not None:
+            if self.flushCall.active():
+                self.flushCall.cancel()
+            self.flushCall = None
+        if not self.unwritten:
+            return defer.succeed(None)
+        unwritten, self.unwritten = self.unwritten, []
+        d = STATS.timed("rrdtool update", self.disk.call, rrdtool.update, RRD_NAME, *unwritten)
+        def failed(reason):
+            reason.trap(rrdtool.error)
+            print "Couldn't write", len(unwritten), "readings to", RRD_NAME, reason.getErrorMessage()
+        return d.addErrback(failed)
+
+    def fetchAverage(self, startTime = None, zone = False):
+        """
+        A Deferred that fires with what rrdtool fetch says from startTime,
+        for every sensor, or just zone's if you pass one (None is the one
+        for every zone).
+        The same startTime during the same RRD step gets the same answer
+        without going back to rrdtool, so a burst of "moisture -3d" is one
+        fetch.
+        """
+        d = self._fetch(startTime)
+        if zone is not False:
+            d.addCallback(_justSource, dsName(zone))
+        return d
+
+    def _fetch(self, startTime):
+        step = int(self.clock.seconds()) // SAMPLE_PERIOD
+        if startTime in self.fetched and self.fetched[startTime][0] == step:
+            return defer.succeed(self.fetched[startTime][1])
+        d = defer.Deferred()
+        if startTime in self.fetching and self.fetching[startTime][0] == step:
+            self.fetching[startTime][1].append(d)
+            return d
+        self.fetching[startTime] = (step, [d])
+        self.flush() # So the answer includes the latest readings
+        args = [RRD_NAME, "AVERAGE"]
         if startTime:
-            return rrdtool.fetch(RRD_NAME, "AVERAGE", "--start", startTime)
+            args += ["--start", startTime]
+        fetched = STATS.timed("rrdtool fetch", self.disk.call, rrdtool.fetch, *args)
+        fetched.addBoth(_deliver, startTime, step, self.fetched, self.fetching)
+        return d
+
+    def graph(self, window):
+        """
+        A Deferred that fires with a PNG of every sensor over the last window
+        ("1h", "1d", "1w", "1m", or "1y"). Raises KeyError for any other
+        window.
+
+        A graph only changes when its RRA gets a new row, so each one is
+        rendered once per row (every 5 minutes for 1h, once a day for 1y)
+        and handed out from memory until then. Rendering happens on a
+        thread, and everybody who asks while it's going gets the same one.
+        """
+        row = self.aggregates[self.zones[0]][window].rowNumber
+        if window in self.graphs and self.graphs[window][0] == row:
+            return defer.succeed(self.graphs[window][1])
+        d = defer.Deferred()
+        if window in self.rendering and self.rendering[window][0] == row:
+            self.rendering[window][1].append(d)
+            return d
+        self.rendering[window] = (row, [d])
+        self.flush() # So the RRD has everything the aggregate does
+        rendered = self.disk.call(self.renderGraph, window)
+        rendered.addBoth(_deliver, window, row, self.graphs, self.rendering)
+        return d
+
+    def renderGraph(self, window):
+        """
+        Run rrdtool graph for window and return the PNG. Safe on a thread.
+        """
+        path = GRAPH_NAME % window
+        aggregate = self.aggregates[self.zones[0]][window]
+        lines = []
+        for i, zone in enumerate(self.zones):
+            name = dsName(zone)
+            lines.append("DEF:%s=%s:%s:AVERAGE" % (name, RRD_NAME, name))
+            lines.append("LINE2:%s#%s:%s" % (name, GRAPH_COLORS[i % len(GRAPH_COLORS)], sensorName(zone)))
+        STATS.timed("rrdtool graph", rrdtool.graph, path,
+                    "--start", "-%d" % (aggregate.rowSeconds * aggregate.rows),
+                    "--title", "Moisture, last " + window,
+                    "--vertical-label", "V",
+                    "--lower-limit", "0", "--upper-limit", "1.8", "--rigid",
+                    "--width", str(GRAPH_WIDTH), "--height", str(GRAPH_HEIGHT),
+                    *lines)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def summary(self, window, zone = None):
+        """
+        A short readable summary of zone's sensor (None for the one for
+        every zone) over the last window ("1h", "1d", "1w", "1m", or "1y"; a
+        leading "-" is fine) straight from memory. Returns None if window
+        isn't one of those. Raises KeyError if there's no such sensor.
+        """
+        aggregate = self.aggregates[zone].get(window.lstrip("-"))
+        if aggregate is None:
+            return None
+        summaryText = "Last " + window.lstrip("-") + ": "
+        if zone is not None:
+            summaryText = "Zone %d, last %s: " % (zone, window.lstrip("-"))
+        if aggregate.mean() is None:
+            summaryText += "no readings yet."
         else:
-            return rrdtool.fetch(RRD_NAME, "AVERAGE")
+            summaryText += "mean %.3f V, min %.3f V, max %.3f V (%d rows)." % (aggregate.mean(),
+                                                                              aggregate.min(),
+                                                                              aggregate.max(),
+                                                                              aggregate.knownRows)
+        if zone in self.lastReadings:
+            summaryText += " Now %.3f V." % self.lastReadings[zone]
+        return summaryText
+
+def dsName(zone):
+    """
+    What zone's sensor (None for the one for every zone) is called in the
+    RRD.
+    """
+    if zone is None:
+        return MAIN_DS_NAME
+    return ZONE_DS_NAME % zone
+
+def sensorName(zone):
+    if zone is None:
+        return "All zones"
+    return "Zone %d" % zone
+
+def _justSource(result, name):
+    """
+    An rrdtool fetch result with only the data source called name in it.
+    """
+    (start, end, step), names, rows = result
+    column = list(names).index(name)
+    return (start, end, step), (name,), [(row[column],) for row in rows]
+
+def _deliver(result, key, version, done, waiting):
+    """
+    Give result to everybody in waiting[key] who asked for this version of
+    it, and keep it in done for the next one to ask (unless it failed).
+    """
+    waiters = []
+    if key in waiting and waiting[key][0] == version:
+        waiters = waiting.pop(key)[1]
+    if not isinstance(result, failure.Failure):
+        done[key] = (version, result)
+    for d in waiters:
+        d.callback(result)
+    if isinstance(result, failure.Failure):
+        return None # Everybody waiting got it
+    return result
@@ -0,0 +1,68 @@
+from twisted.internet import reactor
+
+# Messages to the same person this close together go out as one.
+COALESCE_WINDOW = 0.3
+
+# Never send more than STANZA_BURST stanzas at once, or more than
+# STANZA_RATE a second after that.
+STANZA_RATE = 2.0
+STANZA_BURST = 5
+
+class OutboundQueue(object):
+    """
+    Everything a bot sends goes through here so it doesn't trip the
+    server's throttling or waste the cellular link.
+
+    Messages wait COALESCE_WINDOW before going out. Back-to-back messages to
+    the same person in that time get joined into one stanza with newlines.
+    Only the latest presence is ever sent; a newer status replaces one that
+    hasn't gone out yet. A token bucket keeps the whole connection under
+    STANZA_RATE.
+
+    sendMessage(recipient, text) and sendPresence(statusText, show) do the
+    actual sending.
+    """
+    def __init__(self, sendMessage, sendPresence, clock = reactor):
+        self.sendMessage = sendMessage
+        self.sendPresence = sendPresence
+        self.clock = clock
+        self.messages = []          # [recipient, [text, ...]], oldest first
+        self.presence = None        # (statusText, show)
+        self.tokens = STANZA_BURST
+        self.lastRefill = clock.seconds()
+        self.flushCall = None
+
+    def sendText(self, recipient, text):
+        if self.messages and self.messages[-1][0] == recipient:
+            self.messages[-1][1].append(text)
+        else:
+            self.messages.append([recipient, [text]])
+        self._schedule(COALESCE_WINDOW)
+
+    def setStatus(self, statusText, show = None):
+        self.presence = (statusText, show)
+        self._schedule(COALESCE_WINDOW)
+
+    def flush(self):
+        """
+        Send as much as the rate limit allows, and come back for the rest.
+        """
+        self.flushCall = None
+        now = self.clock.seconds()
+        self.tokens = min(STANZA_BURST, self.tokens + (now - self.lastRefill) * STANZA_RATE)
+        self.lastRefill = now
+        while self.tokens >= 1 and (self.messages or self.presence):
+            self.tokens -= 1
+            if self.messages:
+                recipient, texts = self.messages.pop(0)
+                self.sendMessage(recipient, "\n".join(texts))
+            else:
+                statusText, show = self.presence
+                self.presence = None
+                self.sendPresence(statusText, show)
+        if self.messages or self.presence:
+            self._schedule((1 - self.tokens) / STANZA_RATE)
+
+    def _schedule(self, delay):
+        if self.flushCall is None:
+            self.flushCall = self.clock.callLater(delay, self.flush)
@@ -0,0 +1,36 @@
+def planProgram(runTimesMinutes, zoneFlows, supplyCapacity):
+    """
+    Pack the zones into groups that can run at the same time without asking
+    for more water than the supply has, so the whole program takes as little
+    time as possible. Zones with no run time are left out.
+
+    runTimesMinutes and zoneFlows are keyed by zone. Flows and supplyCapacity
+    can be in any unit as long as it's the same one. A zone that needs more
+    than the supply on its own still runs, just by itself.
+
+    Returns a list of groups, each a list of zones, in the order to run them.
+
+    This is first-fit decreasing on run time: the longest zones go first, and
+    each zone joins the first group that has room for it. A group takes as
+    long as its first (longest) zone, so filling it with shorter zones is free.
+    """
+    zones = [zone for zone in runTimesMinutes if runTimesMinutes[zone] > 0]
+    zones.sort(key = lambda zone: (-runTimesMinutes[zone], zone))
+
+    groups = []         # [zones, flow]
+    for zone in zones:
+        flow = zoneFlows.get(zone, supplyCapacity)
+        for group in groups:
+            if group[1] + flow <= supplyCapacity + 1e-9: # Float slop
+                group[0].append(zone)
+                group[1] += flow
+                break
+        else:
+            groups.append([[zone], flow])
+    return [sorted(groupZones) for groupZones, flow in groups]
+
+def groupMinutes(group, runTimesMinutes):
+    """
+    How long a group from planProgram takes to run.
+    """
+    return max(runTimesMinutes[zone] for zone in group)
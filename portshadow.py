@@ -0,0 +1,132 @@
+import u3
+
+# Feedback IOTypes the shadow cares about.
+BIT_STATE_WRITE    = 11
+BIT_DIR_WRITE      = 13
+PORT_STATE_READ    = 26
+PORT_STATE_WRITE   = 27
+PORT_DIR_READ      = 28
+PORT_DIR_WRITE     = 29
+
+# FIO0-7, EIO0-7 and CIO0-3, numbered 0-19 like LabJackPython does. The
+# port commands have room for 8 CIO lines but the U3 only has 4, so writes
+# to the rest go nowhere and they always read back 0.
+MAX_IONUM = 19
+ALL_LINES = (1 << (MAX_IONUM + 1)) - 1
+
+# What FeedbackBatcher sends now and then to catch the shadow up with the
+# U3, in case something changed it behind our back (like a brownout).
+RESYNC_COMMAND = [u3.PortDirRead(), u3.PortStateRead()]
+
+class PortShadow(object):
+    """
+    What a U3's direction and state registers should hold, going by every
+    write that went to it, as bit masks over IO numbers 0-19. Lines it
+    isn't sure of are left out of the known masks, and the lines past CIO3
+    that don't exist never get in them.
+
+    reduce() turns a write into the smallest one that does the same thing,
+    or nothing at all if every line it touches is already that way. So an
+    ALL_OFF_COMMAND when everything's already off never goes over USB.
+    """
+    def __init__(self):
+        self.directions = 0
+        self.states = 0
+        self.knownDirections = 0
+        self.knownStates = 0
+
+    def reduce(self, command):
+        """
+        Returns command, a smaller write that does what it would, or None if
+        it wouldn't change anything. Anything but a direction or state write
+        comes back as is. The shadow is updated as if it went out.
+        """
+        cmdBytes = list(commandBytes(command))
+        ioType = cmdBytes[0]
+        if ioType in (BIT_STATE_WRITE, BIT_DIR_WRITE):
+            mask = 1 << (cmdBytes[1] & 0x1f)
+            values = mask if cmdBytes[1] >> 7 else 0
+        elif ioType in (PORT_STATE_WRITE, PORT_DIR_WRITE):
+            mask = _bits(cmdBytes[1:4])
+            values = _bits(cmdBytes[4:7]) & mask
+        else:
+            return command
+        if not mask & ALL_LINES:
+            return command # Not a line the shadow keeps
+        mask &= ALL_LINES
+        values &= ALL_LINES
+
+        isDirection = ioType in (BIT_DIR_WRITE, PORT_DIR_WRITE)
+        if isDirection:
+            current, known = self.directions, self.knownDirections
+        else:
+            current, known = self.states, self.knownStates
+        changed = mask & (~known | (current ^ values))
+        current = (current & ~mask) | values
+        if isDirection:
+            self.directions, self.knownDirections = current, known | mask
+        else:
+            self.states, self.knownStates = current, known | mask
+
+        if not changed:
+            return None
+        if changed & (changed - 1) == 0: # Just one line
+            ioNumber = changed.bit_length() - 1
+            if isDirection:
+                return u3.BitDirWrite(ioNumber, int(bool(values & changed)))
+            return u3.BitStateWrite(ioNumber, int(bool(values & changed)))
+        if isDirection:
+            return u3.PortDirWrite(Direction = _bytes(values), WriteMask = _bytes(changed))
+        return u3.PortStateWrite(State = _bytes(values), WriteMask = _bytes(changed))
+
+    def snapshot(self):
+        return (self.directions, self.states, self.knownDirections, self.knownStates)
+
+    def check(self, snapshot, command, result):
+        """
+        command was a PortDirRead or PortStateRead that went out when the
+        shadow was snapshot, and result is what it read. Any line that
+        doesn't match isn't known anymore, so the next write to it goes
+        out. Returns how many didn't match.
+        """
+        directions, states, knownDirections, knownStates = snapshot
+        read = result["FIO"] | result["EIO"] << 8 | result["CIO"] << 16
+        ioType = list(commandBytes(command))[0]
+        if ioType == PORT_DIR_READ:
+            wrong = knownDirections & (directions ^ read)
+            self.knownDirections &= ~wrong
+        elif ioType == PORT_STATE_READ:
+            # Input lines read what's on them, not the state register.
+            outputs = knownDirections & directions
+            wrong = outputs & knownStates & (states ^ read)
+            self.knownStates &= ~wrong
+        else:
+            return 0
+        return bin(wrong).count("1")
+
+    def forget(self, *ioNumbers):
+        """
+        Stop trusting what's known about ioNumbers, or every line if there
+        aren't any.
+        """
+        lines = ALL_LINES
+        if ioNumbers:
+            lines = sum(1 << ioNumber for ioNumber in set(ioNumbers))
+        self.knownDirections &= ~lines
+        self.knownStates &= ~lines
+
+def isPortRead(command):
+    return list(commandBytes(command))[0] in (PORT_DIR_READ, PORT_STATE_READ)
+
+def commandBytes(command):
+    # Older LabJackPython calls it cmd, newer calls it cmdBytes.
+    try:
+        return command.cmdBytes
+    except AttributeError:
+        return command.cmd
+
+def _bits(portBytes):
+    return portBytes[0] | portBytes[1] << 8 | portBytes[2] << 16
+
+def _bytes(bits):
+    return [bits & 0xff, (bits >> 8) & 0xff, (bits >> 16) & 0xff]
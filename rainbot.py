@@ -1,54 +1,103 @@
+from collections import deque
 from datetime import datetime, timedelta
 from twisted.words.xish import domish
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
+from twisted.internet.task import LoopingCall
 from wokkel.xmppim import MessageProtocol, AvailablePresence
 
 import shelve
-SHELVE_NAME = "rainbot-shelve"
+SHELVE_NAME = "rainbot-shelve"   # Where the config used to live
+
+from journal import JournalStore
+from planner import planProgram
+import timeline
+JOURNAL_NAME = "rainbot-journal"
 
 import u3
 
+from commands import CommandRegistry, UsageError
+from settings import Settings
+import history
+from outbound import OutboundQueue
+from session import Session
+from stats import STATS
+
 # strftime format
 TIME_FORMAT = "%a, %m/%d/%Y %l:%M %p"
+ZONE_TIME_FORMAT = "%l:%M %p"
+HISTORY_TIME_FORMAT = "%a %m/%d %l:%M %p"
+
+# "history" only sends the newest this many events.
+HISTORY_LINES = 40
+
+# Where webstatus (/status, /control, and /graph) listens, for the strport in
+# rainbot.tac. Anybody who can reach it can turn the water on, so it only
+# listens on localhost. Put a proxy with a login in front of it to get at it
+# from anywhere else.
+HTTP_INTERFACE = "127.0.0.1"
+HTTP_PORT_NUMBER = 8080
+HTTP_PORT = "tcp:%d:interface=%s" % (HTTP_PORT_NUMBER, HTTP_INTERFACE)
+
+# The link "graph" sends. It's on the same port, so it only works from this
+# machine, and the reply says so. With a proxy, point it at the proxy and
+# turn GRAPH_LOCAL_ONLY off.
+GRAPH_URL = "http://%s:%d/graph/%%s" % (HTTP_INTERFACE, HTTP_PORT_NUMBER)
+GRAPH_LOCAL_ONLY = True
+
+# While a program runs, note how far it's got this often, so after a crash
+# it picks up about where it was instead of running the zone that was on
+# all over again.
+TIMELINE_CHECKPOINT_SECONDS = 60
+
+# A program that should have finished more than this long ago when we
+# start back up is dropped, not picked up where it was.
+RESUME_GRACE_SECONDS = 60 * 60
+
+# How long shutdown waits for everything to turn off before going anyway,
+# in case a U3 is wedged.
+SHUTDOWN_TIMEOUT = 10
 
 # Set all the EIO and CIO to output high.
 # Remember setting these lines high turns the relays off.
 ALL_OFF_COMMAND = [u3.PortDirWrite(Direction = [0, 0xff, 0xff], WriteMask = [0, 0xff, 0xff]),
                    u3.PortStateWrite(State =   [0, 0xff, 0xff], WriteMask = [0, 0xff, 0xff]) ]
 
-# The keys are the sprinkler zones, the IO nums are the 
-# LabJackPython numbers for the U3.
+# The serial number of the U3 the RB12 is on. None is whichever U3
+# u3.U3() finds first, which is all you need with one board. With more than
+# one, give each its serial number here and use those in ZONE_TO_IONUM (and
+# for LIFTBOT_BOARD and MOISTURE_BOARD in rainbot.tac). None next to a
+# serial won't start, since the first one found could be that same board.
+MAIN_BOARD = None
+
+# The keys are the sprinkler zones, the values are (board, IO num), where
+# the IO nums are the LabJackPython numbers for the U3 on that board.
 # My RB12 is upside-down, so CIO3 is at the top and 
 # EIO0 is at the bottom.
-ZONE_TO_IONUM =  { 1  : 19,     # CIO3
-                   2  : 18,
-                   3  : 17,
-                   4  : 16,
-                   5  : 15,
-                   6  : 14,
-                   7  : 13,
-                   8  : 12,
-                   9  : 11,
-                   10 : 10,
-                   11 : 9,
-                   12 : 8  }    # EIO0
-
-# We're going to change these all over the place anyway.
-DEFAULT_RUN_TIMES_MINUTES = { 1  : 7,
-                              2  : 7,
-                              3  : 7,
-                              4  : 7,
-                              5  : 7,
-                              6  : 7,
-                              7  : 7,
-                              8  : 7,
-                              9  : 7,
-                              10 : 7,
-                              11 : 7,
-                              12 : 7 }
-
-# I have 12 zones. I know.
-ZONE_STRING_LIST = [ str(i) for i in range(1, 13) ]
+# Zones on a second board go on the end, like 13 : (320012345, 19), once
+# MAIN_BOARD has a serial number too.
+ZONE_TO_IONUM =  { 1  : (MAIN_BOARD, 19),     # CIO3
+                   2  : (MAIN_BOARD, 18),
+                   3  : (MAIN_BOARD, 17),
+                   4  : (MAIN_BOARD, 16),
+                   5  : (MAIN_BOARD, 15),
+                   6  : (MAIN_BOARD, 14),
+                   7  : (MAIN_BOARD, 13),
+                   8  : (MAIN_BOARD, 12),
+                   9  : (MAIN_BOARD, 11),
+                   10 : (MAIN_BOARD, 10),
+                   11 : (MAIN_BOARD, 9),
+                   12 : (MAIN_BOARD, 8)  }    # EIO0
+
+# We're going to change these all over the place anyway. Zones that show up
+# in ZONE_TO_IONUM later start out with DEFAULT_RUN_TIME_MINUTES too.
+DEFAULT_RUN_TIME_MINUTES = 7
+DEFAULT_RUN_TIMES_MINUTES = dict((zone, DEFAULT_RUN_TIME_MINUTES) for zone in ZONE_TO_IONUM)
+
+# I used to have 12 zones. Now it's however many are in ZONE_TO_IONUM.
+ZONE_STRING_LIST = [ str(zone) for zone in sorted(ZONE_TO_IONUM) ]
+
+# Everything from here to SUPPLY_CAPACITY can be changed in the settings
+# file without restarting; these are just what you get if it doesn't say.
 
 # You could configure these to your heart's content on the 
 # old controller. I'm fine with these.
@@ -58,92 +107,212 @@ INCREMENT_DAY = 2
 # How long to wait between zones
 ZONE_DELAY_SECONDS = 5
 
+# How much water each zone uses and how much the supply can give, in any
+# unit as long as it's the same one (I use gallons per minute). Zones that
+# fit under SUPPLY_CAPACITY together run at the same time. With these
+# defaults only one zone fits, so zones run one at a time like always.
+# Measure yours and raise SUPPLY_CAPACITY.
+ZONE_FLOWS = dict((zone, 1.0) for zone in ZONE_TO_IONUM)
+SUPPLY_CAPACITY = 1.0
+
+# Which AIN channel on the moisture board (MOISTURE_BOARD in rainbot.tac)
+# each moisture sensor is on. None is the one for every zone that doesn't
+# have its own. These can go in the settings file too, but they only take
+# effect after a restart, since every sensor has its own place in the RRD.
+# AIN n is FIO/EIO line n, so it can't be a zone's line on the same board,
+# or a door line if LiftBot's on it too. Startup refuses that.
+MOISTURE_SENSORS = { None : 0 }
+
+# Scale scheduled runs by soil moisture, or skip them when it's wet. Off
+# until you've seen what your sensors read wet and dry: set it to limits
+# like adjuster.DEFAULT_LIMITS, or "moistureAdjust" in the settings file.
+MOISTURE_ADJUST = None
+
+RAINBOT_COMMANDS = CommandRegistry()
+RAINBOT_COMMANDS.register("on", "handleOn")
+RAINBOT_COMMANDS.register("off", "handleOff")
+RAINBOT_COMMANDS.register("pause", "handlePause", aliases = ["p"], usage = ["<days (default 1)>"])
+RAINBOT_COMMANDS.register("run", "handleRun", aliases = ["r"])
+RAINBOT_COMMANDS.register("stop", "handleStop", aliases = ["s"])
+RAINBOT_COMMANDS.register("hold", "handleHold", description = "Hold the running program, zones off")
+RAINBOT_COMMANDS.register("resume", "handleResume", description = "Pick a held program back up")
+RAINBOT_COMMANDS.register("times", "handleTimes", aliases = ["t"],
+                          usage = ["",
+                                   "<new time for all zones>",
+                                   "*<scale for all zones>",
+                                   "+<pad for all zones>",
+                                   "<zone> <new time>"])
+RAINBOT_COMMANDS.register("last", "handleLast", aliases = ["l"])
+RAINBOT_COMMANDS.register("will", "handleWill", aliases = ["w"])
+RAINBOT_COMMANDS.register("moisture", "handleMoisture", aliases = ["m"],
+                          usage = ["<1h|1d|1w|1m|1y or start time>", "zone <zone> <1h|1d|1w|1m|1y or start time>"])
+RAINBOT_COMMANDS.register("graph", "handleGraph", aliases = ["g"], usage = ["<1h|1d|1w|1m|1y (default 1d)>"],
+                          description = "Draw the moisture graph")
+RAINBOT_COMMANDS.register("quit", "handleQuit", aliases = ["q"])
+RAINBOT_COMMANDS.register("history", "handleHistory", usage = ["<how far back, like 30d or week (default 1w)>"])
+RAINBOT_COMMANDS.register("usage", "handleUsage",
+                          usage = ["<how far back (default 1w)>", "zone <zone> <how far back>"],
+                          description = "How long zones have run")
+RAINBOT_COMMANDS.register("stats", "handleStats", description = "How long things have been taking")
+RAINBOT_COMMANDS.register("help", "handleHelp", aliases = ["h", "?"])
+
+def registerZoneCommand(commands, zoneStrings):
+    """
+    One command for all the zones. Called again when the zones change.
+    """
+    commands.unregister("handleZone")
+    # Zone numbers only match exactly, or "1" would be ambiguous with "10".
+    commands.register(zoneStrings[0], "handleZone", aliases = zoneStrings[1:],
+                      usage = ["<time to run>"], prefixes = False,
+                      title = zoneStrings[0] + ".." + zoneStrings[-1])
+
+registerZoneCommand(RAINBOT_COMMANDS, ZONE_STRING_LIST)
+
+def defaultSettings():
+    """
+    The Settings you get from the constants up top, and no credentials.
+    """
+    return Settings(START_HOUR, INCREMENT_DAY, ZONE_DELAY_SECONDS, ZONE_TO_IONUM, ZONE_FLOWS,
+                    SUPPLY_CAPACITY, {"rainbot" : ("", ""), "liftbot" : ("", "")}, MOISTURE_SENSORS,
+                    MOISTURE_ADJUST)
+
 class RainBotProtocol(MessageProtocol):
+    commands = RAINBOT_COMMANDS
+    clock = reactor     # Swap in a task.Clock to simulate
+    adjuster = None     # A WateringAdjuster, to water by soil moisture
+    config = None       # Already open config, or the Scheduler opens it
+    settings = None     # Settings, or defaultSettings()
+    history = None      # A HistoryLog, to keep track of every run
+    startupTimer = None # A StartupTimer to tell when we're connected
+    quitting = False
+    stopped = False     # Once shutDown() has turned everything off
+
+    def __init__(self, clock = None):
+        MessageProtocol.__init__(self)
+        if clock is not None:
+            self.clock = clock
+        self.outbound = OutboundQueue(self._sendMessage, self._sendPresence, self.clock)
+        self.sessions = {}  # Full JID : Session with commands still to run
+        self.statusListeners = []   # Called with nothing whenever the status changes
+
     def connectionMade(self):
         print "RainBot connected"
-        self.d.getFeedback(ALL_OFF_COMMAND)
-        self.scheduler = Scheduler(self, self.d)
+        self.devices.broadcast(ALL_OFF_COMMAND)
+        self.scheduler = Scheduler(self, self.devices, self.clock, self.config, self.adjuster,
+                                   self.settings, self.history)
+        if self.startupTimer:
+            self.startupTimer.mark("rainbot connected")
 
     def connectionLost(self, reason):
         print "RainBot disconnected"
-        self.d.getFeedback(ALL_OFF_COMMAND)
-        self.scheduler.shelveConfig.close()
+        self.shutDown()
         print "RainBot shutting down reactor. See you on the flip side."
         reactor.stop()
 
+    def shutDown(self):
+        """
+        Stop the program, turn every relay off, and close the config, once.
+        rainbot.tac calls this before the reactor shuts down, so it gets to
+        the U3s and the disk before their threads stop, and connectionLost
+        calls it in case the connection went first. The Deferred fires once
+        it's all gone out, or after SHUTDOWN_TIMEOUT.
+        """
+        if self.stopped:
+            return defer.succeed(None)
+        self.stopped = True
+        config = self.config
+        scheduler = getattr(self, "scheduler", None)
+        if scheduler:
+            scheduler.shutDown()
+            config = scheduler.shelveConfig
+        waiting = [self.devices.broadcast(ALL_OFF_COMMAND)]
+        self.devices.flush()
+        if config is not None:
+            waiting.append(config.close()) # The last lastRun and timeline go in first
+        done = defer.Deferred()
+        timeout = self.clock.callLater(SHUTDOWN_TIMEOUT, done.callback, None)
+        def finished(result):
+            if timeout.active():
+                timeout.cancel()
+                done.callback(None)
+        defer.DeferredList(waiting).addBoth(finished)
+        return done
+
+    def applySettings(self, settings):
+        """
+        Start using new Settings, from the zone command on down.
+        """
+        self.settings = settings
+        registerZoneCommand(self.commands, settings.zoneStrings)
+        if getattr(self, "scheduler", None):
+            self.scheduler.applySettings(settings)
+
     def setStatus(self, statusText, show = None):
         """
         Send a presence with statusText. show is one of the allowed strings, like 'xa'.
+
+        It goes through the outbound queue, so if another status comes along
+        before it's sent, only that one goes out.
         """
-        self.send(AvailablePresence(statuses = {None: statusText}, show = show))
+        self.outbound.setStatus(statusText, show)
+        self.statusChanged()
 
-    def sendText(self, responseText):
+    def statusChanged(self):
         """
-        Sends responseText in a message to whoever sent RainBot a message last.
+        Let the statusListeners know something's different, like for the web
+        status cache.
         """
-        reply = self._blankMessage()
+        for listener in self.statusListeners:
+            listener()
+
+    def _sendPresence(self, statusText, show):
+        self.send(AvailablePresence(statuses = {None: statusText}, show = show))
+
+    def _sendMessage(self, recipient, responseText):
+        reply = self._blankMessage(recipient)
         reply.addElement("body", content=responseText)        
         self.send(reply)
 
     def onMessage(self, msg):
+        """
+        Hand the command to the sender's session, which replies to them and
+        runs their commands in order.
+        """
         #print "Got a message", msg.toXml()
-        self.lastFrom = msg["from"] # Save this to send a reply.
-
         if msg["type"] == 'chat' and hasattr(msg, "body") and msg.body != None:
             msgTokens = str(msg.body).split()
-            msgCommand = msgTokens[0].lower()
-            if len(msgCommand) > 0:
-                if msgCommand == "on":
-                    self.handleOn(msgTokens)
-                elif msgCommand == "off":
-                    self.handleOff(msgTokens)
-                elif msgCommand == "pause" or msgCommand == "p":
-                    self.handlePause(msgTokens)
-                elif msgCommand == "run" or msgCommand == "r":
-                    self.handleRun(msgTokens)
-                elif msgCommand == "stop" or msgCommand == "s":
-                    self.handleStop(msgTokens)
-                elif msgCommand == "times" or msgCommand == "t":
-                    self.handleTimes(msgTokens)
-                elif msgCommand == "quit" or msgCommand == "q":
-                    self.handleQuit(msgTokens)
-                elif msgCommand == "last" or msgCommand == "l":
-                    self.handleLast(msgTokens)
-                elif msgCommand == "will" or msgCommand == "w":
-                    self.handleWill(msgTokens)                    
-                elif msgCommand == "moisture" or msgCommand == "m":
-                    self.handleMoisture(msgTokens)
-                elif msgCommand == "help" or msgCommand == "h" or msgCommand == "?":
-                    self.handleHelp(msgTokens)
-                elif msgCommand in ZONE_STRING_LIST:
-                    self.handleZone(msgTokens)
-                else:
-                    self.handleUnknownCommand(msgTokens)
-            
+            session = self.sessions.get(msg["from"])
+            if session is None:
+                session = self.sessions[msg["from"]] = Session(self, msg["from"], self._forgetSession)
+            session.received(msgTokens)
 
-    def handleOn(self, msgTokens):
+    def _forgetSession(self, session):
+        if self.sessions.get(session.jid) is session:
+            del self.sessions[session.jid]
+
+    def handleOn(self, session, msgTokens):
         """
         After running the scheduler's turn on, also send the status 
         string, because it can be quite long.
         """
         responseText = "Turning on"
-        self.sendText(responseText)
+        session.sendText(responseText)
         statusString = self.scheduler.turnOn()
         responseText = "Turned on"
-        self.sendText(responseText)
-        self.sendText(statusString)
+        session.sendText(responseText)
+        session.sendText(statusString)
 
-    def handleOff(self, msgTokens):
+    def handleOff(self, session, msgTokens):
         """
         Shut it down.
         """        
         responseText = "Turning off"
-        self.sendText(responseText)
+        session.sendText(responseText)
         self.scheduler.turnOff()
         responseText = "Turned off"
-        self.sendText(responseText)
+        session.sendText(responseText)
 
-    def handlePause(self, msgTokens):
+    def handlePause(self, session, msgTokens):
         """
         No arguments pauses for one day. The argument can be negative (and zero), but
         it can't cause the next time to go in the past, so -1 is probably the
@@ -162,30 +331,46 @@ class RainBotProtocol(MessageProtocol):
             responseText = "Pausing one day"
         else:
             responseText = "Pausing " + str(pauseDays) + " days"    
-        self.sendText(responseText)
+        session.sendText(responseText)
         statusString = self.scheduler.pauseDays(pauseDays)
-        self.sendText(statusString)
+        session.sendText(statusString)
 
-    def handleRun(self, msgTokens):
+    def handleRun(self, session, msgTokens):
         """
         Go time. It's going to get wet.
         """
         responseText = "Running"
-        self.sendText(responseText)
+        session.sendText(responseText)
         self.scheduler.runProgram()
 
-    def handleStop(self, msgTokens):
+    def handleStop(self, session, msgTokens):
         """
-        Ack, I'm all wet. Stop.
+        Ack, I'm all wet. Stop. Whatever was running is done for; the next
+        scheduled run still happens.
         """
         responseText = "Stopping"
-        self.sendText(responseText)
-        self.d.getFeedback(ALL_OFF_COMMAND)
+        session.sendText(responseText)
+        self.scheduler.stopProgram()
         responseText = "Stopped"
-        self.sendText(responseText)
+        session.sendText(responseText)
         self.setStatus(responseText)
 
-    def handleTimes(self, msgTokens):
+    def handleHold(self, session, msgTokens):
+        """
+        Like stop, but resume picks it back up with the time it had left.
+        """
+        if self.scheduler.holdProgram():
+            session.sendText("Holding. Resume to finish.")
+        else:
+            session.sendText("Nothing running to hold")
+
+    def handleResume(self, session, msgTokens):
+        if self.scheduler.resumeProgram():
+            session.sendText("Resuming")
+        else:
+            session.sendText("Nothing held")
+
+    def handleTimes(self, session, msgTokens):
         """
         This is a lot of work for one function, but there are a lot of ways to
         set the time.
@@ -202,91 +387,213 @@ class RainBotProtocol(MessageProtocol):
             try:
                 if msgTokens[-1].startswith('*'):
                     timeScale = float(msgTokens[-1][1:])
-                    for zone in (int(s) for s in ZONE_STRING_LIST):
+                    for zone in (int(s) for s in self.scheduler.settings.zoneStrings):
                         runTimeDict[zone] = int(timeScale * runTimeDict[zone])
                 elif msgTokens[-1].startswith('+'):
                     timePad = int(msgTokens[-1][1:])
-                    for zone in (int(s) for s in ZONE_STRING_LIST):
+                    for zone in (int(s) for s in self.scheduler.settings.zoneStrings):
                         runTimeDict[zone] += timePad
                 else:
                     newTime = int(msgTokens[-1])
-                    for zone in (int(s) for s in ZONE_STRING_LIST):
+                    for zone in (int(s) for s in self.scheduler.settings.zoneStrings):
                         runTimeDict[zone] = newTime
             except Exception, e:
-                self.sendText("Couldn't set run time. " + str(e))
+                session.sendText("Couldn't set run time. " + str(e))
             else:
                 self.scheduler.shelveConfig["runTimesMinutes"] = runTimeDict
                 self.scheduler.shelveConfig.sync()
+                self.statusChanged()
         elif len(msgTokens) == 3:
             try:
                 newTime = int(msgTokens[-1])
                 thisZone = int(msgTokens[-2])
                 runTimeDict[thisZone] = newTime
             except Exception, e:
-                self.sendText("Couldn't set run time. " + str(e))
+                session.sendText("Couldn't set run time. " + str(e))
             else:
                 self.scheduler.shelveConfig["runTimesMinutes"] = runTimeDict
                 self.scheduler.shelveConfig.sync()
+                self.statusChanged()
         responseText = "Run times"
-        self.sendText(responseText)
+        session.sendText(responseText)
         responseText = str(self.scheduler.shelveConfig["runTimesMinutes"])
-        self.sendText(responseText)
+        session.sendText(responseText)
 
-    def handleQuit(self, msgTokens):
+    def handleQuit(self, session, msgTokens):
         """
         Exit. Hopefully you've got monit or something to start you back up.
+        Everything's turned off first, and whatever was running picks up
+        again when it starts.
         """
         responseText = "Quitting"
-        self.sendText(responseText)
+        session.sendText(responseText)
+        if self.quitting:
+            return
+        self.quitting = True
+        self.scheduler.shutDown()
         reactor.callLater(1, reactor.stop)
 
-    def handleLast(self, msgTokens):
+    def handleLast(self, session, msgTokens):
         """
         This is in the status, but I want to have it sent to me anyway.
         """
         responseText = self.scheduler.lastRunStatusString
-        now = datetime.now()
+        now = self.scheduler.now()
         responseText += " (" + str(now - self.scheduler.shelveConfig["lastRun"]) + " ago)"
-        self.sendText(responseText)
+        session.sendText(responseText)
 
-    def handleWill(self, msgTokens):
+    def handleWill(self, session, msgTokens):
         """
         This is at the end of the status, where sometimes I can't read it.
+
+        Also when each zone will run, either in the program that's running
+        now or the next one.
         """
         responseText = self.scheduler.willRunStatusString
-        now = datetime.now()
-        responseText += " (in " + str(self.scheduler.willRunDatetime - now) + ")"
-        self.sendText(responseText)
+        now = self.scheduler.now()
+        if self.scheduler.willRunDatetime is not None:
+            responseText += " (in " + str(self.scheduler.willRunDatetime - now) + ")"
+        for zone, start, stop in self.scheduler.zoneTimes():
+            responseText += "\nZone " + str(zone) + ": " + start.strftime(ZONE_TIME_FORMAT).strip()
+            responseText += " - " + stop.strftime(ZONE_TIME_FORMAT).strip()
+        if self.scheduler.adjusting():
+            responseText += "\n" + self.scheduler.adjuster.describe(self.scheduler.settings.moistureAdjust)
+        else:
+            responseText += "\nMoisture adjusting off."
+        session.sendText(responseText)
+
+    def handleMoisture(self, session, msgTokens):
+        """
+        The standard windows (1h, 1d, 1w, 1m, 1y) come from memory. Any
+        other start time goes to rrdtool like before.
 
-    def handleMoisture(self, msgTokens):
-        startTime = None
+        moisture              # Last day, the sensor for every zone
+        moisture 1w           # Last week
+        moisture -3d          # Every row since three days ago, every sensor
+        moisture zone 4 1w    # Zone 4's own sensor
+        """
+        args = msgTokens[1:]
+        zone = None
+        if args and args[0].lower() == "zone":
+            try:
+                zone = int(args[1])
+            except (IndexError, ValueError):
+                raise UsageError("Which zone?")
+            if zone not in self.moisture.aggregates:
+                raise UsageError("Zone %d doesn't have a moisture sensor of its own" % zone)
+            args = args[2:]
+        if len(args) > 1:
+            raise UsageError("Too many arguments")
+        startTime = (args or ["1d"])[0]
+        zones = [zone]
+        if zone is None and None not in self.moisture.aggregates:
+            zones = self.moisture.zones # No sensor for every zone, so say how each one's doing
+        summaries = [self.moisture.summary(startTime, sensorZone) for sensorZone in zones]
+        if summaries[0] is not None:
+            session.sendText("\n".join(summaries))
+            return
+        def fetched(result):
+            session.sendText(str(result).replace(", ", "\n")) # A tuple that needs to be a readable string
+        if zone is None:
+            return self.moisture.fetchAverage(startTime).addCallback(fetched)
+        return self.moisture.fetchAverage(startTime, zone).addCallback(fetched)
+
+    def handleGraph(self, session, msgTokens):
+        """
+        Render the moisture graph (or find it's already rendered) and say
+        where to get it.
+        """
+        window = "1d"
         if len(msgTokens) == 2:
-            startTime = msgTokens[-1]
-        responseText = self.moisture.fetchAverage(startTime) # Returns a tuple that needs to be a readable string
-        responseText = str(responseText).replace(", ", "\n")
-        self.sendText(responseText)
-
-    def handleHelp(self, msgTokens):
-        responseText = "Commands:\n"
-        responseText += "on\n"
-        responseText += "off\n"
-        responseText += "pause (p) <days (default 1)>\n"
-        responseText += "run (r)\n"
-        responseText += "stop (s)\n"
-        responseText += "times (t)\n"
-        responseText += "times (t) <new time for all zones>\n"
-        responseText += "times (t) *<scale for all zones>\n"
-        responseText += "times (t) +<pad for all zones>\n"
-        responseText += "times (t) <zone> <new time>\n"
-        responseText += "last (l)\n"
-        responseText += "will (w)\n"
-        responseText += "moisture (m) <start time>\n"
-        responseText += "quit (q)\n"
-        responseText += "1..12 <time to run>\n"
-        responseText += "\n"
-        self.sendText(responseText)
-
-    def handleZone(self, msgTokens):
+            window = msgTokens[1].lstrip("-")
+        if len(msgTokens) > 2:
+            raise UsageError("No graph for " + " ".join(msgTokens[1:]))
+        try:
+            d = self.moisture.graph(window)
+        except KeyError:
+            raise UsageError("No graph for " + " ".join(msgTokens[1:]))
+        def rendered(png):
+            responseText = "Moisture graph for the last %s (%d KB): %s" % (window, (len(png) + 1023) // 1024,
+                                                                           GRAPH_URL % window)
+            if GRAPH_LOCAL_ONLY:
+                responseText += " (only from the RainBot machine)"
+            session.sendText(responseText)
+        return d.addCallback(rendered)
+
+    def handleHistory(self, session, msgTokens):
+        """
+        What happened, newest last.
+
+        history        # The last week
+        history 30d    # The last 30 days
+        """
+        if self.history is None:
+            session.sendText("No history kept")
+            return
+        start = self.clock.seconds() - _period(msgTokens[1:] or ["1w"])
+        def read(logged):
+            if not logged:
+                session.sendText("Nothing happened")
+                return
+            events = deque(maxlen = HISTORY_LINES)
+            for when, kind, zone, manual, number in logged:
+                events.append(datetime.fromtimestamp(when).strftime(HISTORY_TIME_FORMAT) + ": " +
+                              history.describeEvent(kind, zone, manual, number))
+            responseText = ""
+            if len(logged) > len(events):
+                responseText += "(%d earlier)\n" % (len(logged) - len(events))
+            responseText += "\n".join(events)
+            session.sendText(responseText)
+        return self.history.events(start).addCallback(read)
+
+    def handleUsage(self, session, msgTokens):
+        """
+        How long each zone ran and how many times.
+
+        usage              # Every zone, the last week
+        usage month        # Every zone, the last month
+        usage zone 4 week  # Just zone 4
+        """
+        if self.history is None:
+            session.sendText("No history kept")
+            return
+        args = msgTokens[1:]
+        zones = None
+        if args and args[0].lower() == "zone":
+            try:
+                zones = [int(args[1])]
+            except (IndexError, ValueError):
+                raise UsageError("Which zone?")
+            args = args[2:]
+        periodText = (args or ["1w"])[0]
+        end = self.clock.seconds()
+        def added(usage):
+            shown = zones
+            if shown is None:
+                shown = sorted(usage)
+            if not shown:
+                session.sendText("Nothing ran in the last " + periodText)
+                return
+            lines = ["Last " + periodText + ":"]
+            for zone in shown:
+                seconds, runs = usage.get(zone, (0.0, 0))
+                lines.append("Zone %d: %d minutes, %d runs" % (zone, int(round(seconds / 60)), runs))
+            if len(shown) > 1:
+                lines.append("Total: %d minutes" % int(round(sum(seconds for seconds, runs in usage.values()) / 60)))
+            session.sendText("\n".join(lines))
+        return self.history.usage(end - _period([periodText]), end, zones).addCallback(added)
+
+    def handleStats(self, session, msgTokens):
+        """
+        p50/p99/max for the device, rrdtool, config syncs, every handler,
+        and how far behind the reactor has been running.
+        """
+        session.sendText(STATS.report())
+
+    def handleHelp(self, session, msgTokens):
+        session.sendText(self.commands.helpText())
+
+    def handleZone(self, session, msgTokens):
         """
         You can pass a custom run time, as in
         
@@ -298,35 +605,35 @@ class RainBotProtocol(MessageProtocol):
         if len(msgTokens) > 1:
             try:
                 customRunTime = int(msgTokens[1])
-            except:
-                pass
-        if zoneStr in ZONE_STRING_LIST:
+            except ValueError:
+                raise UsageError("Not a number of minutes: " + msgTokens[1])
+        if zoneStr in self.scheduler.settings.zoneStrings:
             responseText = "Zone " + zoneStr
-            self.sendText(responseText)
+            session.sendText(responseText)
             zone = int(zoneStr)
-            runTime = self.scheduler.runZone(zone, singleZone = True, customRunTime = customRunTime)
+            runTime = self.scheduler.runZone(zone, customRunTime = customRunTime)
             responseText = "Running for : " + str(runTime)
             if runTime == 1:
                 responseText += " minute."
             else:
                 responseText += " minutes."
-            self.sendText(responseText)
+            session.sendText(responseText)
         else:
             responseText = "Unknown zone: " + zoneStr
-            self.sendText(responseText)
+            session.sendText(responseText)
 
-    def handleUnknownCommand(self, msgTokens):
+    def handleUnknownCommand(self, session, msgTokens):
         responseText = "Unknown command: " + msgTokens[0]
-        self.sendText(responseText)
+        session.sendText(responseText)
 
-    def _blankMessage(self):            
+    def _blankMessage(self, recipient):            
         """
         Just add body, as in
-            reply = self._blankMessage()
+            reply = self._blankMessage(recipient)
             reply.addElement("body", content=responseText)
         """
         reply = domish.Element((None, "message"))
-        reply["to"] = self.lastFrom
+        reply["to"] = recipient
         reply["from"] = self.parent.jid.full()
         reply["type"] = 'chat'
         return reply
@@ -339,46 +646,128 @@ class SchedulerState(object):
 
 class Scheduler(object):
 
-    def __init__(self, im, d):
+    def __init__(self, im, devices, clock = reactor, config = None, adjuster = None, settings = None,
+                 history = None):
+        """
+        devices is the DevicePool with the relay boards on it. clock is
+        anything that looks like the reactor's IReactorTime, like a
+        twisted.internet.task.Clock for the simulator. config is the mapping
+        to keep settings in, openConfig() if you don't pass one. adjuster is
+        a WateringAdjuster to scale scheduled run times by soil moisture
+        when settings.moistureAdjust turns it on, or None to always run the
+        times as set. settings is the Settings to
+        start with, defaultSettings() if you don't pass any. history is a
+        HistoryLog to log every zone and program to, if you want that.
+        """
         self.im = im
-        self.d = d
+        self.devices = devices
+        self.clock = clock
+        self.adjuster = adjuster
+        if settings is None:
+            settings = defaultSettings()
+        self.settings = settings
+        self.programSettings = settings # What the running program started with
+        self.pauseDelay = None
+        self.history = history
+        self.zonesOn = set()        # For the history
         self.nextScheduledRun = None
+        self.checkpointLoop = None
+        self.willRunDatetime = None # When nextScheduledRun goes off, while there's one
+        self.run = None             # TimelineRun for the program (or zone) that's running
         self.lastRunStatusString = ""
         self.willRunStatusString = ""
-        self.shelveConfig = shelve.open(SHELVE_NAME)
+        if config is None:
+            config = openConfig(clock)
+        self.shelveConfig = config
 
 
         # Check the shelve dictionary for
         #     lastRun : Last run time
         #     onState : Whether the sprinklers start on
         #     runTimesMinutes : Dictionary of how long to run each zone
-        # I call .sync() on it after assigning to it because I'm just that way
+        #     timeline : The ProgramTimeline that was running, if one was
+        #     timelineHeld : When it was held, if it was
+        #     timelineAt : The last time we know it was still running
+        # Each one is read once, anything missing gets filled in, and it all
+        # goes back with one .sync().
+        config = self.shelveConfig
+        changed = False
         try:
-            self.lastRunStatusString = "Last run: " + self.shelveConfig["lastRun"].strftime(TIME_FORMAT) + ". "
+            self.lastRunStatusString = "Last run: " + config["lastRun"].strftime(TIME_FORMAT) + ". "
         except:
             self.lastRunStatusString = "Last run: unknown. "
-            self.shelveConfig["lastRun"] = datetime.now()
+            config["lastRun"] = self.now()
+            changed = True
         try:
-            self.shelveConfig["onState"]
+            onState = config["onState"]
         except:
-            self.shelveConfig["onState"] = True
-            self.shelveConfig.sync()
+            onState = config["onState"] = True
+            changed = True
         try:
-            self.shelveConfig["runTimesMinutes"].keys()
+            runTimesMinutes = config["runTimesMinutes"]
+            runTimesMinutes.keys()
         except:
-            self.shelveConfig["runTimesMinutes"] = DEFAULT_RUN_TIMES_MINUTES
-            self.shelveConfig.sync()
+            runTimesMinutes = dict(DEFAULT_RUN_TIMES_MINUTES)
+            changed = True
+        if self.addNewZones(runTimesMinutes) or changed:
+            config["runTimesMinutes"] = runTimesMinutes
+            config.sync()
 
-        if self.shelveConfig["onState"]:
+        if onState:
             self.scheduleNextRun()
         else:
             self.turnOff()
 
+        # Finish whatever was running when we went down.
+        if "timeline" in self.shelveConfig:
+            self.resumeTimeline(self.shelveConfig["timeline"], self.shelveConfig.get("timelineHeld"),
+                                self.shelveConfig.get("timelineAt"))
+
+    def addNewZones(self, runTimesMinutes):
+        """
+        Give zones that aren't in runTimesMinutes yet the default run time.
+        Returns whether there were any.
+        """
+        newZones = [zone for zone in self.settings.zoneToIonum if zone not in runTimesMinutes]
+        for zone in newZones:
+            runTimesMinutes[zone] = DEFAULT_RUN_TIME_MINUTES
+        return bool(newZones)
+
+    def applySettings(self, settings):
+        """
+        Swap in new Settings. A program that's running keeps going on the old
+        zone map until it's done, but the next run is worked out again now,
+        pause and all.
+        """
+        self.settings = settings
+        if self.run is None:
+            self.programSettings = settings
+        runTimesMinutes = self.shelveConfig["runTimesMinutes"]
+        if self.addNewZones(runTimesMinutes):
+            self.shelveConfig["runTimesMinutes"] = runTimesMinutes
+            self.shelveConfig.sync()
+        if self.nextScheduledRun and self.nextScheduledRun.active():
+            state = self.state # Could be in the middle of a manual run
+            self.scheduleNextRun(self.pauseDelay)
+            self.state = state
+
+    def logEvent(self, kind, zone = 0, manual = False, number = 0):
+        if self.history:
+            self.history.add(self.clock.seconds(), kind, zone, manual, number)
+
+    def now(self):
+        """
+        datetime.now(), according to self.clock.
+        """
+        return datetime.fromtimestamp(self.clock.seconds())
+
     def scheduleNextRun(self, pauseDelay = None):
         """
         The optional pauseDelay is a timedelta of extra time to add on the 
         time to run next.
         """
+        self.pauseDelay = pauseDelay
+
         # We are definitely on
         self.shelveConfig["onState"] = True
         self.shelveConfig.sync()
@@ -391,17 +780,17 @@ class Scheduler(object):
             self.nextScheduledRun = None
         
         # Calculate number of seconds till it's time to run
-        now = datetime.now()
+        now = self.now()
         lastRunTime = self.shelveConfig["lastRun"]
-        self.willRunDatetime = lastRunTime.replace(hour = START_HOUR, minute = 0, second = 0) # Love that .replace() from datetime
-        while lastRunTime > self.willRunDatetime or now > self.willRunDatetime:
-            self.willRunDatetime += timedelta(days = INCREMENT_DAY)
+        self.willRunDatetime = lastRunTime.replace(hour = self.settings.startHour, minute = 0, second = 0) # Love that .replace() from datetime
+        while lastRunTime > self.willRunDatetime or now >= self.willRunDatetime:
+            self.willRunDatetime += timedelta(days = self.settings.incrementDay)
         if pauseDelay:
             self.willRunDatetime += pauseDelay
         timeTillRun = self.willRunDatetime - now
         timeTillRunSeconds = _td_to_seconds(timeTillRun)
 
-        self.nextScheduledRun = reactor.callLater(timeTillRunSeconds, self.runProgram)
+        self.nextScheduledRun = self.clock.callLater(timeTillRunSeconds, self.runScheduledProgram)
         self.willRunStatusString = "Will run: " + self.willRunDatetime.strftime(TIME_FORMAT) + "."
         try:
             self.im.setStatus(self.lastRunStatusString + self.willRunStatusString)
@@ -410,16 +799,21 @@ class Scheduler(object):
         return self.lastRunStatusString + self.willRunStatusString
 
     def turnOn(self):
+        self.logEvent(history.TURNED_ON)
         return self.scheduleNextRun()
 
     def turnOff(self):
         """
         Set the off state, turn off all zones, and set the red light.
         """
+        if self.shelveConfig["onState"]:
+            self.logEvent(history.TURNED_OFF)
         self.shelveConfig["onState"] = False
         self.shelveConfig.sync()
         self.state = SchedulerState.SCHEDULER_OFF
         self.willRunStatusString = "Sprinklers off"
+        self.willRunDatetime = None
+        self.cancelRun()
         self.turnOffAllZones()
         if self.nextScheduledRun:
             if self.nextScheduledRun.active():
@@ -434,64 +828,279 @@ class Scheduler(object):
         Doesn't do anything if the sprinklers are off.
         """
         if self.state != SchedulerState.SCHEDULER_OFF:
+            self.logEvent(history.PAUSE, number = numDays)
             return self.scheduleNextRun(timedelta(days = numDays))
         else:
             return "Not pausing because sprinklers are off."
 
-    def runProgram(self, manual = False):
+    def runScheduledProgram(self):
+        """
+        The timer goes off. Only this run goes by soil moisture, if it's
+        adjusting: it's skipped if every zone is wet, and scaled if not.
+        Anybody who asks for a run gets the times as set.
         """
-        Run all the zones.
+        if (self.adjusting() and any(self.programRunTimes(False).values())
+                and not any(self.programRunTimes(True).values())):
+            self.skipProgram()
+            return
+        self.runProgram(adjusted = True)
+
+    def runProgram(self, manual = False, adjusted = False):
+        """
+        Run all the zones, as many at a time as the water supply allows.
+        Zones with a run time of 0 are skipped.
         
         If run in manual mode, don't mess with the next scheduled run.
         
         If run in regularly scheduled mode, schedule the next run when
-        all the zones are done.
+        all the zones are done. adjusted scales the run times by soil
+        moisture.
         """
         if manual:
             self.state = SchedulerState.SCHEDULER_RUNNING_MANUAL
         else:
             self.state = SchedulerState.SCHEDULER_RUNNING_SCHEDULED
         self.im.setStatus("Running program")
-        self.runZone(1, singleZone = False)
+        self.logEvent(history.PROGRAM_START, manual = manual)
+        self.startTimeline(self.planTimeline(self.now(), scheduled = not manual, adjusted = adjusted))
 
-    def runZone(self, zone, singleZone = False, customRunTime = None):
+    def skipProgram(self):
         """
-        Run one zone, zone.
-        
-        If running as singleZone, end of story. If not, schedule the next
-        zone after this.
+        The soil's wet enough already. It doesn't count as a run, so the next
+        one is still on the usual schedule.
+        """
+        print "Skipping program.", self.adjuster.describe(self.settings.moistureAdjust)
+        self.logEvent(history.SKIPPED)
+        self.scheduleNextRun()
+        try:
+            self.im.setStatus("Skipped, soil is wet. " + self.lastRunStatusString + self.willRunStatusString)
+        except:
+            pass
+
+    def programRunTimes(self, adjusted):
+        """
+        How long each zone runs in a program, adjusted for soil moisture if
+        adjusted and it's adjusting.
+        """
+        runTimesMinutes = dict((zone, minutes) for zone, minutes
+                               in self.shelveConfig["runTimesMinutes"].items()
+                               if zone in self.settings.zoneToIonum) # Not a board that's gone
+        if adjusted and self.adjusting():
+            runTimesMinutes = self.adjuster.adjust(runTimesMinutes, self.settings.moistureAdjust)
+        return runTimesMinutes
+
+    def adjusting(self):
+        """
+        Whether scheduled runs go by soil moisture: there's an adjuster and
+        the settings turn it on.
+        """
+        return self.adjuster is not None and self.settings.moistureAdjust is not None
+
+    def planTimeline(self, start, scheduled, adjusted):
+        """
+        The timeline the program would follow if it started at start,
+        adjusted for soil moisture if adjusted.
+        """
+        runTimesMinutes = self.programRunTimes(adjusted)
+        groups = planProgram(runTimesMinutes, self.settings.zoneFlows, self.settings.supplyCapacity)
+        return timeline.buildTimeline(groups, runTimesMinutes, start, self.settings.zoneDelaySeconds,
+                                      scheduled)
+
+    def runZone(self, zone, customRunTime = None):
+        """
+        Run one zone, zone, by itself.
         
         Pass in customRunTime (minutes) or use the configured time.
 
         Returns the number of minutes it will run for so it can be
         sent as a response message.
         """
-        self.im.setStatus("Running zone: " + str(zone))
         try:
-            thisRunTimeSeconds = 60 * self.shelveConfig["runTimesMinutes"][zone]
+            thisRunTimeMinutes = self.shelveConfig["runTimesMinutes"][zone]
             if customRunTime:
-                thisRunTimeSeconds = 60 * customRunTime
-            reactor.callLater(0, self.turnOnZone, zone)
-            if singleZone:
-                reactor.callLater(thisRunTimeSeconds, self.ranLastZone)
-            else:
-                reactor.callLater(thisRunTimeSeconds, self.runNextZone, zone)
-            return thisRunTimeSeconds // 60
+                thisRunTimeMinutes = customRunTime
+            self.startTimeline(timeline.zoneTimeline(zone, thisRunTimeMinutes, self.now()))
+            return thisRunTimeMinutes
         except Exception, e:
             self.im.setStatus("Couldn't run zone: " + str(zone) + ". Exception: " + str(e))
 
-    def runNextZone(self, zone):
+    def zoneTimes(self):
         """
-        Breathe for a moment, then run the next zone.
+        [(zone, start, stop), ...] for the rest of the running program, or
+        for the next scheduled one if nothing's running.
         """
-        self.turnOffAllZones()
-        self.im.setStatus("Finished zone: " + str(zone))
-        if zone < len(ZONE_STRING_LIST):
-            nextZone = zone + 1
-            reactor.callLater(ZONE_DELAY_SECONDS, self.runZone, nextZone, singleZone = False)
+        if self.run:
+            return self.run.timeline.zoneTimes()
+        if self.state == SchedulerState.SCHEDULER_OFF or self.willRunDatetime is None:
+            return []
+        return self.planTimeline(self.willRunDatetime, scheduled = True, adjusted = True).zoneTimes()
+
+    def startTimeline(self, newTimeline, heldAt = None):
+        """
+        Follow newTimeline from the top, or hold it from heldAt. It takes
+        over from anything that was already running, and that one's timer
+        goes with it.
+        """
+        self.cancelRun()
+        self.programSettings = self.settings
+        self.run = timeline.TimelineRun(newTimeline, self.clock, self.runTimeline, heldAt)
+        self.saveTimeline()
+        self.run.arm(self.now())
+        if heldAt is None:
+            self.startCheckpoints()
+
+    def resumeTimeline(self, oldTimeline, heldAt = None, stoppedAt = None):
+        """
+        Pick up what was running when we went down, from stoppedAt, the
+        last time it was known to be running. If it was held it stays held,
+        and resumeProgram() takes it from where it was held. If it should
+        have been done more than RESUME_GRACE_SECONDS ago, it's dropped.
+        """
+        finishesAt = oldTimeline.events[-1][0]
+        if heldAt is None and self.now() - finishesAt > timedelta(seconds = RESUME_GRACE_SECONDS):
+            print "Not picking the program back up. It should have finished", finishesAt.strftime(TIME_FORMAT)
+            self.forgetTimeline()
+            return
+        if oldTimeline.scheduled:
+            self.state = SchedulerState.SCHEDULER_RUNNING_SCHEDULED
+        else:
+            self.state = SchedulerState.SCHEDULER_RUNNING_MANUAL
+        if heldAt is None:
+            self.im.setStatus("Resuming program")
+            self.startTimeline(oldTimeline.resumed(self.now(), stoppedAt))
         else:
-            reactor.callLater(ZONE_DELAY_SECONDS, self.ranLastZone)
-    
+            self.im.setStatus("Holding program")
+            self.startTimeline(oldTimeline, heldAt)
+
+    def saveTimeline(self):
+        self.shelveConfig["timeline"] = self.run.timeline
+        self.shelveConfig["timelineHeld"] = self.run.heldAt
+        self.shelveConfig["timelineAt"] = self.now()
+        self.shelveConfig.sync()
+
+    def checkpoint(self):
+        """
+        Note that the program's still going as of now.
+        """
+        self.shelveConfig["timelineAt"] = self.now()
+        self.shelveConfig.sync()
+
+    def startCheckpoints(self):
+        self.stopCheckpoints()
+        self.checkpointLoop = LoopingCall(self.checkpoint)
+        self.checkpointLoop.clock = self.clock
+        self.checkpointLoop.start(TIMELINE_CHECKPOINT_SECONDS, now = False)
+
+    def stopCheckpoints(self):
+        if self.checkpointLoop and self.checkpointLoop.running:
+            self.checkpointLoop.stop()
+        self.checkpointLoop = None
+
+    def forgetTimeline(self):
+        for key in ("timeline", "timelineHeld", "timelineAt"):
+            if key in self.shelveConfig:
+                del self.shelveConfig[key]
+        self.shelveConfig.sync()
+
+    def cancelRun(self):
+        """
+        Drop whatever's running, timer and all, so nothing it had coming
+        turns a zone on. Doesn't touch the relays.
+        """
+        if self.run is None:
+            return
+        self.run.cancel()
+        self.run = None
+        self.stopCheckpoints()
+        self.programSettings = self.settings
+        self.forgetTimeline()
+
+    def stopProgram(self):
+        """
+        Stop whatever's running for good and turn everything off. The
+        schedule carries on, so stopping a scheduled program still gets the
+        next one scheduled.
+        """
+        state = self.state
+        self.cancelRun()
+        self.turnOffAllZones()
+        if state in (SchedulerState.SCHEDULER_RUNNING_SCHEDULED, SchedulerState.SCHEDULER_RUNNING_MANUAL):
+            self.logEvent(history.PROGRAM_END)
+            self.state = SchedulerState.SCHEDULER_ON
+        if state == SchedulerState.SCHEDULER_RUNNING_SCHEDULED:
+            self.scheduleNextRun()
+
+    def holdProgram(self):
+        """
+        Stop the clock on whatever's running and turn everything off until
+        resumeProgram(). Returns False if there's nothing running to hold.
+        """
+        if self.run is None or not self.run.hold(self.now()):
+            return False
+        self.stopCheckpoints()
+        self.turnOffAllZones()
+        self.saveTimeline()
+        self.im.setStatus("Holding program")
+        return True
+
+    def resumeProgram(self):
+        """
+        Pick a held program back up with the time it had left. Returns False
+        if nothing's held.
+        """
+        if self.run is None or not self.run.held():
+            return False
+        self.run.resume(self.now())
+        self.saveTimeline()
+        self.startCheckpoints()
+        self.im.setStatus("Resuming program")
+        return True
+
+    def shutDown(self):
+        """
+        Cancel every timer and turn everything off, for quitting. What was
+        running stays saved, as of now, so it picks up again on the next
+        start.
+        """
+        if self.run:
+            if not self.run.held():
+                self.checkpoint()
+            self.run.cancel()
+        self.stopCheckpoints()
+        if self.nextScheduledRun and self.nextScheduledRun.active():
+            self.nextScheduledRun.cancel()
+        self.nextScheduledRun = None
+        self.turnOffAllZones()
+
+    def runTimeline(self, run):
+        """
+        Do every event that's due, save how far we got, and set the timer
+        for the one after that.
+        """
+        if run is not self.run:
+            return # Replaced by a newer run
+        now = self.now()
+        while run is self.run:
+            when, kind, zones = run.timeline.nextEvent()
+            if when > now:
+                break
+            run.timeline.next += 1
+            if kind == timeline.START:
+                self.im.setStatus("Running " + _zonesString(zones))
+                self.turnOnZones(zones)
+            elif kind == timeline.STOP:
+                self.turnOffZone(zones[0])
+            elif kind == timeline.END:
+                self.turnOffAllZones()
+                self.im.setStatus("Finished " + _zonesString(zones))
+            elif kind == timeline.DONE:
+                self.cancelRun()
+                self.ranLastZone()
+                return
+        if run is self.run:
+            self.saveTimeline()
+            run.arm(now)
+
     def ranLastZone(self):
         """
         Another successful watering. I can see the grass greener already.
@@ -499,10 +1108,12 @@ class Scheduler(object):
         Shut everything down, make some notes, and schedule another run if needed.
         """
         self.turnOffAllZones()
+        if self.state in (SchedulerState.SCHEDULER_RUNNING_SCHEDULED, SchedulerState.SCHEDULER_RUNNING_MANUAL):
+            self.logEvent(history.PROGRAM_END)
         if self.state == SchedulerState.SCHEDULER_RUNNING_SCHEDULED:
             self.scheduleNextRun()
         self.state = SchedulerState.SCHEDULER_ON
-        lastRunTime = self.shelveConfig["lastRun"] = datetime.now()
+        lastRunTime = self.shelveConfig["lastRun"] = self.now()
         self.shelveConfig.sync()
         self.lastRunStatusString = "Last run: " + lastRunTime.strftime(TIME_FORMAT) + ". "
         try:
@@ -510,20 +1121,79 @@ class Scheduler(object):
         except:
             pass
 
-    def turnOnZone(self, zone):
+    def turnOnZones(self, zones):
         """
-        Use the LabJackPython BitStateWrite to change a single EIO or CI0.
+        Use the LabJackPython BitStateWrite to change a single EIO or CI0
+        for each zone, and turn everything else off.
         
         Remember setting the line low turns the relay on.
+
+        Each board's batcher sends its share in one Feedback packet, and the
+        boards all get theirs at the same time.
+        """
+        manual = not (self.run and self.run.timeline.scheduled)
+        for zone in sorted(self.zonesOn - set(zones)):
+            self.logEvent(history.ZONE_OFF, zone)
+        for zone in zones:
+            if zone not in self.zonesOn:
+                self.logEvent(history.ZONE_ON, zone, manual)
+        self.zonesOn = set(zones)
+        ioNums = {}     # FeedbackBatcher : [IO num, ...]
+        for zone in zones:
+            board, ioNum = self.programSettings.zoneToIonum[zone]
+            ioNums.setdefault(self.devices.get(board), []).append(ioNum)
+        for d in self.devices:
+            d.getFeedback(ALL_OFF_COMMAND)
+            if d in ioNums:
+                d.getFeedback([u3.BitStateWrite(ioNum, 0) for ioNum in ioNums[d]])
+
+    def turnOffZone(self, zone):
+        """
+        Turn off just this zone and leave the rest of its group running.
         """
-        self.d.getFeedback(ALL_OFF_COMMAND)
-        self.d.getFeedback(u3.BitStateWrite(ZONE_TO_IONUM[zone], 0))
+        if zone in self.zonesOn:
+            self.zonesOn.discard(zone)
+            self.logEvent(history.ZONE_OFF, zone)
+        board, ioNum = self.programSettings.zoneToIonum[zone]
+        self.devices.get(board).getFeedback(u3.BitStateWrite(ioNum, 1))
 
     def turnOffAllZones(self):
         """
         An all-around handy thing to do.
         """
-        self.d.getFeedback(ALL_OFF_COMMAND)
+        for zone in sorted(self.zonesOn):
+            self.logEvent(history.ZONE_OFF, zone)
+        self.zonesOn = set()
+        self.devices.broadcast(ALL_OFF_COMMAND)
+
+def openConfig(clock = reactor):
+    """
+    Open the config journal. The first time, bring over whatever was in the
+    old shelve.
+    """
+    config = JournalStore(JOURNAL_NAME, clock)
+    if not config.keys():
+        try:
+            legacyConfig = shelve.open(SHELVE_NAME, "r")
+        except Exception:
+            pass
+        else:
+            # Not config[key] = ..., which would sync() through the reactor
+            # from whatever thread this is on.
+            config.writeNow([(key, legacyConfig[key]) for key in legacyConfig.keys()])
+            legacyConfig.close()
+    return config
+
+def _zonesString(zones):
+    if len(zones) == 1:
+        return "zone: " + str(zones[0])
+    return "zones: " + ", ".join(str(zone) for zone in zones)
+
+def _period(tokens):
+    seconds = history.parsePeriod(tokens[0])
+    if seconds is None:
+        raise UsageError("Not a time period: " + tokens[0])
+    return seconds
 
 def _td_to_seconds(td):
     '''Convert a timedelta to seconds'''
@@ -0,0 +1,49 @@
+from twisted.internet import defer
+
+class Session(object):
+    """
+    One person (or script) talking to a bot, by full JID. Replies go back to
+    whoever sent the command, not whoever happened to talk last, and their
+    commands run one at a time in the order they sent them. If a handler
+    returns a Deferred, the next command waits for it. Other people's
+    sessions don't wait for anybody.
+
+    forget(session) gets called when there's nothing left queued, so the bot
+    isn't holding on to everyone who ever said hi.
+    """
+    def __init__(self, protocol, jid, forget = None):
+        self.protocol = protocol
+        self.jid = jid
+        self.forget = forget
+        self.queue = []         # msgTokens waiting their turn
+        self.running = False    # Waiting on a handler's Deferred
+
+    def sendText(self, responseText):
+        """
+        Send responseText back to this session's JID.
+        """
+        self.protocol.outbound.sendText(self.jid, responseText)
+
+    def received(self, msgTokens):
+        self.queue.append(msgTokens)
+        if not self.running:
+            self.runNext()
+
+    def runNext(self, result = None):
+        """
+        Run queued commands until one has to be waited on, or they're gone.
+        """
+        self.running = False
+        while self.queue and not self.running:
+            msgTokens = self.queue.pop(0)
+            d = defer.maybeDeferred(self.protocol.commands.dispatch, self.protocol, self, msgTokens)
+            d.addErrback(self.commandFailed, msgTokens)
+            if not d.called:
+                self.running = True
+                d.addCallback(self.runNext)
+        if not self.running and self.forget:
+            self.forget(self)
+
+    def commandFailed(self, failure, msgTokens):
+        print "Command", " ".join(msgTokens), "from", self.jid, "failed:", failure.getErrorMessage()
+        self.sendText("Couldn't do " + msgTokens[0] + ". " + failure.getErrorMessage())
@@ -0,0 +1,321 @@
+import json
+import os
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from adjuster import DEFAULT_LIMITS
+
+SETTINGS_FILE = "rainbot-settings.json"
+
+# How often to look at SETTINGS_FILE when there's no inotify, and how long
+# to let an editor finish saving before reading it.
+POLL_PERIOD = 5
+RELOAD_DELAY = 0.5
+
+# LabJackPython IO numbers: FIO0-7, EIO0-7, CIO0-3.
+MAX_IONUM = 19
+
+# AIN0-15, which are FIO0-7 and EIO0-7.
+MAX_AIN_CHANNEL = 15
+
+class SettingsError(Exception):
+    """
+    The settings file is there but it's not right. The message says why.
+    """
+
+class Settings(object):
+    """
+    Everything that can change without a restart. One of these is never
+    changed after it's made; a reload makes a new one and swaps it in, so
+    nobody ever sees half of an edit.
+
+    zoneToIonum is {zone : (board, IO num)}, like ZONE_TO_IONUM. credentials
+    is {"rainbot" : (jid, password), "liftbot" : (jid, password)}.
+    moistureSensors is {zone or None : AIN channel}, like MOISTURE_SENSORS.
+    moistureAdjust is None to water by the clock alone, or limits like
+    adjuster.DEFAULT_LIMITS to scale scheduled runs by soil moisture.
+    """
+    def __init__(self, startHour, incrementDay, zoneDelaySeconds, zoneToIonum, zoneFlows,
+                 supplyCapacity, credentials, moistureSensors, moistureAdjust = None):
+        self.startHour = startHour
+        self.incrementDay = incrementDay
+        self.zoneDelaySeconds = zoneDelaySeconds
+        self.zoneToIonum = zoneToIonum
+        self.zoneFlows = zoneFlows
+        self.supplyCapacity = supplyCapacity
+        self.credentials = credentials
+        self.moistureSensors = moistureSensors
+        self.moistureAdjust = moistureAdjust
+        self.zoneStrings = [str(zone) for zone in sorted(zoneToIonum)]
+
+    def boards(self):
+        return set(board for board, ioNum in self.zoneToIonum.values())
+
+def parseSettings(text, defaults):
+    """
+    Settings from the JSON in text. Anything it leaves out comes from
+    defaults. Raises SettingsError if something's wrong with it.
+
+        {"startHour": 4,
+         "incrementDay": 2,
+         "zoneDelaySeconds": 5,
+         "zones": {"1": [null, 19], "2": [320012345, 19]},
+         "zoneFlows": {"1": 2.5},
+         "supplyCapacity": 5.0,
+         "moistureSensors": {"all": 0, "3": 1, "4": 2},
+         "moistureAdjust": {"wetVolts": 1.3, "dryVolts": 0.5},
+         "rainbot": {"jid": "rainbot@example.com/home", "password": "..."},
+         "liftbot": {"jid": "liftbot@example.com/home", "password": "..."}}
+
+    A zone's board is a U3 serial number, or null for the first one found.
+    A moisture sensor is an AIN channel for one zone, or for "all" the zones
+    without one of their own. moistureAdjust turns on scaling scheduled runs
+    by soil moisture: true for the limits in adjuster.py, or any of wetVolts,
+    dryVolts, minScale, and maxScale to change them. false turns it off.
+    """
+    try:
+        raw = json.loads(text)
+    except ValueError, e:
+        raise SettingsError("Not JSON: " + str(e))
+    if not isinstance(raw, dict):
+        raise SettingsError("Should be a JSON object")
+
+    startHour = _number(raw, "startHour", defaults.startHour, int, 0, 23)
+    incrementDay = _number(raw, "incrementDay", defaults.incrementDay, int, 1)
+    zoneDelaySeconds = _number(raw, "zoneDelaySeconds", defaults.zoneDelaySeconds, float, 0)
+    supplyCapacity = _number(raw, "supplyCapacity", defaults.supplyCapacity, float, 0)
+    if supplyCapacity <= 0:
+        raise SettingsError("supplyCapacity has to be more than 0")
+
+    zoneToIonum = defaults.zoneToIonum
+    zoneFlows = defaults.zoneFlows
+    if "zones" in raw:
+        zoneToIonum = {}
+        for zoneString, line in _items(raw, "zones"):
+            zone = _zone(zoneString)
+            if (not isinstance(line, list) or len(line) != 2 or
+                    not (line[0] is None or _isInteger(line[0])) or
+                    not _isInteger(line[1]) or not 0 <= line[1] <= MAX_IONUM):
+                raise SettingsError("Zone %s should be [board serial or null, IO num 0-%d]" % (zone, MAX_IONUM))
+            zoneToIonum[zone] = tuple(line)
+        if not zoneToIonum:
+            raise SettingsError("There have to be some zones")
+        if len(set(zoneToIonum.values())) < len(zoneToIonum):
+            raise SettingsError("Two zones are on the same line")
+        checkBoards(set(board for board, ioNum in zoneToIonum.values()))
+        zoneFlows = dict((zone, defaults.zoneFlows.get(zone, 1.0)) for zone in zoneToIonum)
+    if "zoneFlows" in raw:
+        zoneFlows = dict(zoneFlows)
+        for zoneString, flow in _items(raw, "zoneFlows"):
+            zone = _zone(zoneString)
+            if zone not in zoneToIonum:
+                raise SettingsError("zoneFlows has zone %d, which isn't in zones" % zone)
+            if not isinstance(flow, (int, float)) or flow <= 0:
+                raise SettingsError("Zone %d's flow should be a number more than 0" % zone)
+            zoneFlows[zone] = float(flow)
+
+    moistureSensors = dict((zone, channel) for zone, channel in defaults.moistureSensors.items()
+                           if zone is None or zone in zoneToIonum)
+    if "moistureSensors" in raw:
+        moistureSensors = {}
+        for zoneString, channel in _items(raw, "moistureSensors"):
+            zone = None
+            if zoneString != "all":
+                zone = _zone(zoneString)
+                if zone not in zoneToIonum:
+                    raise SettingsError("moistureSensors has zone %d, which isn't in zones" % zone)
+            if not _isInteger(channel) or not 0 <= channel <= MAX_AIN_CHANNEL:
+                raise SettingsError("Moisture sensor %s should be AIN channel 0-%d" % (zoneString, MAX_AIN_CHANNEL))
+            moistureSensors[zone] = channel
+        if not moistureSensors:
+            raise SettingsError("There have to be some moisture sensors")
+        if len(set(moistureSensors.values())) < len(moistureSensors):
+            raise SettingsError("Two moisture sensors are on the same channel")
+
+    moistureAdjust = defaults.moistureAdjust
+    if "moistureAdjust" in raw:
+        moistureAdjust = _adjustLimits(raw["moistureAdjust"], defaults.moistureAdjust)
+
+    credentials = dict(defaults.credentials)
+    for bot in ("rainbot", "liftbot"):
+        if bot in raw:
+            login = raw[bot]
+            if (not isinstance(login, dict) or
+                    not all(isinstance(login.get(key), basestring) for key in ("jid", "password"))):
+                raise SettingsError(bot + " should have a jid and a password")
+            credentials[bot] = (str(login["jid"]), str(login["password"]))
+
+    return Settings(startHour, incrementDay, zoneDelaySeconds, zoneToIonum, zoneFlows,
+                    supplyCapacity, credentials, moistureSensors, moistureAdjust)
+
+def checkBoards(boards):
+    """
+    A board of None opens whichever U3 is found first, which with more than
+    one plugged in could be one that's also opened by its serial number. So
+    it's fine on its own, but once there's a serial, everybody needs one.
+    """
+    if None in boards and len(boards) > 1:
+        raise SettingsError("With more than one board, every board needs its serial number, not null")
+
+def checkMoistureLines(zoneToIonum, moistureSensors, board, otherLines = {}):
+    """
+    AIN channel n is IO num n, so a moisture sensor on board takes that line
+    over when the sampler makes it analog. It can't be a zone's relay line
+    on the same board, or one of otherLines ({IO num : what it is}), like
+    the door lines when LiftBot's on that board too.
+    """
+    taken = dict(otherLines)
+    for zone, (zoneBoard, ioNum) in zoneToIonum.items():
+        if zoneBoard == board:
+            taken[ioNum] = "zone %d's relay" % zone
+    for zone, channel in sorted(moistureSensors.items()):
+        if channel in taken:
+            raise SettingsError("Moisture sensor %s is on AIN%d, which is %s" % (
+                "all" if zone is None else zone, channel, taken[channel]))
+
+def loadSettings(path, defaults):
+    """
+    parseSettings on the file at path, or just defaults if there isn't one.
+    """
+    try:
+        with open(path) as f:
+            text = f.read()
+    except IOError, e:
+        if not os.path.exists(path):
+            return defaults
+        raise SettingsError("Couldn't read it: " + str(e))
+    return parseSettings(text, defaults)
+
+class SettingsWatcher(object):
+    """
+    Watches the settings file and calls onChange(settings) with the new
+    Settings every time it's saved, if they check out. If they don't, it
+    says why and everything keeps going with the old ones.
+
+    It uses inotify on the file's directory, which catches editors that
+    save by writing a new file and renaming it over the old one. Where
+    there's no inotify it looks at the file's modification time every
+    POLL_PERIOD instead.
+    """
+    def __init__(self, path, defaults, onChange, clock = reactor):
+        self.path = os.path.abspath(path)
+        self.defaults = defaults
+        self.onChange = onChange
+        self.clock = clock
+        self.reloadCall = None
+        self.lastStat = self._stat()
+        self.notifier = None
+        self.pollLoop = None
+
+    def start(self):
+        try:
+            from twisted.internet import inotify
+            from twisted.python import filepath
+            self.notifier = inotify.INotify()
+            self.notifier.startReading()
+            self.notifier.watch(filepath.FilePath(os.path.dirname(self.path)),
+                                mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_DELETE,
+                                callbacks = [self.changed])
+        except Exception, e:
+            print "No inotify (%s). Checking %s every %d seconds." % (e, self.path, POLL_PERIOD)
+            self.notifier = None
+            self.startPolling()
+
+    def startPolling(self):
+        self.pollLoop = LoopingCall(self.poll)
+        self.pollLoop.clock = self.clock
+        self.pollLoop.start(POLL_PERIOD, now = False)
+
+    def stop(self):
+        if self.notifier:
+            self.notifier.loseConnection()
+            self.notifier = None
+        if self.pollLoop and self.pollLoop.running:
+            self.pollLoop.stop()
+        if self.reloadCall and self.reloadCall.active():
+            self.reloadCall.cancel()
+        self.reloadCall = None
+
+    def changed(self, ignored, filePath, mask):
+        if filePath.path == self.path:
+            self.scheduleReload()
+
+    def poll(self):
+        if self._stat() != self.lastStat:
+            self.scheduleReload()
+
+    def scheduleReload(self):
+        if self.reloadCall is None:
+            self.reloadCall = self.clock.callLater(RELOAD_DELAY, self.reload)
+
+    def reload(self):
+        self.reloadCall = None
+        self.lastStat = self._stat()
+        try:
+            settings = loadSettings(self.path, self.defaults)
+        except SettingsError, e:
+            print "Not using the new", self.path + ".", e
+            return
+        print "Reloaded", self.path
+        self.onChange(settings)
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+def _items(raw, key):
+    if not isinstance(raw[key], dict):
+        raise SettingsError(key + " should be a JSON object")
+    return raw[key].items()
+
+def _adjustLimits(value, defaults):
+    if value is False or value is None:
+        return None
+    limits = dict(defaults or DEFAULT_LIMITS)
+    if value is True:
+        return limits
+    if not isinstance(value, dict):
+        raise SettingsError("moistureAdjust should be true, false, or a JSON object")
+    for key in value:
+        if key not in DEFAULT_LIMITS:
+            raise SettingsError("moistureAdjust doesn't have a " + key)
+    for key in DEFAULT_LIMITS:
+        limits[key] = _number(value, key, limits[key], float, 0)
+    if limits["wetVolts"] <= limits["dryVolts"]:
+        raise SettingsError("moistureAdjust wetVolts has to be more than dryVolts")
+    if limits["minScale"] > 1:
+        raise SettingsError("moistureAdjust minScale should be at most 1")
+    if limits["maxScale"] < 1:
+        raise SettingsError("moistureAdjust maxScale should be at least 1")
+    return limits
+
+def _zone(zoneString):
+    try:
+        zone = int(zoneString)
+    except ValueError:
+        raise SettingsError("Not a zone number: " + zoneString)
+    if zone < 1:
+        raise SettingsError("Zones start at 1, not %d" % zone)
+    return zone
+
+def _isInteger(value):
+    # JSON true and false come back as bools, which are ints too.
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def _number(raw, key, default, kind, low, high = None):
+    if key not in raw:
+        return default
+    value = raw[key]
+    if (not isinstance(value, (int, long, float)) or isinstance(value, bool) or
+            (kind is int and value != int(value))):
+        raise SettingsError(key + " should be a number")
+    value = kind(value)
+    if value < low:
+        raise SettingsError("%s should be at least %s" % (key, low))
+    if high is not None and value > high:
+        raise SettingsError("%s should be at most %s" % (key, high))
+    return value
@@ -0,0 +1,933 @@
+"""
+Run RainBot, LiftBot, and the moisture sampler against a FakeU3 on a
+task.Clock, so hours of watering take milliseconds. Each simulation checks
+what the relays and sensors did and blows up with an AssertionError if it
+wasn't right.
+
+    python simulate.py
+"""
+import Queue
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from device import DeviceWorker, InlineWorker, FeedbackBatcher, DevicePool
+from diskpool import DiskPool, DiskQueue
+from fakeu3 import FakeU3
+import journal
+from journal import JournalStore
+from settings import SETTINGS_FILE, SettingsError, SettingsWatcher, checkMoistureLines, parseSettings
+import rainbot
+
+class StatusRecorder(object):
+    """
+    Stands in for the protocol the Scheduler reports to.
+    """
+    def __init__(self):
+        self.statuses = []
+
+    def setStatus(self, statusText, show = None):
+        self.statuses.append(statusText)
+
+class HeldDisk(object):
+    """
+    Stands in for a DiskQueue on a slow card. Calls wait, in order, until
+    release() runs the ones that were queued when it was called.
+    """
+    def __init__(self):
+        self.calls = []         # (Deferred, f, args, kwargs)
+
+    def call(self, f, *args, **kwargs):
+        d = defer.Deferred()
+        self.calls.append((d, f, args, kwargs))
+        return d
+
+    def release(self):
+        calls, self.calls = self.calls, []
+        for d, f, args, kwargs in calls:
+            defer.maybeDeferred(f, *args, **kwargs).chainDeferred(d)
+
+class ShutdownReactor(object):
+    """
+    Stands in for the reactor under a DeviceWorker or a DiskPool, on the
+    simulation's clock. What their threads send back waits until pump(),
+    which also runs whatever's due on the clock, and stop()
+    runs the shutdown triggers like the reactor does: every "before" one,
+    then it waits on the Deferreds they gave back, then "during" and
+    "after".
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.fromThreads = Queue.Queue()
+        self.triggers = {"before" : [], "during" : [], "after" : []}
+
+    def callLater(self, *args, **kwargs):
+        return self.clock.callLater(*args, **kwargs)
+
+    def seconds(self):
+        return self.clock.seconds()
+
+    def callFromThread(self, f, *args, **kwargs):
+        self.fromThreads.put((f, args, kwargs))
+
+    def addSystemEventTrigger(self, phase, eventType, f, *args, **kwargs):
+        self.triggers[phase].append((f, args, kwargs))
+
+    def pump(self, done, limitSeconds = 5):
+        """
+        Run what the threads sent back until done(), or until limitSeconds
+        of real time go by.
+        """
+        limit = time.time() + limitSeconds
+        while not done() and time.time() < limit:
+            self.clock.advance(0)
+            try:
+                f, args, kwargs = self.fromThreads.get(timeout = 0.05)
+            except Queue.Empty:
+                continue
+            f(*args, **kwargs)
+        return done()
+
+    def stop(self):
+        before = [defer.maybeDeferred(f, *args, **kwargs) for f, args, kwargs in self.triggers["before"]]
+        finished = []
+        defer.DeferredList(before).addCallback(finished.append)
+        self.pump(lambda: finished)
+        for phase in ("during", "after"):
+            for f, args, kwargs in self.triggers[phase]:
+                f(*args, **kwargs)
+
+class Simulation(object):
+    """
+    A clock set to now, a FakeU3 on it for each board, a batcher in front of
+    each of those, and a scratch directory for the config journal and RRD.
+    u3Device and d are the first board's.
+    """
+    def __init__(self, boards = (rainbot.MAIN_BOARD,)):
+        self.clock = Clock()
+        self.clock.advance(time.time())
+        self.u3Devices = {}     # board : FakeU3
+        self.devices = DevicePool()
+        for board in boards:
+            self.u3Devices[board] = FakeU3(self.clock)
+            self.devices.add(board, FeedbackBatcher(InlineWorker(self.u3Devices[board]), self.clock))
+        self.u3Device = self.u3Devices[boards[0]]
+        self.d = self.devices.get(boards[0])
+        self.directory = tempfile.mkdtemp(prefix = "rainbot-sim-")
+
+    def config(self):
+        return JournalStore(os.path.join(self.directory, rainbot.JOURNAL_NAME), self.clock, InlineWorker())
+
+    def runUntil(self, done, limitSeconds):
+        """
+        Jump the clock from timer to timer until done() or limitSeconds go by.
+        """
+        limit = self.clock.seconds() + limitSeconds
+        while not done():
+            calls = self.clock.getDelayedCalls()
+            if not calls:
+                break
+            nextTime = min(call.getTime() for call in calls)
+            if nextTime > limit:
+                break
+            self.clock.advance(max(0, nextTime - self.clock.seconds()))
+        return done()
+
+    def advance(self, seconds):
+        """
+        Like clock.advance, but every timer on the way goes off at its own
+        time instead of all at the end.
+        """
+        end = self.clock.seconds() + seconds
+        self.runUntil(lambda: False, seconds)
+        self.clock.advance(max(0, end - self.clock.seconds()))
+
+    def cleanUp(self):
+        shutil.rmtree(self.directory)
+
+def expectedZoneRelays(runTimesMinutes, settings = None, board = rainbot.MAIN_BOARD):
+    """
+    The relayLog a program of equal run times should leave on board: each
+    group's lines on together, then nothing, in the planner's order.
+    """
+    if settings is None:
+        settings = rainbot.defaultSettings()
+    relays = [()]
+    for group in rainbot.planProgram(runTimesMinutes, settings.zoneFlows, settings.supplyCapacity):
+        lines = tuple(sorted(ioNum for zoneBoard, ioNum in (settings.zoneToIonum[zone] for zone in group)
+                             if zoneBoard == board))
+        for relaySet in (lines, ()):
+            if relaySet != relays[-1]:
+                relays.append(relaySet)
+    return relays[1:]
+
+def simulateProgram():
+    """
+    A whole program, every zone, start to finish.
+    """
+    sim = Simulation()
+    try:
+        im = StatusRecorder()
+        scheduler = rainbot.Scheduler(im, sim.devices, sim.clock, sim.config())
+        runTimesMinutes = scheduler.shelveConfig["runTimesMinutes"]
+        start = sim.clock.seconds()
+        scheduler.runProgram(manual = True)
+        assert sim.runUntil(lambda: scheduler.run is None, 24 * 60 * 60), "Program never finished"
+
+        relays = [lines for when, lines in sim.u3Device.relayLog]
+        assert relays == expectedZoneRelays(runTimesMinutes), relays
+        elapsed = sim.clock.seconds() - start
+        print "Program: %d relay changes in %d USB round trips (%d commands), %s of watering" % (
+            len(relays), sim.u3Device.feedbackCount, sim.u3Device.commandCount,
+            timedelta(seconds = int(elapsed)))
+    finally:
+        sim.cleanUp()
+
+def simulatePause():
+    """
+    Pause a day, make sure nothing runs until then, and that the run after
+    that is back on the regular schedule.
+    """
+    sim = Simulation()
+    try:
+        im = StatusRecorder()
+        scheduler = rainbot.Scheduler(im, sim.devices, sim.clock, sim.config())
+        unpaused = scheduler.willRunDatetime
+        scheduler.pauseDays(1)
+        assert scheduler.willRunDatetime == unpaused + timedelta(days = 1)
+
+        assert sim.runUntil(lambda: sim.u3Device.relayLog, 10 * 24 * 60 * 60), "Never ran"
+        firstOn = sim.u3Device.relayLog[0][0]
+        assert abs(firstOn - time.mktime(scheduler.willRunDatetime.timetuple())) < 1, firstOn
+        willRun = scheduler.willRunDatetime
+        assert sim.runUntil(lambda: scheduler.run is None, 24 * 60 * 60)
+        assert scheduler.willRunDatetime == unpaused + timedelta(days = rainbot.INCREMENT_DAY)
+        print "Pause: ran at", willRun.strftime(rainbot.TIME_FORMAT), \
+              "then back on schedule for", scheduler.willRunDatetime.strftime(rainbot.TIME_FORMAT)
+    finally:
+        sim.cleanUp()
+
+def simulateStop():
+    """
+    Stop a program partway, hold and resume a zone, and hammer run zone
+    over and over. Nothing that was stopped should ever touch the relays
+    again, and there should never be more than a handful of timers.
+    """
+    sim = Simulation()
+    try:
+        im = StatusRecorder()
+        scheduler = rainbot.Scheduler(im, sim.devices, sim.clock, sim.config())
+        runTimesMinutes = scheduler.shelveConfig["runTimesMinutes"]
+        scheduler.runProgram(manual = True)
+        sim.advance(60 * (runTimesMinutes[1] + 1))
+        scheduler.stopProgram()
+        sim.advance(0) # Let the batcher send the all off
+        relays = len(sim.u3Device.relayLog)
+        sim.advance(24 * 60 * 60)
+        assert scheduler.run is None and len(sim.u3Device.relayLog) == relays, sim.u3Device.relayLog[relays:]
+
+        heldFor = 60 * 60
+        scheduler.runZone(4, 10)
+        sim.advance(3 * 60)
+        assert scheduler.holdProgram()
+        sim.advance(heldFor)
+        assert scheduler.resumeProgram()
+        assert sim.runUntil(lambda: scheduler.run is None, 60 * 60), "Zone never finished"
+        log = sim.u3Device.relayLog[relays:]
+        onFor = sum(log[i + 1][0] - log[i][0] for i in range(0, len(log), 2))
+        zoneLines = (rainbot.ZONE_TO_IONUM[4][1],)
+        assert [lines for when, lines in log] == [zoneLines, (), zoneLines, ()] and onFor == 10 * 60, log
+
+        for i in range(500):
+            scheduler.runZone(1 + i % 12, 5)
+            sim.advance(0.1)
+        timers = len(sim.clock.getDelayedCalls())
+        assert timers <= 5, sim.clock.getDelayedCalls()
+        scheduler.turnOff()
+        sim.advance(0)
+        relays = len(sim.u3Device.relayLog)
+        sim.advance(7 * 24 * 60 * 60)
+        assert len(sim.u3Device.relayLog) == relays, sim.u3Device.relayLog[relays:]
+        print "Stop: stopped, held for %s and resumed, 500 zone runs left %d timers" % (
+            timedelta(seconds = heldFor), timers)
+    finally:
+        sim.cleanUp()
+
+def simulateShadow():
+    """
+    Every relay off and nothing should go out for an all off, even after
+    the resyncs read back a CIO that only has 4 lines. Then the U3 browns
+    out and comes back with every line an input. Within a couple of
+    resyncs the batcher should notice, and the next zone should really
+    come on.
+    """
+    import device
+
+    sim = Simulation()
+    try:
+        im = StatusRecorder()
+        sim.devices.broadcast(rainbot.ALL_OFF_COMMAND) # Like connectionMade
+        scheduler = rainbot.Scheduler(im, sim.devices, sim.clock, sim.config())
+        sim.advance(2 * device.SHADOW_RESYNC_PERIOD)
+        shadow = sim.devices.get(rainbot.MAIN_BOARD).shadow
+        for command in device.RESYNC_COMMAND:
+            snapshot = shadow.snapshot()
+            wrong = shadow.check(snapshot, command, sim.u3Device.getFeedback(command)[0])
+            assert wrong == 0, "%d lines drifted with nothing touching them" % wrong
+        commands = sim.u3Device.commandCount
+        scheduler.turnOffAllZones()
+        sim.advance(0)
+        assert sim.u3Device.commandCount == commands, sim.u3Device.commandCount - commands
+
+        sim.u3Device.directions = [0] * len(sim.u3Device.directions)
+        sim.advance(2 * device.SHADOW_RESYNC_PERIOD)
+        scheduler.runZone(5, 1)
+        sim.advance(1)
+        zoneLines = (rainbot.ZONE_TO_IONUM[5][1],)
+        assert sim.u3Device.relaysOn() == zoneLines, sim.u3Device.relaysOn()
+        assert sim.runUntil(lambda: scheduler.run is None, 60 * 60), "Zone never finished"
+        print "Shadow: all off with nothing on sent nothing, zone came on after a brownout"
+    finally:
+        sim.cleanUp()
+
+def simulateBoards():
+    """
+    24 zones across two boards, odd zones on one and even on the other, with
+    enough water for two at a time. Each board should only ever see its own
+    zones, and both should be watering at once.
+    """
+    boards = (320000001, 320000002)
+    zones = dict((str(zone), [boards[(zone - 1) % 2], 8 + (zone - 1) // 2]) for zone in range(1, 25))
+    boardSettings = parseSettings(json.dumps({"zones" : zones, "supplyCapacity" : 2}),
+                                  rainbot.defaultSettings())
+    for bad in [{"zones" : {"1" : [None, 19], "13" : [boards[0], 19]}},
+                {"zones" : {"1" : [None, True]}},
+                {"zones" : {"1" : [False, 19]}},
+                {"moistureSensors" : {"all" : True}}]:
+        try:
+            parseSettings(json.dumps(bad), rainbot.defaultSettings())
+        except SettingsError:
+            pass
+        else:
+            raise AssertionError("Took %s" % json.dumps(bad))
+    sim = Simulation(boards)
+    try:
+        im = StatusRecorder()
+        scheduler = rainbot.Scheduler(im, sim.devices, sim.clock, sim.config(), settings = boardSettings)
+        runTimesMinutes = scheduler.shelveConfig["runTimesMinutes"]
+        assert sorted(runTimesMinutes) == range(1, 25), runTimesMinutes
+        scheduler.runProgram(manual = True)
+        assert sim.runUntil(lambda: scheduler.run is None, 24 * 60 * 60), "Program never finished"
+
+        for board in boards:
+            relays = [lines for when, lines in sim.u3Devices[board].relayLog]
+            assert relays == expectedZoneRelays(runTimesMinutes, boardSettings, board), (board, relays)
+        onTimes = [[when for when, lines in sim.u3Devices[board].relayLog if lines] for board in boards]
+        assert onTimes[0] == onTimes[1], onTimes
+        print "Boards: %d zones on %d boards, %s" % (len(runTimesMinutes), len(boards), ", ".join(
+            "%s %d USB round trips" % (board, sim.u3Devices[board].feedbackCount) for board in boards))
+    finally:
+        sim.cleanUp()
+
+def simulateReload():
+    """
+    Change the start hour and move every zone to different lines in the
+    middle of a program. The program should finish on the old lines, and the
+    next run should move to the new hour.
+    """
+    sim = Simulation()
+    try:
+        im = StatusRecorder()
+        scheduler = rainbot.Scheduler(im, sim.devices, sim.clock, sim.config())
+        runTimesMinutes = scheduler.shelveConfig["runTimesMinutes"]
+        path = os.path.join(sim.directory, SETTINGS_FILE)
+        watcher = SettingsWatcher(path, rainbot.defaultSettings(), scheduler.applySettings, sim.clock)
+        watcher.startPolling()
+
+        scheduler.runProgram(manual = True)
+        sim.runUntil(lambda: False, 10 * 60)
+        zones = dict((str(zone), [None, 19 - ioNum]) for zone, (board, ioNum) in rainbot.ZONE_TO_IONUM.items())
+        with open(path, "w") as f:
+            f.write(json.dumps({"startHour" : 6, "zones" : zones}))
+        with open(path + ".bad", "w") as f:
+            f.write("{not json") # Not the settings file, so nobody should care
+        assert sim.runUntil(lambda: scheduler.run is None, 24 * 60 * 60), "Program never finished"
+        watcher.stop()
+
+        relays = [lines for when, lines in sim.u3Device.relayLog]
+        assert relays == expectedZoneRelays(runTimesMinutes), relays
+        assert scheduler.settings.zoneToIonum[1] == (None, 0), scheduler.settings.zoneToIonum
+        assert scheduler.willRunDatetime.hour == 6, scheduler.willRunDatetime
+        print "Reload: program finished on the old lines, next run at", \
+              scheduler.willRunDatetime.strftime(rainbot.TIME_FORMAT)
+    finally:
+        sim.cleanUp()
+
+def simulateSessions():
+    """
+    Two people talking to the bot at once. One's command has to wait on a
+    Deferred, which should hold up only that person's next command. Every
+    reply has to go back to whoever sent the command.
+    """
+    from twisted.words.xish import domish
+    from commands import CommandRegistry
+
+    class SessionBot(rainbot.RainBotProtocol):
+        commands = CommandRegistry()
+        commands.register("slow", "handleSlow")
+        commands.register("echo", "handleEcho")
+
+        def handleSlow(self, session, msgTokens):
+            session.sendText("slow started")
+            self.pending = defer.Deferred()
+            return self.pending.addCallback(lambda ignored: session.sendText("slow done"))
+
+        def handleEcho(self, session, msgTokens):
+            self.ran.append((session.jid, msgTokens[1]))
+            session.sendText("echo " + msgTokens[1])
+
+        def _sendMessage(self, recipient, responseText):
+            self.sent.append((recipient, responseText))
+
+    def message(sender, body):
+        msg = domish.Element((None, "message"))
+        msg["type"] = "chat"
+        msg["from"] = sender
+        msg.addElement("body", content = body)
+        bot.onMessage(msg)
+
+    clock = Clock()
+    bot = SessionBot(clock)
+    bot.sent = []
+    bot.ran = []
+    alice, bob = "alice@example.com/phone", "bob@example.com/laptop"
+    message(alice, "slow")
+    message(bob, "echo 1")
+    message(alice, "echo 2")     # Waits for alice's slow
+    message(bob, "echo 3")       # Doesn't
+    assert bot.ran == [(bob, "1"), (bob, "3")], bot.ran
+    bot.pending.callback(None)
+    assert bot.ran == [(bob, "1"), (bob, "3"), (alice, "2")], bot.ran
+    assert not bot.sessions, bot.sessions # Nobody left with anything queued
+    clock.advance(10)
+    replies = {}
+    for recipient, text in bot.sent:
+        replies.setdefault(recipient, []).extend(text.split("\n"))
+    assert replies == {alice : ["slow started", "slow done", "echo 2"],
+                       bob : ["echo 1", "echo 3"]}, bot.sent
+    print "Sessions: bob's commands ran while alice's waited, and every reply went back to its sender"
+
+def simulateJournal():
+    """
+    The power goes out in the middle of a config write, twice: once partway
+    through a record and once leaving junk after the last one. Both times
+    everything up to the last whole record has to come back.
+    """
+    sim = Simulation()
+    try:
+        config = sim.config()
+        config["runTimesMinutes"] = {1 : 7, 2 : 5}
+        config["onState"] = True
+        sim.clock.advance(0)
+        config["runTimesMinutes"] = {1 : 9, 2 : 5}
+        del config["onState"]
+        sim.clock.advance(0)
+        goodBytes = os.path.getsize(config.path)
+
+        config.journal.write(journal._encodeRecord("runTimesMinutes", "x" * 40)[:-10]) # Cut off
+        config.journal.flush()
+        config.close()
+        config = sim.config()
+        assert config["runTimesMinutes"] == {1 : 9, 2 : 5}, config["runTimesMinutes"]
+        assert "onState" not in config and len(config) == 1, config.keys()
+        assert os.path.getsize(config.path) == goodBytes, (os.path.getsize(config.path), goodBytes)
+
+        config["lastRun"] = 12
+        sim.clock.advance(0)
+        config.journal.write(journal.RECORD_HEADER.pack(20, 1234) + "\xff" * 20) # Doesn't check out
+        config.journal.flush()
+        config.close()
+        config = sim.config()
+        assert config["lastRun"] == 12 and config["runTimesMinutes"] == {1 : 9, 2 : 5}, dict(
+            (key, config[key]) for key in config)
+        config.close()
+        print "Journal: came back to the last whole record after a torn write and after junk"
+    finally:
+        sim.cleanUp()
+
+def simulateMigration():
+    """
+    The first start after upgrading, bringing the old shelve over into the
+    journal. openConfig() runs on a thread then, so it can't touch the
+    clock at all.
+    """
+    import shelve
+
+    class NoClock(object):
+        def callLater(self, *args, **kwargs):
+            raise AssertionError("openConfig() used the clock")
+
+    sim = Simulation()
+    oldDirectory = os.getcwd()
+    os.chdir(sim.directory) # SHELVE_NAME and JOURNAL_NAME are relative
+    try:
+        legacyConfig = shelve.open(rainbot.SHELVE_NAME)
+        legacyConfig["runTimesMinutes"] = {1 : 3, 2 : 4}
+        legacyConfig["onState"] = False
+        legacyConfig.close()
+        config = rainbot.openConfig(NoClock())
+        assert config["runTimesMinutes"] == {1 : 3, 2 : 4} and config["onState"] is False
+        config = JournalStore(rainbot.JOURNAL_NAME, sim.clock, InlineWorker())
+        assert sorted(config.keys()) == ["onState", "runTimesMinutes"], config.keys()
+        config.close()
+        print "Migration: the old shelve came over without touching the clock"
+    finally:
+        os.chdir(oldDirectory)
+        sim.cleanUp()
+
+def simulateCompaction():
+    """
+    Fill the journal until it compacts, and keep assigning while the
+    compacted copy is being written and swapped in. Nothing assigned in
+    between can get lost, and the journal has to come out smaller.
+    """
+    oldMinBytes = journal.COMPACT_MIN_BYTES
+    journal.COMPACT_MIN_BYTES = 4096
+    sim = Simulation()
+    try:
+        disk = HeldDisk()
+        path = os.path.join(sim.directory, rainbot.JOURNAL_NAME)
+        config = JournalStore(path, sim.clock, disk)
+        for count in xrange(1000):
+            config["count"] = count
+            sim.clock.advance(0)
+            disk.release()
+            if config.compacting is not None:
+                break
+        assert config.compacting is not None, "Never compacted"
+        bigBytes = config.journalBytes
+
+        config["count"] = "while compacting"
+        config["zone"] = 4
+        sim.clock.advance(0)
+        disk.release() # The compacted copy, then the writes queued behind it
+        assert config.compacting is None, "Compaction didn't finish"
+        config["zone"] = 5 # While it's being swapped in
+        sim.clock.advance(0)
+        while disk.calls:
+            disk.release()
+        assert not os.path.exists(config.compactPath)
+        config.close()
+        disk.release()
+
+        config = sim.config()
+        assert config["count"] == "while compacting" and config["zone"] == 5, (config["count"], config["zone"])
+        assert config.journalBytes < bigBytes, (config.journalBytes, bigBytes)
+        config.close()
+        print "Compaction: journal went from %d to %d bytes with writes going on" % (bigBytes, config.journalBytes)
+    finally:
+        journal.COMPACT_MIN_BYTES = oldMinBytes
+        sim.cleanUp()
+
+def simulateHistory():
+    """
+    A program and then a manual zone, logged. Nothing gets written until
+    the disk gets to it, and a query queued after the events still sees
+    them. The usage should add up, and still add up after a restart with
+    half an event on the end of the log.
+    """
+    import history
+
+    sim = Simulation()
+    try:
+        im = StatusRecorder()
+        disk = HeldDisk()
+        historyLog = history.HistoryLog(os.path.join(sim.directory, history.HISTORY_NAME), disk)
+        scheduler = rainbot.Scheduler(im, sim.devices, sim.clock, sim.config(), history = historyLog)
+        runTimesMinutes = scheduler.shelveConfig["runTimesMinutes"]
+        start = sim.clock.seconds()
+        scheduler.runProgram(manual = True)
+        assert sim.runUntil(lambda: scheduler.run is None, 24 * 60 * 60), "Program never finished"
+        scheduler.runZone(4, 3)
+        assert sim.runUntil(lambda: scheduler.run is None, 60 * 60), "Zone never finished"
+        end = sim.clock.seconds()
+        assert os.path.getsize(historyLog.path) == 0, "History written on the reactor"
+        results = []
+        historyLog.usage(start, end).addCallback(results.append)
+        assert not results, "Usage read on the reactor"
+        disk.release()
+        assert results and results[0][4] == ((runTimesMinutes[4] + 3) * 60, 2), results
+
+        historyLog.log.write("\0" * 5) # Power went out mid-write
+        historyLog.close()
+        disk.release()
+        historyLog = history.HistoryLog(historyLog.path, InlineWorker())
+        usage = []
+        historyLog.usage(start, end).addCallback(usage.append)
+        usage = usage[0]
+        assert usage[4] == ((runTimesMinutes[4] + 3) * 60, 2), usage[4]
+        assert sum(runs for seconds, runs in usage.values()) == len(runTimesMinutes) + 1, usage
+        events = []
+        historyLog.events(start).addCallback(events.extend)
+        manual = [zone for when, kind, zone, isManual, number in events
+                  if kind == history.ZONE_ON and isManual]
+        assert manual == range(1, 13) + [4], manual
+        print "History: %d events, zone 4 ran %d minutes in %d runs" % (
+            historyLog.count, usage[4][0] / 60, usage[4][1])
+    finally:
+        sim.cleanUp()
+
+def simulateDoors():
+    """
+    Open and close the big door under LiftBot, with a JID subscribed to
+    alerts after 2 minutes and a socket listener subscribed to just the
+    changes. The JID subscribes from one client and unsubscribes from
+    another.
+    """
+    import liftbot
+    from doorevents import DoorEvents
+
+    class SimLiftBot(liftbot.LiftBotProtocol):
+        def setStatus(self, statusText, show = None):
+            self.statuses.append(statusText)
+
+    class Listener(object):
+        def __init__(self):
+            self.lines = []
+
+        def sendLine(self, line):
+            self.lines.append(json.loads(line))
+
+    sim = Simulation()
+    try:
+        bot = SimLiftBot(sim.clock)
+        bot.statuses = []
+        bot.d = sim.d
+        sent = []
+        bot.doorEvents = DoorEvents(lambda jid, text: sent.append((jid, json.loads(text))),
+                                    os.path.join(sim.directory, "subscribers.json"), sim.clock, InlineWorker())
+        bot.doorEvents.subscribe("me@example.com/phone", 2)
+        assert bot.doorEvents.describe("me@example.com/laptop").endswith("after 2 minutes open.")
+        listener = Listener()
+        bot.doorEvents.listen(listener)
+        sim.u3Device.setInput(liftbot.BIG_DOOR_SENSOR, 0)
+        sim.u3Device.setInput(liftbot.LITTLE_DOOR_SENSOR, 0)
+        bot.connectionMade()
+        sim.clock.advance(0)
+        sim.runUntil(lambda: False, 60 * 60)
+        reads = sim.u3Device.feedbackCount
+        opened = sim.clock.seconds()
+        sim.u3Device.setInput(liftbot.BIG_DOOR_SENSOR, 1)
+        sim.runUntil(lambda: False, 3 * 60)
+        sim.u3Device.setInput(liftbot.BIG_DOOR_SENSOR, 0)
+        sim.runUntil(lambda: False, 60)
+        sim.u3Device.setInput(liftbot.BIG_DOOR_SENSOR, 1)
+        sim.runUntil(lambda: False, 1) # A glitch, not a door
+        sim.u3Device.setInput(liftbot.BIG_DOOR_SENSOR, 0)
+        sim.runUntil(lambda: False, 60)
+        bot.stopPolling()
+        bot.doorEvents.stop()
+        assert bot.statuses == ["Doors closed", "Big door open", "Doors closed"], bot.statuses
+        events = [event["event"] for jid, event in sent]
+        assert events == ["opened", "left open", "closed"], sent
+        assert [line["event"] for line in listener.lines] == ["opened", "closed"], listener.lines
+        assert sent[0][1]["time"] - opened <= liftbot.SLOW_SAMPLE_PERIOD, (sent[0], opened)
+        assert sent[1][1]["openSeconds"] == 2 * 60 and sent[2][1]["openSeconds"] >= 2 * 60, sent
+        assert set(jid for jid, event in sent) == set(["me@example.com"]), sent
+        assert json.load(open(bot.doorEvents.path)) == {"me@example.com" : 2}
+        assert bot.doorEvents.unsubscribe("me@example.com/laptop"), "Other client couldn't unsubscribe"
+        assert bot.doorEvents.jids == {}, bot.doorEvents.jids
+        with open(bot.doorEvents.path, "w") as f:
+            json.dump({"me@example.com/phone" : 2}, f) # From before they were bare
+        loaded = DoorEvents(None, bot.doorEvents.path, sim.clock, InlineWorker())
+        assert loaded.jids == {"me@example.com" : 2}, loaded.jids
+        print "Doors:", " -> ".join(bot.statuses), "(%d USB reads the first idle hour)" % reads
+        print "Door events:", ", ".join(events), "after %d seconds open" % sent[2][1]["openSeconds"]
+    finally:
+        sim.cleanUp()
+
+def simulateMoisture(days = 7):
+    """
+    A week of readings from the sensor for every zone and zone 2's own,
+    through the sampler and into a real RRD. Both have to come in with one
+    trip over USB each time. Sensors that would take over a zone's relay or
+    a door line on the same board have to be turned down first.
+    """
+    import liftbot
+    import moisture
+
+    sensors = {None : 0, 2 : 3}
+    zoneToIonum = rainbot.defaultSettings().zoneToIonum
+    checkMoistureLines(zoneToIonum, sensors, rainbot.MAIN_BOARD, liftbot.DOOR_LINES)
+    for badSensors, badZones in [({None : 0, 2 : liftbot.BIG_DOOR_BUTTON}, zoneToIonum),
+                                 (sensors, dict(zoneToIonum.items() + [(13, (rainbot.MAIN_BOARD, 3))]))]:
+        try:
+            checkMoistureLines(badZones, badSensors, rainbot.MAIN_BOARD, liftbot.DOOR_LINES)
+        except SettingsError:
+            pass
+        else:
+            raise AssertionError("Took a moisture sensor on a line that's in use")
+
+    sim = Simulation()
+    oldDirectory = os.getcwd()
+    os.chdir(sim.directory) # RRD_NAME is relative
+    try:
+        sim.u3Device.setVoltage(0, 1.2)
+        sim.u3Device.setVoltage(3, 0.8)
+        shutdownReactor = ShutdownReactor(sim.clock)
+        sampler = moisture.MoistureSampler(sim.d, sensors, sim.clock, InlineWorker(), shutdownReactor)
+        sampler.start()
+        samples = days * 24 * 60 * 60 // moisture.SAMPLE_PERIOD
+        sim.advance(samples * moisture.SAMPLE_PERIOD)
+        sampler.sampleLoop.stop()
+        shutdownReactor.stop() # Writes out what's still buffered
+        assert not sampler.unwritten, sampler.unwritten
+        assert abs(sampler.aggregates[None]["1w"].mean() - 1.2) < 0.001, sampler.summary("1w")
+        assert abs(sampler.aggregates[2]["1w"].mean() - 0.8) < 0.001, sampler.summary("1w", 2)
+        assert sim.u3Device.feedbackCount == samples, (sim.u3Device.feedbackCount, samples)
+        print "Moisture:", sampler.summary("1w"), sampler.summary("1w", 2)
+        print "Moisture: %d readings from %d sensors in %d USB round trips" % (samples, len(sampler.zones),
+                                                                              sim.u3Device.feedbackCount)
+    finally:
+        os.chdir(oldDirectory)
+        sim.cleanUp()
+
+def simulateWetSoil():
+    """
+    Let the soil read wet. With the settings as they come nothing changes.
+    Once they turn moistureAdjust on, make sure the scheduled run gets
+    skipped, then dry it out and make sure the next one runs long, by the
+    limits in the settings.
+    """
+    import moisture
+    import adjuster
+
+    for bad in [{"moistureAdjust" : {"wetVolts" : 0.5, "dryVolts" : 0.6}},
+                {"moistureAdjust" : {"wetVolts" : True}},
+                {"moistureAdjust" : {"wet" : 1.0}},
+                {"moistureAdjust" : 1}]:
+        try:
+            parseSettings(json.dumps(bad), rainbot.defaultSettings())
+        except SettingsError:
+            pass
+        else:
+            raise AssertionError("Took %s" % json.dumps(bad))
+    adjustSettings = parseSettings(json.dumps({"moistureAdjust" : {"wetVolts" : 1.3, "dryVolts" : 0.6}}),
+                                   rainbot.defaultSettings())
+
+    sim = Simulation()
+    oldDirectory = os.getcwd()
+    os.chdir(sim.directory) # RRD_NAME is relative
+    try:
+        sim.u3Device.setVoltage(0, 1.5)
+        sampler = moisture.MoistureSampler(sim.d, {None : 0}, sim.clock, InlineWorker(), ShutdownReactor(sim.clock))
+        sampler.start()
+        im = StatusRecorder()
+        scheduler = rainbot.Scheduler(im, sim.devices, sim.clock, sim.config(),
+                                      adjuster.WateringAdjuster(sampler.trend, sim.clock))
+        sim.advance(moisture.SAMPLE_PERIOD)
+        assert sampler.trend.level is not None, "No readings"
+        assert not scheduler.adjusting(), "Adjusting without being asked to"
+        assert scheduler.programRunTimes(True) == scheduler.programRunTimes(False)
+        scheduler.applySettings(adjustSettings)
+        assert scheduler.adjusting() and not any(scheduler.programRunTimes(True).values())
+        skipped = scheduler.willRunDatetime
+        sim.runUntil(lambda: scheduler.willRunDatetime != skipped, 10 * 24 * 60 * 60)
+        assert not sim.u3Device.relayLog, sim.u3Device.relayLog
+        assert im.statuses[-1].startswith("Skipped"), im.statuses[-1]
+
+        sim.u3Device.setVoltage(0, 0.45)
+        assert sim.runUntil(lambda: sim.u3Device.relayLog, 10 * 24 * 60 * 60), "Never ran"
+        scale = scheduler.adjuster.scale(1, scheduler.settings.moistureAdjust)
+        assert scale != scheduler.adjuster.scale(1), "Didn't use the limits from the settings"
+        assert sim.runUntil(lambda: scheduler.run is None, 24 * 60 * 60), "Program never finished"
+        sampler.sampleLoop.stop()
+        onFor = sim.u3Device.relayLog[1][0] - sim.u3Device.relayLog[0][0]
+        expected = round(scheduler.shelveConfig["runTimesMinutes"][1] * scale) * 60
+        assert scale > 1 and onFor == expected, (scale, onFor)
+        print "Wet soil: skipped", skipped.strftime(rainbot.TIME_FORMAT) + ", then ran zones x%.2f when dry" % scale
+    finally:
+        os.chdir(oldDirectory)
+        sim.cleanUp()
+
+def simulateWetRun():
+    """
+    Somebody sends "run" while the soil reads wet. They asked for it, so it
+    has to run every zone for its time as set, not get skipped.
+    """
+    import adjuster
+    import moisture
+
+    class Replies(object):
+        jid = "me@example.com/phone"
+
+        def __init__(self):
+            self.texts = []
+
+        def sendText(self, text):
+            self.texts.append(text)
+
+    sim = Simulation()
+    try:
+        trend = moisture.MoistureTrend()
+        trend.addSample(sim.clock.seconds(), 1.5)
+        im = StatusRecorder()
+        bot = rainbot.RainBotProtocol(sim.clock)
+        bot.scheduler = rainbot.Scheduler(im, sim.devices, sim.clock, sim.config(),
+                                          adjuster.WateringAdjuster(trend, sim.clock),
+                                          parseSettings('{"moistureAdjust": true}', rainbot.defaultSettings()))
+        assert not any(bot.scheduler.programRunTimes(True).values()), "Soil isn't wet"
+        runTimesMinutes = bot.scheduler.programRunTimes(False)
+        session = Replies()
+        bot.commands.dispatch(bot, session, ["run"])
+        assert bot.scheduler.run is not None, im.statuses
+        assert sim.runUntil(lambda: bot.scheduler.run is None, 24 * 60 * 60), "Program never finished"
+        assert not any(status.startswith("Skipped") for status in im.statuses), im.statuses
+        relays = [lines for when, lines in sim.u3Device.relayLog]
+        assert relays == expectedZoneRelays(runTimesMinutes), relays
+        onFor = sim.u3Device.relayLog[1][0] - sim.u3Device.relayLog[0][0]
+        assert onFor == runTimesMinutes[1] * 60, onFor
+        print "Wet run: \"run\" in the chat ran all %d zones for their full times on wet soil" % len(runTimesMinutes)
+    finally:
+        sim.cleanUp()
+
+def simulateStatus():
+    """
+    Started up turned off, then a manual program. Nothing's ever been
+    scheduled, so /status has to say willRun is null during the run and
+    after it instead of falling over.
+    """
+    import webstatus
+
+    sim = Simulation()
+    try:
+        im = StatusRecorder()
+        config = sim.config()
+        config["onState"] = False
+        bot = rainbot.RainBotProtocol(sim.clock)
+        bot.scheduler = rainbot.Scheduler(im, sim.devices, sim.clock, config)
+        snapshot = webstatus.StatusSnapshot(bot, clock = sim.clock)
+        bot.scheduler.runProgram(manual = True)
+        running = json.loads(snapshot.get())
+        assert running["state"] == "running manual" and running["willRun"] is None, running
+        assert sim.runUntil(lambda: bot.scheduler.run is None, 24 * 60 * 60), "Program never finished"
+        snapshot.invalidate()
+        done = json.loads(snapshot.get())
+        assert done["willRun"] is None and done["zoneTimes"] == [], done
+        assert done["moistureAdjust"] == "off", done
+        print "Status: willRun was %s while running and %s after, with nothing scheduled" % (
+            json.dumps(running["willRun"]), json.dumps(done["willRun"]))
+    finally:
+        sim.cleanUp()
+
+def simulateShutdown():
+    """
+    Shut down in the middle of a zone, with a real worker thread in front
+    of the U3 and the config on a real disk pool like rainbot.tac has. The
+    relay has to be off and a change made right before has to be in the
+    journal by the time the reactor's done, and anything sent after that
+    still has to get to the U3 and the disk.
+    """
+    sim = Simulation()
+    try:
+        shutdownReactor = ShutdownReactor(sim.clock)
+        u3Device = FakeU3(sim.clock)
+        worker = DeviceWorker(u3Device, shutdownReactor)
+        devices = DevicePool()
+        devices.add(rainbot.MAIN_BOARD, FeedbackBatcher(worker, sim.clock))
+        bot = rainbot.RainBotProtocol(sim.clock)
+        bot.devices = devices
+        pool = DiskPool(reactor = shutdownReactor)
+        bot.config = JournalStore(os.path.join(sim.directory, rainbot.JOURNAL_NAME), sim.clock, DiskQueue(pool))
+        bot.connectionMade()
+        shutdownReactor.addSystemEventTrigger("before", "shutdown", bot.shutDown) # Like rainbot.tac
+        bot.scheduler.runZone(1, 10)
+        sim.clock.advance(0)
+        zoneLines = (rainbot.ZONE_TO_IONUM[1][1],)
+        assert shutdownReactor.pump(lambda: u3Device.relaysOn() == zoneLines), u3Device.relaysOn()
+        runTimesMinutes = bot.config["runTimesMinutes"]
+        runTimesMinutes[2] = 9
+        bot.config["runTimesMinutes"] = runTimesMinutes # Like "2 9" right before
+        bot.config.sync()
+
+        shutdownReactor.stop()
+        assert u3Device.relaysOn() == (), "Relays on at exit: %r" % (u3Device.relaysOn(),)
+        assert bot.config.journal is None, "Config wasn't closed before the disk pool stopped"
+        assert sim.config()["runTimesMinutes"][2] == 9, "Lost the last change"
+        late = []
+        worker.call(u3Device.relaysOn).addCallback(late.append)
+        pool.call(lambda: "written").addCallback(late.append)
+        assert late == [(), "written"], late
+        print "Shutdown: zone 1 was on, every relay was off and the config closed by the time the reactor stopped"
+    finally:
+        sim.cleanUp()
+
+def simulateRestart():
+    """
+    Kill the process partway into zone 2 of a program and start a new
+    Scheduler on the same journal. Back ten minutes later, zone 2 should
+    get just the rest of its time and the rest of the program should
+    follow. Back three days later, nothing from that program should run.
+    """
+    sim = Simulation()
+    try:
+        scheduler = rainbot.Scheduler(StatusRecorder(), sim.devices, sim.clock, sim.config())
+        runTimesMinutes = scheduler.shelveConfig["runTimesMinutes"]
+        zoneLine = lambda zone: (rainbot.ZONE_TO_IONUM[zone][1],)
+        scheduler.runProgram(manual = True)
+        assert sim.runUntil(lambda: sim.u3Device.relaysOn() == zoneLine(2), 60 * 60), "Zone 2 never came on"
+        sim.advance(3.5 * 60)
+        killedAt = sim.clock.seconds()
+        path = scheduler.shelveConfig.path
+
+        for downSeconds in (10 * 60, 3 * 24 * 60 * 60):
+            restart = Simulation()
+            try:
+                restart.clock.advance(killedAt + downSeconds - restart.clock.seconds())
+                shutil.copy(path, os.path.join(restart.directory, rainbot.JOURNAL_NAME)) # As the kill left it
+                config = restart.config()
+                restarted = rainbot.Scheduler(StatusRecorder(), restart.devices, restart.clock, config)
+                if downSeconds > rainbot.RESUME_GRACE_SECONDS:
+                    assert restarted.run is None and "timeline" not in config, "Picked up a stale program"
+                    assert restart.u3Device.relayLog == [], restart.u3Device.relayLog
+                    continue
+                assert restart.runUntil(lambda: restarted.run is None, 24 * 60 * 60), "Program never finished"
+                relays = [lines for when, lines in restart.u3Device.relayLog]
+                rest = dict((zone, minutes) for zone, minutes in runTimesMinutes.items() if zone >= 2)
+                assert relays == expectedZoneRelays(rest), relays
+                onFor = restart.u3Device.relayLog[1][0] - restart.u3Device.relayLog[0][0]
+                leftAtKill = runTimesMinutes[2] * 60 - 3.5 * 60
+                assert leftAtKill <= onFor <= leftAtKill + rainbot.TIMELINE_CHECKPOINT_SECONDS, onFor
+                config.close()
+            finally:
+                restart.cleanUp()
+        print "Restart: zone 2 got the last %d seconds of its %d minutes, and a 3 day old program was dropped" % (
+            onFor, runTimesMinutes[2])
+    finally:
+        sim.cleanUp()
+
+if __name__ == "__main__":
+    simulateProgram()
+    simulatePause()
+    simulateStop()
+    simulateShadow()
+    simulateBoards()
+    simulateReload()
+    simulateSessions()
+    simulateJournal()
+    simulateMigration()
+    simulateCompaction()
+    simulateHistory()
+    simulateDoors()
+    simulateMoisture()
+    simulateWetSoil()
+    simulateWetRun()
+    simulateStatus()
+    simulateShutdown()
+    simulateRestart()
@@ -0,0 +1,44 @@
+import time
+
+from stats import STATS
+
+class StartupTimer(object):
+    """
+    Notes how long after started each stage of startup finished, and prints
+    the lot once every stage in expected has. Each stage also goes in STATS
+    as "startup <stage>", so "stats" has it too.
+
+    Only the first mark for a stage counts. Reconnecting later isn't
+    starting up.
+    """
+    def __init__(self, started, expected):
+        self.started = started
+        self.expected = list(expected)
+        self.marks = []         # (stage, seconds), in the order they finished
+        self.reported = False
+
+    def mark(self, stage):
+        if stage in [markedStage for markedStage, seconds in self.marks]:
+            return
+        seconds = time.time() - self.started
+        self.marks.append((stage, seconds))
+        STATS.record("startup " + stage, seconds)
+        if not self.reported and self.done():
+            self.reported = True
+            print self.report()
+
+    def markWhenDone(self, stage, d):
+        """
+        mark(stage) when d fires, and pass its result along.
+        """
+        def finished(result):
+            self.mark(stage)
+            return result
+        return d.addCallback(finished)
+
+    def done(self):
+        marked = [stage for stage, seconds in self.marks]
+        return all(stage in marked for stage in self.expected)
+
+    def report(self):
+        return "Startup: " + ", ".join("%s %.2fs" % (stage, seconds) for stage, seconds in self.marks)
@@ -0,0 +1,139 @@
+import threading
+import time
+from bisect import bisect_left
+
+from twisted.internet import reactor, defer
+from twisted.internet.task import LoopingCall
+
+# Histogram bucket upper bounds in seconds, 1-2-5 steps from 100 us to a
+# minute. Anything slower goes in one last bucket.
+BUCKETS = [m * 10 ** e for e in range(-4, 2) for m in (1, 2, 5)]
+
+# How often to check how late the reactor is, and to write STATS_FILE.
+LAG_PERIOD = 1
+DUMP_PERIOD = 600
+STATS_FILE = "rainbot-stats.txt"
+
+class Histogram(object):
+    """
+    Counts of how long something took, in BUCKETS. Cheap to add to, and
+    good enough to read percentiles off of.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """
+        The upper bound of the bucket the pth percentile falls in.
+        """
+        if not self.count:
+            return None
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= p / 100.0 * self.count:
+                if i < len(BUCKETS):
+                    return BUCKETS[i]
+                return self.max
+        return self.max
+
+class Stats(object):
+    """
+    A Histogram per operation, by name. record() can be called from any
+    thread, like the device worker.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self.lock:
+            try:
+                histogram = self.histograms[name]
+            except KeyError:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def timed(self, name, f, *args, **kwargs):
+        """
+        Call f(*args, **kwargs) and record how long it took. If it returns a
+        Deferred, that's until the Deferred fires.
+        """
+        start = time.time()
+        try:
+            result = f(*args, **kwargs)
+        except:
+            self.record(name, time.time() - start)
+            raise
+        if isinstance(result, defer.Deferred):
+            def done(passThrough):
+                self.record(name, time.time() - start)
+                return passThrough
+            return result.addBoth(done)
+        self.record(name, time.time() - start)
+        return result
+
+    def report(self):
+        with self.lock:
+            names = sorted(self.histograms)
+            lines = []
+            for name in names:
+                histogram = self.histograms[name]
+                lines.append("%s: n=%d p50=%s p99=%s max=%s" % (name, histogram.count,
+                                                               _ms(histogram.percentile(50)),
+                                                               _ms(histogram.percentile(99)),
+                                                               _ms(histogram.max)))
+        if not lines:
+            return "No stats yet"
+        return "\n".join(lines)
+
+    def dump(self, path = STATS_FILE):
+        with open(path, "w") as f:
+            f.write(time.strftime("%Y-%m-%d %H:%M:%S") + "\n" + self.report() + "\n")
+
+# Everybody records into this one.
+STATS = Stats()
+
+class LagMonitor(object):
+    """
+    Wakes up every LAG_PERIOD and records how much later than that it
+    actually got to run, which is how long something held up the reactor.
+    """
+    def __init__(self, clock = reactor, stats = STATS):
+        self.clock = clock
+        self.stats = stats
+        self.lastTime = None
+        self.loop = LoopingCall(self.check)
+        self.loop.clock = clock
+
+    def start(self):
+        self.lastTime = self.clock.seconds()
+        self.loop.start(LAG_PERIOD, now = False)
+
+    def check(self):
+        now = self.clock.seconds()
+        self.stats.record("reactor lag", max(0, now - self.lastTime - LAG_PERIOD))
+        self.lastTime = now
+
+def startMonitoring(clock = reactor, stats = STATS):
+    """
+    Start watching reactor lag and writing STATS_FILE every DUMP_PERIOD.
+    """
+    LagMonitor(clock, stats).start()
+    dumpLoop = LoopingCall(stats.dump)
+    dumpLoop.clock = clock
+    dumpLoop.start(DUMP_PERIOD, now = False)
+
+def _ms(seconds):
+    if seconds is None:
+        return "-"
+    return "%.1fms" % (seconds * 1000)
@@ -0,0 +1,174 @@
+from datetime import timedelta
+
+from planner import groupMinutes
+
+# What can happen on a timeline. Every event is (when, kind, zones).
+START, STOP, END, DONE = "start", "stop", "end", "done"
+
+class ProgramTimeline(object):
+    """
+    Every zone start and stop of one program (or one manual zone run),
+    worked out before the first zone turns on.
+
+        START  Turn these zones on and everything else off
+        STOP   Turn this zone off, the rest of its group keeps going
+        END    The group is done. Everything off.
+        DONE   The program is done
+
+    next is the index of the first event that hasn't happened yet. The
+    whole thing pickles, so it goes in the config and can be picked up
+    again after a restart.
+    """
+    def __init__(self, events, scheduled, next = 0):
+        self.events = events
+        self.scheduled = scheduled
+        self.next = next
+
+    def nextEvent(self):
+        return self.events[self.next]
+
+    def runningZones(self):
+        """
+        The zones that should be on right now.
+        """
+        running = []
+        for when, kind, zones in self.events[:self.next]:
+            if kind == START:
+                running = list(zones)
+            elif kind == STOP:
+                running = [zone for zone in running if zone not in zones]
+            else:
+                running = []
+        return running
+
+    def zoneTimes(self):
+        """
+        [(zone, start, stop), ...] in order, for the zones that haven't
+        finished yet.
+        """
+        starts = {}
+        times = []
+        for i, (when, kind, zones) in enumerate(self.events):
+            for zone in zones:
+                if kind == START:
+                    starts[zone] = when
+                elif zone in starts:
+                    if i >= self.next:
+                        times.append((zone, starts[zone], when))
+                    del starts[zone]
+        times.sort(key = lambda (zone, start, stop): (start, zone))
+        return times
+
+    def resumed(self, now, since = None):
+        """
+        A copy picking up where this one left off, as of now. Everything
+        left is pushed back by the time since it stopped at since. After a
+        restart nobody knows how long we were gone, so it's the time since
+        the last event that happened. Zones that were on get turned back on
+        for the rest of their time.
+        """
+        if since is not None:
+            offset = now - since
+        elif self.next:
+            offset = now - self.events[self.next - 1][0]
+        else:
+            offset = now - self.events[0][0]
+        events = [(when + offset, kind, zones) for when, kind, zones in self.events[self.next:]]
+        running = self.runningZones()
+        if running:
+            events.insert(0, (now, START, running))
+        return ProgramTimeline(events, self.scheduled)
+
+class TimelineRun(object):
+    """
+    A ProgramTimeline being followed. It owns the one timer that drives it,
+    so cancelling it (or holding it, or starting another run in its place)
+    is just cancelling that, and nothing it set up can touch the relays
+    afterward.
+
+    onEvent(run) gets called when the next event is due. It does what's due
+    and calls arm() for the one after. Pass heldAt to start out held.
+    """
+    def __init__(self, programTimeline, clock, onEvent, heldAt = None):
+        self.timeline = programTimeline
+        self.clock = clock
+        self.onEvent = onEvent
+        self.call = None
+        self.heldAt = heldAt    # When hold() stopped it
+        self.cancelled = False
+
+    def arm(self, now):
+        """
+        Set the timer for the next event, as of now.
+        """
+        self._stopTimer()
+        if self.cancelled or self.heldAt is not None:
+            return
+        when = self.timeline.nextEvent()[0]
+        delta = when - now
+        delaySeconds = max(0, delta.days * 86400 + delta.seconds + delta.microseconds / 1e6)
+        self.call = self.clock.callLater(delaySeconds, self._due)
+
+    def cancel(self):
+        self.cancelled = True
+        self._stopTimer()
+
+    def hold(self, now):
+        """
+        Stop the clock on it. Returns False if it was already held.
+        """
+        if self.heldAt is not None:
+            return False
+        self.heldAt = now
+        self._stopTimer()
+        return True
+
+    def resume(self, now):
+        """
+        Pick up where hold() left off. Everything left gets pushed back by
+        how long it was held, so every zone still gets its whole time.
+        """
+        self.timeline = self.timeline.resumed(now, self.heldAt)
+        self.heldAt = None
+        self.arm(now)
+
+    def held(self):
+        return self.heldAt is not None
+
+    def _due(self):
+        self.call = None
+        if not self.cancelled:
+            self.onEvent(self)
+
+    def _stopTimer(self):
+        if self.call and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+def buildTimeline(groups, runTimesMinutes, start, zoneDelaySeconds, scheduled):
+    """
+    Lay out the groups from planner.planProgram one after another starting
+    at start, with zoneDelaySeconds between them.
+    """
+    events = []
+    when = start
+    for group in groups:
+        groupSeconds = 60 * groupMinutes(group, runTimesMinutes)
+        events.append((when, START, list(group)))
+        for zone in group:
+            if 60 * runTimesMinutes[zone] < groupSeconds:
+                events.append((when + timedelta(minutes = runTimesMinutes[zone]), STOP, [zone]))
+        when += timedelta(seconds = groupSeconds)
+        events.append((when, END, list(group)))
+        when += timedelta(seconds = zoneDelaySeconds)
+    events.append((when, DONE, []))
+    events.sort(key = lambda (when, kind, zones): when) # Stable, so START stays ahead of its STOPs
+    return ProgramTimeline(events, scheduled)
+
+def zoneTimeline(zone, runMinutes, start):
+    """
+    Just the one zone. Like the old single zone runs, the program is done
+    as soon as it turns off.
+    """
+    stop = start + timedelta(minutes = runMinutes)
+    return ProgramTimeline([(start, START, [zone]), (stop, DONE, [zone])], False)
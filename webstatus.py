@@ -0,0 +1,202 @@
+import json
+from datetime import datetime
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+from rainbot import SchedulerState
+
+# The moisture numbers change without anybody saying so, so don't hand out
+# a snapshot older than this even if nothing else changed.
+SNAPSHOT_MAX_AGE = 60
+
+STATE_NAMES = { SchedulerState.SCHEDULER_OFF               : "off",
+                SchedulerState.SCHEDULER_ON                : "on",
+                SchedulerState.SCHEDULER_RUNNING_SCHEDULED : "running scheduled",
+                SchedulerState.SCHEDULER_RUNNING_MANUAL    : "running manual" }
+
+class StatusSnapshot(object):
+    """
+    The JSON for /status, made once and handed out until something changes.
+    The bots call invalidate() (through their status listeners) whenever
+    they set a new status, so polling as fast as you like only ever reads
+    what's in memory. It never touches the U3 or rrdtool.
+    """
+    def __init__(self, rainbot, liftbot = None, clock = reactor):
+        self.rainbot = rainbot
+        self.liftbot = liftbot
+        self.clock = clock
+        self.json = None
+        self.madeAt = None
+        rainbot.statusListeners.append(self.invalidate)
+        if liftbot:
+            liftbot.statusListeners.append(self.invalidate)
+
+    def invalidate(self):
+        self.json = None
+
+    def get(self):
+        now = self.clock.seconds()
+        if self.json is None or now - self.madeAt > SNAPSHOT_MAX_AGE:
+            self.json = json.dumps(self.make(), sort_keys = True)
+            self.madeAt = now
+        return self.json
+
+    def make(self):
+        status = {"generated" : _time(datetime.fromtimestamp(self.clock.seconds()))}
+        scheduler = getattr(self.rainbot, "scheduler", None)
+        if scheduler:
+            runTimesMinutes = scheduler.shelveConfig["runTimesMinutes"]
+            status["state"] = STATE_NAMES[scheduler.state]
+            status["lastRun"] = _time(scheduler.shelveConfig["lastRun"])
+            willRun = getattr(scheduler, "willRunDatetime", None) # Not until a run's been scheduled
+            if scheduler.state == SchedulerState.SCHEDULER_OFF or willRun is None:
+                status["willRun"] = None
+            else:
+                status["willRun"] = _time(willRun)
+            status["running"] = sorted(scheduler.zonesOn)
+            status["runTimesMinutes"] = dict((str(zone), minutes) for zone, minutes in runTimesMinutes.items())
+            status["zoneTimes"] = [[zone, _time(start), _time(stop)] for zone, start, stop in scheduler.zoneTimes()]
+            status["moistureAdjust"] = scheduler.adjusting() and scheduler.settings.moistureAdjust or "off"
+        moisture = getattr(self.rainbot, "moisture", None)
+        if moisture:
+            # The sensor for every zone is at the top like it always was, and
+            # zones with their own are under "zones".
+            status["moisture"] = {}
+            for zone in moisture.zones:
+                if zone is None:
+                    sensor = status["moisture"]
+                else:
+                    sensor = status["moisture"].setdefault("zones", {}).setdefault(str(zone), {})
+                sensor["now"] = moisture.lastReadings.get(zone)
+                for window in ("1h", "1d"):
+                    sensor[window] = moisture.aggregates[zone][window].mean()
+        doorState = self.liftbot and getattr(self.liftbot, "doorState", None)
+        if doorState:
+            status["doors"] = {"big" : doorState.bigDoorUp and "open" or "closed",
+                               "little" : doorState.littleDoorUp and "open" or "closed"}
+        return status
+
+class StatusResource(resource.Resource):
+    """
+    GET /status
+    """
+    isLeaf = True
+
+    def __init__(self, snapshot):
+        resource.Resource.__init__(self)
+        self.snapshot = snapshot
+
+    def render_GET(self, request):
+        request.setHeader("content-type", "application/json")
+        return self.snapshot.get()
+
+class ControlResource(resource.Resource):
+    """
+    POST /control/<verb>, which does the same thing as the chat command.
+
+        /control/on
+        /control/off
+        /control/pause?days=2
+        /control/zone?zone=4&minutes=3
+
+    Answers with JSON, {"result": ...} or {"error": ...}.
+    """
+    isLeaf = True
+
+    def __init__(self, rainbot):
+        resource.Resource.__init__(self)
+        self.rainbot = rainbot
+
+    def render_POST(self, request):
+        request.setHeader("content-type", "application/json")
+        scheduler = getattr(self.rainbot, "scheduler", None)
+        if scheduler is None:
+            request.setResponseCode(503)
+            return json.dumps({"error" : "Not connected yet"})
+        verb = request.postpath and request.postpath[0] or ""
+        try:
+            if verb == "on":
+                result = scheduler.turnOn()
+            elif verb == "off":
+                scheduler.turnOff()
+                result = "Turned off"
+            elif verb == "pause":
+                result = scheduler.pauseDays(_intArg(request, "days", 1))
+            elif verb == "zone":
+                zone = _intArg(request, "zone")
+                if zone not in scheduler.settings.zoneToIonum:
+                    raise ValueError("No zone " + str(zone))
+                minutes = scheduler.runZone(zone, customRunTime = _intArg(request, "minutes", None))
+                result = "Running zone %d for %s minutes" % (zone, minutes)
+            else:
+                request.setResponseCode(404)
+                return json.dumps({"error" : "Unknown verb: " + verb})
+        except ValueError, e:
+            request.setResponseCode(400)
+            return json.dumps({"error" : str(e)})
+        self.rainbot.statusChanged()
+        return json.dumps({"result" : result})
+
+class GraphResource(resource.Resource):
+    """
+    GET /graph/<window>, a PNG of every moisture sensor over the last 1h,
+    1d, 1w, 1m, or 1y. The sampler keeps the rendered graphs, so this only
+    waits on rrdtool when there's a new row to draw.
+    """
+    isLeaf = True
+
+    def __init__(self, moisture):
+        resource.Resource.__init__(self)
+        self.moisture = moisture
+
+    def render_GET(self, request):
+        window = request.postpath and request.postpath[0] or "1d"
+        d = None
+        if self.moisture is not None:
+            try:
+                d = self.moisture.graph(window)
+            except KeyError:
+                pass
+        if d is None:
+            request.setResponseCode(404)
+            request.setHeader("content-type", "application/json")
+            return json.dumps({"error" : "No graph for " + window})
+        def rendered(png):
+            if not finished:
+                request.setHeader("content-type", "image/png")
+                request.write(png)
+                request.finish()
+        def failed(failure):
+            print "Couldn't draw the", window, "moisture graph.", failure.getErrorMessage()
+            if not finished:
+                request.setResponseCode(500)
+                request.finish()
+        finished = []
+        request.notifyFinish().addErrback(lambda failure: finished.append(True))
+        d.addCallbacks(rendered, failed)
+        return server.NOT_DONE_YET
+
+def makeSite(rainbot, liftbot = None, clock = reactor):
+    """
+    A Site with /status, /control, and /graph on it, for strports.service().
+    """
+    root = resource.Resource()
+    root.putChild("status", StatusResource(StatusSnapshot(rainbot, liftbot, clock)))
+    root.putChild("control", ControlResource(rainbot))
+    root.putChild("graph", GraphResource(getattr(rainbot, "moisture", None)))
+    return server.Site(root)
+
+def _intArg(request, name, default = ValueError):
+    values = request.args.get(name)
+    if not values:
+        if default is ValueError:
+            raise ValueError("Missing " + name)
+        return default
+    try:
+        return int(values[0])
+    except ValueError:
+        raise ValueError("Not a number for " + name + ": " + values[0])
+
+def _time(when):
+    return when.strftime("%Y-%m-%dT%H:%M:%S")